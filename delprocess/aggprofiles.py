@@ -13,12 +13,79 @@ Updated: 4 May 2019
 import pandas as pd
 import numpy as np
 import feather
-from pathlib import Path
+import pyarrow as pa
 import os
+import warnings
+import threading
+from glob import glob
+import json
+import hashlib
+from collections import OrderedDict
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED, as_completed
+from functools import lru_cache
+from pandas.tseries.frequencies import to_offset
 
 from .surveys import loadID
-from .loadprofiles import loadReducedProfiles, getProfilePower
-from .support import pdata_dir, validYears, InputError#, writeLog
+from .loadprofiles import loadReducedProfiles, getProfilePower, iterProfilePower, resampleReadings, channelTopology, _reducedProfilesInput, _fileSignature
+from .support import pdata_dir, table_dir, validYears, InputError, writeLog, writeAsync, tempPath
+
+
+def _calendarTable(labels, interval):
+    """Computes calendar metadata for a DatetimeIndex of interval labels. 
+    interval_hours is the length of the interval that ends at a label, as 
+    returned by pd.date_range(end=label, periods=2, freq=interval).
+    """
+    offset = to_offset(interval)
+    # Labels that are not on offset are rolled back to the previous offset
+    rollback = labels.where((labels - offset) + offset == labels, labels - offset)
+    meta = pd.DataFrame({'interval_hours':(labels - (rollback - offset)) / np.timedelta64(1, 'h'),
+                         'month':labels.month, 
+                         'dayix':labels.dayofweek,
+                         'hour':labels.hour}, index=labels)
+    meta['daytype'] = pd.Categorical.from_codes(np.searchsorted([5, 6], meta.dayix, 'right'), 
+                                                ['Weekday','Saturday','Sunday'], ordered=True)
+    meta['season'] = np.where(meta.month.isin([5, 6, 7, 8]), 'high', 'low')
+    
+    return meta
+
+
+@lru_cache(maxsize=64)
+def calendarMeta(interval, year):
+    """Returns calendar metadata for all interval labels in a year. Results are 
+    cached per (interval, year) and must not be modified.
+    
+    Parameters:
+        interval (str): pandas offset alias, eg 'H', 'D', 'M'
+        year (int)
+    
+    Returns:
+        pandas dataframe indexed by label with columns [
+                'interval_hours', 'month', 'dayix', 'hour', 'daytype', 'season']
+    """
+    labels = pd.date_range(str(year), pd.Timestamp(str(year + 1)) - pd.Timedelta(1), 
+                           freq=interval)
+    
+    return _calendarTable(labels, interval)
+
+
+def intervalCalendar(datefield, interval):
+    """Looks up the calendar metadata of calendarMeta() for each timestamp in 
+    datefield. Timestamps that are not interval labels are computed directly.
+    
+    Returns:
+        pandas dataframe with the columns of calendarMeta(), one row per timestamp
+    """
+    codes, labels = pd.factorize(np.asarray(datefield, dtype='datetime64[ns]'))
+    labels = pd.DatetimeIndex(labels)
+    tables = [calendarMeta(interval, y) for y in np.unique(labels.year)]
+    table = pd.concat(tables) if len(tables) > 0 else _calendarTable(labels, interval)
+    table = table[~table.index.duplicated()]
+    missing = labels[table.index.get_indexer(labels) < 0]
+    if len(missing) > 0:
+        table = pd.concat([table, _calendarTable(missing, interval)])
+    
+    return table.iloc[table.index.get_indexer(labels)[codes]].reset_index(drop=True)
 
 
 def aggTs(year, unit, interval, mean=True, dir_name='H'):
@@ -35,7 +102,6 @@ def aggTs(year, unit, interval, mean=True, dir_name='H'):
     try:
         data = loadReducedProfiles(year, unit, dir_name)
         data['ProfileID'] = data['ProfileID'].astype('category')
-        data.set_index('Datefield', inplace=True)
         # Ensure that only valid data is used in aggregation
         data.loc[data['Valid']!=1,'Unitsread'] = np.nan 
     except:
@@ -43,15 +109,16 @@ def aggTs(year, unit, interval, mean=True, dir_name='H'):
         
     # Specify aggregation function for different units    
     if unit in ['kW','kVA']:
-        aggregated = data.groupby('ProfileID').resample(interval).agg({
+        aggregated = resampleReadings(data, interval, by=['ProfileID'], fill=True, agg={
                 'Unitsread':'sum',
                 'Valid':'sum',
                 'RecorderID':'count'})
     elif unit in ['A', 'V', 'Hz']:
-        aggregated = data.groupby('ProfileID').resample(interval).agg({
+        aggregated = resampleReadings(data, interval, by=['ProfileID'], fill=True, agg={
                 'Unitsread':'mean',
                 'Valid':'sum',
                 'RecorderID':'count'})
+    aggregated.set_index(['ProfileID', 'Datefield'], inplace=True)
 
     if mean is True:
         aggregated['vu'] = aggregated.Unitsread*aggregated.Valid
@@ -79,67 +146,305 @@ def aggProfilePower(profilepowerdata, interval):
     
     The aggregate function for kW and kW_calculated is sum().
     The aggregate function for A, V is mean().
-    """
-    data = profilepowerdata.set_index('Datefield')
     
+    As with groupby().resample(), the intervals without readings between the first 
+    and last reading of a profile are included, with 0 valid hours.
+    """
     try:
-        aggprofile = data.groupby(['RecorderID','ProfileID_i']).resample(interval).agg({
+        aggprofile = resampleReadings(profilepowerdata, interval, 
+                                      by=['RecorderID','ProfileID_i'], fill=True, agg={
                 'Unitsread_i': np.mean, 
                 'Unitsread_v': np.mean, 
                 'Unitsread_kw': np.sum,
                 'Unitsread_kva': np.mean,
                 'kw_calculated': np.sum, 
                 'valid_calculated': np.sum})
-    except:
-        aggprofile = data.groupby(['RecorderID','ProfileID_i']).resample(interval).agg({
+    except KeyError:
+        aggprofile = resampleReadings(profilepowerdata, interval, 
+                                      by=['RecorderID','ProfileID_i'], fill=True, agg={
                 'Unitsread_i': np.mean, 
                 'Unitsread_v': np.mean, 
                 'kw_calculated': np.sum,  
                 'valid_calculated': np.sum})
         
-    aggprofile.reset_index(inplace=True)        
-    aggprofile['interval_hours'] = aggprofile['Datefield'].apply(lambda x: (
-            x - pd.date_range(end=x, periods=2, freq = interval)[0]) / np.timedelta64(1, 'h'))
+    aggprofile['interval_hours'] = intervalCalendar(aggprofile['Datefield'], 
+                                                    interval)['interval_hours'].values
     aggprofile['valid_obs_ratio'] = aggprofile['valid_calculated']/aggprofile['interval_hours']
     aggprofile['interval'] = interval
 
     return aggprofile
 
 
+def poolMoments(count, mean, m2, axis=0):
+    """Combines the moment statistics of partitions of data along axis into the 
+    statistics of their union (Chan et al.). M2 is the sum of squared deviations 
+    from the mean. Partitions with count 0 are ignored.
+    
+    Returns:
+        count, mean (nan if count is 0) and M2 arrays
+    """
+    count = np.asarray(count)
+    has = count > 0
+    mean = np.where(has, mean, 0)
+    n = count.sum(axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pooled = (count*mean).sum(axis=axis) / n
+        dev = np.where(has, m2 + count*(mean - np.expand_dims(pooled, axis))**2, 0)
+    
+    return n, np.where(n > 0, pooled, np.nan), dev.sum(axis=axis)
+
+
+def momentStd(count, m2):
+    """Returns the sample standard deviation from count and M2 (nan if count < 2)."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 1, np.sqrt(m2 / (count - 1)), np.nan)
+
+
+def _groupMoments(grouped, column):
+    """Computes count, mean and M2 of column for every group of a groupby object."""
+    stats = grouped[column].agg(['count', 'mean', 'var'])
+    stats['m2'] = (stats['var']*(stats['count'] - 1)).fillna(0)
+    
+    return stats
+
+
 def annualIntervalDemand(aggprofilepowerdata):
     """Computes the mean annual power consumption for the interval aggregated in aggprofilepowerdata.
+    
+    The count and M2 of the kW (and kVA) readings are saved with the mean and std, 
+    so that the demand of batches of profiles can be combined with mergeDemand().
     """
     interval = aggprofilepowerdata.interval[0]
+    data = aggprofilepowerdata
+    # For years < 2009 where only V and I were observed
+    if 'Unitsread_kw' in data.columns:
+        values = {'kw':'Unitsread_kw', 'kva':'Unitsread_kva'}
+    else:
+        values = {'kw':'kw_calculated'}
     
-    try:
-        aggdemand = aggprofilepowerdata.groupby(['RecorderID','ProfileID_i']).agg({
-                'Unitsread_kw': ['mean', 'std'], 
-                'Unitsread_kva': ['mean', 'std'],
-                'valid_calculated':'sum',
-                'interval_hours':'sum'})
-        aggdemand.columns = ['_'.join(col).strip() for col in aggdemand.columns.values]
-        aggdemand.rename(columns={
-                'Unitsread_kw_mean':interval+'_kw_mean', 
-                'Unitsread_kw_std':interval+'_kw_std', 
-                'Unitsread_kva_mean':interval+'_kva_mean', 
-                'Unitsread_kva_std':interval+'_kva_std', 
-                'valid_calculated_sum':'valid_hours'}, inplace=True)
-    except:
-        aggdemand = aggprofilepowerdata.groupby(['RecorderID','ProfileID_i']).agg({
-                'kw_calculated': ['mean', 'std'], 
-                'valid_calculated':'sum',
-                'interval_hours':'sum'})        
-        aggdemand.columns = ['_'.join(col).strip() for col in aggdemand.columns.values]
-        aggdemand.rename(columns={
-                'kw_calculated_mean':interval+'_kw_mean', 
-                'kw_calculated_std':interval+'_kw_std', 
-                'valid_calculated_sum':'valid_hours'}, inplace=True) 
-        
+    grouped = data.groupby(['RecorderID','ProfileID_i'], observed=True)
+    moments = {v:_groupMoments(grouped, col) for v, col in values.items()}
+    aggdemand = pd.DataFrame(index=moments['kw'].index)
+    for v, stats in moments.items():
+        aggdemand[interval + '_' + v + '_mean'] = stats['mean']
+        aggdemand[interval + '_' + v + '_std'] = np.sqrt(stats['var'])
+    aggdemand['valid_hours'] = grouped['valid_calculated'].sum()
+    aggdemand['interval_hours_sum'] = grouped['interval_hours'].sum()
     aggdemand['valid_obs_ratio'] = aggdemand['valid_hours']/aggdemand['interval_hours_sum']    
     aggdemand['interval'] = interval
+    for v, stats in moments.items():
+        aggdemand[interval + '_' + v + '_count'] = stats['count']
+        aggdemand[interval + '_' + v + '_m2'] = stats['m2']
     
     return aggdemand.reset_index()
 
+
+def mergeDemand(demand, keys):
+    """Combines rows of demand tables with the same keys, eg the annual interval 
+    demand or average daytype demand of batches of readings. Means, stds, counts 
+    and M2 are pooled exactly with poolMoments(), hours are summed and 
+    valid_obs_ratio is recomputed. Other columns keep their first value.
+    
+    Parameters:
+        demand (dataframe): concatenated output of annualIntervalDemand(), 
+            aggDaytypeDemand() or cubeDaytypeDemand()
+        keys (list): columns identifying a row, eg ['RecorderID', 'ProfileID_i']
+    
+    Returns:
+        pandas dataframe sorted by keys
+    """
+    grouped = demand.groupby(keys, sort=True, observed=True)
+    codes = grouped.ngroup().values
+    merged = grouped.first()
+    for m in [c[:-3] for c in demand.columns if c.endswith('_m2')]:
+        count = demand[m + '_count'].values
+        mean = np.where(count > 0, demand[m + '_mean'].values, 0)
+        n = np.bincount(codes, count, len(merged))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pooled = np.bincount(codes, count*mean, len(merged)) / n
+        dev = np.where(count > 0, demand[m + '_m2'].values + count*(mean - pooled[codes])**2, 0)
+        merged[m + '_count'] = n.astype(demand[m + '_count'].dtype)
+        merged[m + '_mean'] = np.where(n > 0, pooled, np.nan)
+        merged[m + '_m2'] = np.bincount(codes, dev, len(merged))
+        merged[m + '_std'] = momentStd(n, merged[m + '_m2'].values)
+    hours = [c for c in ['interval_hours_sum', 'total_hours_sum'] if c in demand.columns]
+    for c in ['valid_hours'] + hours:
+        merged[c] = grouped[c].sum()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged['valid_obs_ratio'] = merged['valid_hours'] / merged[hours[0]]
+    
+    return merged.reset_index()[demand.columns]
+
+
+def daytypeCube(profilepowerdata):
+    """Accumulates hourly profile power in a dense cube of shape (profiles, 12 
+    months, 3 daytypes, 24 hours). The cube holds the count, mean and M2 of kW 
+    (and kVA for years > 2009) readings, and the valid and total hours of each 
+    cell. profilepowerdata is not modified.
+    
+    Returns:
+        dict of numpy arrays with keys 'ProfileID_i' (sorted) and 'kw_count', 
+        'kw_mean', 'kw_m2', ['kva_count', 'kva_mean', 'kva_m2'], 'valid_hours', 
+        'total_hours'
+    """
+    data = profilepowerdata
+    # For years < 2009 where only V and I were observed
+    if 'Unitsread_kw' in data.columns:
+        values = {'kw':'Unitsread_kw', 'kva':'Unitsread_kva'}
+    else:
+        values = {'kw':'kw_calculated'}
+    
+    ids, pcodes = np.unique(data['ProfileID_i'].values, return_inverse=True)
+    calendar = intervalCalendar(data['Datefield'], 'H')
+    cells = ((pcodes*12 + calendar['month'].values - 1)*3 + 
+             calendar['daytype'].cat.codes.values)*24 + calendar['hour'].values
+    shape = (len(ids), 12, 3, 24)
+    size = int(np.prod(shape))
+    
+    cube = {'ProfileID_i':ids}
+    for v, col in values.items():
+        x = data[col].values.astype(float)
+        ok = ~np.isnan(x)
+        c = cells[ok]
+        count = np.bincount(c, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(c, x[ok], size) / count
+        cube[v + '_count'] = count.reshape(shape)
+        cube[v + '_mean'] = mean.reshape(shape)
+        cube[v + '_m2'] = np.bincount(c, (x[ok] - mean[c])**2, size).reshape(shape)
+    valid = np.nan_to_num(data['valid_calculated'].values.astype(float))
+    cube['valid_hours'] = np.bincount(cells, valid, size).reshape(shape)
+    cube['total_hours'] = np.bincount(cells, minlength=size).reshape(shape)
+    
+    return cube
+
+
+def _cubeMoments(cube):
+    """Returns the names of the readings with moment statistics in a cube."""
+    return [k[:-3] for k in cube.keys() if k.endswith('_m2')]
+
+
+def mergeDaytypeCubes(cubes):
+    """Merges daytype cubes of batches of readings into a single cube. Cells of 
+    ProfileIDs that appear in several cubes are combined with poolMoments().
+    """
+    ids = np.unique(np.concatenate([c['ProfileID_i'] for c in cubes]))
+    merged = {'ProfileID_i':ids}
+    for k, a in cubes[0].items():
+        if k != 'ProfileID_i':
+            merged[k] = np.zeros((len(ids),) + a.shape[1:], a.dtype)
+    for c in cubes:
+        pos = np.searchsorted(ids, c['ProfileID_i'])
+        for v in _cubeMoments(c):
+            stats = [np.stack([merged[v + s][pos], c[v + s]]) for s in ['_count', '_mean', '_m2']]
+            for s, a in zip(['_count', '_mean', '_m2'], poolMoments(*stats)):
+                merged[v + s][pos] = a
+        for k in ['valid_hours', 'total_hours']:
+            merged[k][pos] += c[k]
+    
+    return merged
+
+
+def cubeDaytypeDemand(cube, groups=None, name='month'):
+    """Reduces a daytype cube to an average daytype demand table with a row for 
+    every ProfileID_i, month (or month group), daytype and hour. Months and hours 
+    without any readings are omitted.
+    
+    Parameters:
+        cube (dict): output of daytypeCube()
+        groups (dict): maps months (1-12) to group labels, eg seasons. Defaults 
+            to None (one row per month). The moments of the months in a group 
+            are pooled, so that the mean and std of a group are those of all its 
+            readings.
+        name (str): name of the month group column
+    
+    Returns:
+        pandas dataframe with columns [
+                'ProfileID_i', name, 'daytype', 'hour', 'kw_mean', 'kw_std', 
+                ['kva_mean', 'kva_std'], 'valid_hours', 'total_hours_sum', 
+                'valid_obs_ratio', 'kw_count', 'kw_m2', ['kva_count', 'kva_m2']]
+    """
+    ids = cube['ProfileID_i']
+    moments = _cubeMoments(cube)
+    observed = cube['total_hours'].sum(axis=(0, 2)) > 0
+    months = np.flatnonzero(observed.any(axis=1))
+    hours = np.flatnonzero(observed.any(axis=0))
+    
+    if groups is None:
+        labels = months + 1
+        cube = {k:a[:, months] for k, a in cube.items() if k != 'ProfileID_i'}
+    else:
+        labels = pd.Categorical(sorted(set(groups[m + 1] for m in months)))
+        members = [[m for m in months if groups[m + 1] == l] for l in labels]
+        reduced = {}
+        for v in moments:
+            pooled = [poolMoments(*[cube[v + s][:, m] for s in ['_count', '_mean', '_m2']], 
+                                  axis=1) for m in members]
+            for i, s in enumerate(['_count', '_mean', '_m2']):
+                reduced[v + s] = np.stack([p[i] for p in pooled], axis=1)
+        for k in ['valid_hours', 'total_hours']:
+            reduced[k] = np.stack([cube[k][:, m].sum(axis=1) for m in members], axis=1)
+        cube = reduced
+    
+    stats = OrderedDict()
+    for v in moments:
+        stats[v + '_mean'] = cube[v + '_mean']
+        stats[v + '_std'] = momentStd(cube[v + '_count'], cube[v + '_m2'])
+    stats['valid_hours'] = cube['valid_hours']
+    stats['total_hours_sum'] = cube['total_hours']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['valid_obs_ratio'] = cube['valid_hours'] / cube['total_hours']
+    for v in moments:
+        stats[v + '_count'] = cube[v + '_count']
+        stats[v + '_m2'] = cube[v + '_m2']
+    
+    daytypes = ['Weekday','Saturday','Sunday']
+    index = pd.MultiIndex.from_product([ids, labels, range(3), hours],
+                                       names=['ProfileID_i', name, 'daytype', 'hour'])
+    demand = index.to_frame(index=False)
+    demand['daytype'] = pd.Categorical.from_codes(demand['daytype'], daytypes, ordered=True)
+    for k, a in stats.items():
+        demand[k] = a[..., hours].ravel()
+    
+    return demand
+
+
+def _savez(cube, path):
+    with open(path, 'wb') as f:
+        np.savez(f, **cube)
+
+
+def saveDaytypeCube(cube, year):
+    """Saves a daytype cube to aggProfiles/adtd_cube as a numpy .npz file in the 
+    background. Returns the future of the write (see writeAsync()).
+    """
+    path = os.path.join(pdata_dir, 'aggProfiles', 'adtd_cube')
+    os.makedirs(path, exist_ok=True)
+    
+    return writeAsync(os.path.join(path, 'adtd_cube_' + str(year) + '.npz'), 
+                      lambda tmp_path: _savez(cube, tmp_path))
+
+
+def readDaytypeCube(year):
+    """Reads the daytype cube of a year. If it has not been saved or was saved by 
+    an earlier version, it is built from the profile power file of the year and saved.
+    """
+    validYears(year)
+    path = os.path.join(pdata_dir, 'aggProfiles', 'adtd_cube', 'adtd_cube_' + str(year) + '.npz')
+    try:
+        with np.load(path) as f:
+            cube = dict(f)
+        # Cubes saved before moment statistics were introduced are rebuilt
+        if 'kw_m2' in cube:
+            return cube
+    except FileNotFoundError:
+        pass
+    cube = daytypeCube(readAggProfiles(year, 'pp'))
+    saveDaytypeCube(cube, year)
+    
+    return cube
+
+
 def aggDaytypeDemand(profilepowerdata):   
     """
     This function generates an hourly load profile for each ProfileID_i.
@@ -148,99 +453,732 @@ def aggDaytypeDemand(profilepowerdata):
         Daytype [Weekday, Sunday, Monday]
         Hour
     """
+    return cubeDaytypeDemand(daytypeCube(profilepowerdata))
+
+
+# Relative accuracy of the kW quantile sketches
+sketch_accuracy = 0.01
+# Readings up to this value (including zero and negative readings) share a bucket
+_sketch_min = 1e-6
+
+
+def kwSketch(profilepowerdata, accuracy=None):
+    """Sketches the distribution of kW readings of every ProfileID_i and month for 
+    quantile queries. Readings are counted in logarithmic buckets with bounds 
+    gamma**(bucket-1) and gamma**bucket, gamma = (1 + accuracy)/(1 - accuracy) 
+    (DDSketch), so that quantile estimates are within the relative accuracy. The 
+    smallest and largest reading of every bucket are kept, which makes the 
+    minimum and peak exact. Sketches are merged with mergeSketches().
+    
+    Parameters:
+        profilepowerdata (dataframe): profile power, eg a batch of iterProfilePower()
+        accuracy (float): relative accuracy. Defaults to None (sketch_accuracy).
+    
+    Returns:
+        pandas dataframe with columns ['ProfileID_i', 'month', 'bucket', 'count', 
+        'min', 'max']
+    """
+    if accuracy is None:
+        accuracy = sketch_accuracy
     data = profilepowerdata
-    data['month'] = data['Datefield'].dt.month
-    data['dayix'] = data['Datefield'].dt.dayofweek
-    data['hour'] = data['Datefield'].dt.hour
-    cats = pd.cut(data.dayix, bins = [0, 5, 6, 7], right=False, 
-                  labels= ['Weekday','Saturday','Sunday'], include_lowest=True)
-    data['daytype'] = cats
-    data['total_hours'] = 1    
+    # For years < 2009 where only V and I were observed
+    kw = data['Unitsread_kw'] if 'Unitsread_kw' in data.columns else data['kw_calculated']
+    x = kw.values.astype(float)
+    ok = ~np.isnan(x)
+    x = x[ok]
+    gamma = (1 + accuracy) / (1 - accuracy)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bucket = np.where(x > _sketch_min, np.ceil(np.log(x) / np.log(gamma)), 
+                          np.iinfo(np.int32).min).astype(np.int32)
+    readings = pd.DataFrame({'ProfileID_i':data['ProfileID_i'].values[ok], 
+                             'month':data['Datefield'].dt.month.values[ok], 
+                             'bucket':bucket, 'kw':x})
+    sketch = readings.groupby(['ProfileID_i', 'month', 'bucket'])['kw'].agg(
+            ['count', 'min', 'max'])
+    
+    return sketch.reset_index()
+
+
+def mergeSketches(sketches, keys=['ProfileID_i', 'month']):
+    """Merges kW sketches of batches of readings, eg recorder batches or years. 
+    Sketches must have been built with the same accuracy.
+    """
+    sketch = pd.concat(sketches, ignore_index=True) if isinstance(sketches, list) else sketches
+    merged = sketch.groupby(keys + ['bucket']).agg({'count':'sum', 'min':'min', 'max':'max'})
+    
+    return merged.reset_index()
+
+
+def sketchQuantiles(sketch, quantiles=[0.5, 0.95, 0.99], groups=None, name='month', 
+                    accuracy=None):
+    """Estimates kW quantiles and the peak kW from a sketch for every ProfileID_i 
+    and month, or month group. Quantiles are interpolated linearly between the 
+    smallest and largest reading of the bucket that contains their rank, or 
+    between the largest reading of a bucket and the smallest of the next. 
+    Estimates within a bucket are limited to the values that are within the 
+    relative accuracy of every reading in the bucket.
+    
+    Parameters:
+        sketch (dataframe): output of kwSketch() or mergeSketches()
+        quantiles (list): quantiles between 0 and 1
+        groups (dict): maps months (1-12) to group labels, eg seasons. Defaults 
+            to None (one row per month).
+        name (str): name of the month group column
+        accuracy (float): relative accuracy the sketch was built with. Defaults 
+            to None (sketch_accuracy).
+    
+    Returns:
+        pandas dataframe with columns ['ProfileID_i', name, 'count', 'kw_p50', 
+        ..., 'kw_peak']
+    """
+    if accuracy is None:
+        accuracy = sketch_accuracy
+    if groups is not None:
+        sketch = sketch.assign(month = sketch['month'].map(groups)).rename(columns={'month':name})
+        sketch = mergeSketches(sketch, ['ProfileID_i', name])
+    keys = ['ProfileID_i', name]
+    sketch = sketch.sort_values(keys + ['bucket'])
+    grouped = sketch.groupby(keys, sort=False)
+    end = grouped['count'].cumsum().values
+    start = end - sketch['count'].values
+    n = grouped['count'].transform('sum').values
+    # Smallest reading of the next bucket, for ranks between two buckets
+    last = np.r_[(sketch[keys].values[1:] != sketch[keys].values[:-1]).any(axis=1), True]
+    next_min = np.where(last, sketch['max'].values, np.r_[sketch['min'].values[1:], np.nan])
+    
+    result = grouped.agg(count=('count', 'sum'), kw_peak=('max', 'max'))
+    for q in quantiles:
+        rank = q*(n - 1)
+        row = (start <= rank) & (rank < end)
+        lo = sketch['min'].values[row]
+        hi = sketch['max'].values[row]
+        count = sketch['count'].values[row]
+        position = rank[row] - start[row]
+        within = position <= count - 1
+        interpolated = lo + (hi - lo)*position/np.maximum(count - 1, 1)
+        # Readings up to _sketch_min share a bucket without relative bounds
+        logarithmic = sketch['bucket'].values[row] > np.iinfo(np.int32).min
+        interpolated = np.where(logarithmic, np.clip(interpolated, hi*(1 - accuracy), 
+                                                     lo*(1 + accuracy)), interpolated)
+        estimate = np.where(within, interpolated, 
+                            hi + (next_min[row] - hi)*(position - count + 1))
+        result['kw_p' + '{:g}'.format(100*q)] = estimate
+    
+    return result[[c for c in result.columns if c != 'kw_peak'] + ['kw_peak']].reset_index()
+
+
+def kwQuantiles(year, quantiles=[0.5, 0.95, 0.99], period='month'):
+    """Estimates kW quantiles and the peak kW of every ProfileID_i from the kW 
+    sketch saved by generateAggProfiles(), without reading profile power.
+    
+    Parameters:
+        year (int)
+        quantiles (list): quantiles between 0 and 1
+        period (str): one of 'month', 'season' or 'year'
+    
+    Returns:
+        pandas dataframe, see sketchQuantiles()
+    """
+    sketch = readAggProfiles(year, 'kw_sketch')
+    if period == 'month':
+        return sketchQuantiles(sketch, quantiles)
+    elif period == 'season':
+        calendar = calendarMeta('M', year)
+        return sketchQuantiles(sketch, quantiles, dict(zip(calendar.month, calendar.season)), 
+                               'season')
+    elif period == 'year':
+        return sketchQuantiles(sketch, quantiles, {m:year for m in range(1, 13)}, 'year')
+    else:
+        raise InputError(period, 'Invalid period. Select from month, season, year.')
+
+
+# Maximum memory in bytes of the aggregate profile frames cached by readAggProfiles()
+agg_cache_bytes = 2**30
+_agg_cache = OrderedDict()
+_agg_cache_lock = threading.Lock()
+# Parsed artifact catalogs by year
+_catalogs = {}
+
+# Bump to invalidate all aggregate artifacts when the way they are computed changes
+_artifact_version = 4
+
+
+def _aggProfilesPath(aggfunc, year, filetype='feather'):
+    """Returns the path of an aggregate profile file."""
+    return os.path.join(pdata_dir, 'aggProfiles', aggfunc, filetype, 
+                        aggfunc + '_' + str(year) + '.' + filetype)
+
+
+def _aggArtifacts(year, interval, dir_name='H', topology=None):
+    """Returns the artifact graph of generateAggProfiles() in topological order. 
+    Every artifact lists the artifacts it is computed from, the parameters it 
+    depends on and a function that computes it from the values of its parents. Artifacts are saved as feather files unless 
+    they specify their own path, save and load functions.
+    """
+    aggpp = 'aggpp_' + interval
+    aid = 'a' + interval + 'd'
+    cube_path = os.path.join(pdata_dir, 'aggProfiles', 'adtd_cube', 'adtd_cube_' + str(year) + '.npz')
+    
+    return OrderedDict([
+        ('pp', {'parents':[], 'interval':dir_name, 'description':'profile power file',
+                'compute':lambda: getProfilePower(year, dir_name, topology)}),
+        (aggpp, {'parents':['pp'], 'interval':interval, 'description':'aggregate ' + interval + ' profile power file',
+                 'params':[interval], 'compute':lambda pp: aggProfilePower(pp, interval)}),
+        (aid, {'parents':[aggpp], 'params':[interval], 'interval':interval, 'description':'aggregate ' + interval + ' demand file',
+               'compute':annualIntervalDemand}),
+        ('adtd_cube', {'parents':['pp'], 'description':'daytype demand cube', 
+                       'compute':daytypeCube, 'path':cube_path,
+                       'save':lambda cube: saveDaytypeCube(cube, year),
+                       'load':lambda: readDaytypeCube(year)}),
+        ('adtd', {'parents':['adtd_cube'], 'interval':'H', 'description':'average daytype demand file',
+                  'compute':cubeDaytypeDemand}),
+        ('kw_sketch', {'parents':['pp'], 'params':[sketch_accuracy], 'interval':'H',
+                       'description':'kW quantile sketch file', 'compute':kwSketch})])
+
+
+def _artifactInputs(year, dir_name, entries=None):
+    """Returns the signatures of the reduced profiles and the profiles table that 
+    profile power is computed from, by path relative to the data directory. 
+    Signatures are computed with _fileSignature(), which only hashes files whose 
+    size or mtime differ from the signatures in entries, so that reduced profiles 
+    that are saved again with the same content do not invalidate the artifacts. 
+    Reduced profiles are resolved with _reducedProfilesInput(), so that parquet 
+    datasets are covered, and profiles that have not been saved are recorded as 
+    missing instead of being reduced.
+    """
+    entries = {} if entries is None else entries
+    units = ['A', 'V'] if year <= 2009 else ['A', 'V', 'kW', 'kVA']
+    paths = [_reducedProfilesInput(year, unit, dir_name) for unit in units]
+    paths.append(os.path.join(table_dir, 'profiles.csv'))
+    files = []
+    inputs = OrderedDict()
+    for unit, path in zip(units + [None], paths):
+        if path is None:
+            inputs[os.path.join(dir_name, unit)] = None
+        elif os.path.isdir(path):
+            files.extend(sorted(os.path.join(root, f) for root, dirs, fs in os.walk(path) 
+                                for f in fs))
+        else:
+            files.append(path)
+    for f in files:
+        key = os.path.relpath(f, os.path.dirname(pdata_dir))
+        inputs[key] = _fileSignature(f, entries.get(key))
+    
+    return inputs
+
+
+def _artifactFingerprints(artifacts, year, dir_name, inputs):
+    """Fingerprints every artifact with its parameters and the fingerprints of 
+    the artifacts it depends on, starting from the content of the inputs of 
+    profile power returned by _artifactInputs().
+    """
+    hashes = [[key, None if sig is None else sig['md5']] for key, sig in inputs.items()]
+    fingerprints = {}
+    for name, artifact in artifacts.items():
+        if len(artifact['parents']) == 0:
+            params = [year, dir_name, hashes]
+        else:
+            params = [year, artifact.get('params', []), 
+                      [fingerprints[p] for p in artifact['parents']]]
+        key = json.dumps([_artifact_version, name, params])
+        fingerprints[name] = hashlib.md5(key.encode()).hexdigest()
     
+    return fingerprints
+
+
+def _artifactPath(artifacts, name, year):
+    return artifacts[name].get('path', _aggProfilesPath(name, year))
+
+
+def _loadArtifactManifest(year):
+    """Loads the fingerprints of the aggregate artifacts saved for a year."""
+    path = os.path.join(pdata_dir, 'aggProfiles', 'manifest', 'manifest_' + str(year) + '.json')
     try:
-        daytypedemand = data.groupby(['ProfileID_i', 'month', 'daytype', 'hour']).agg({
-                'Unitsread_kw': ['mean', 'std'], 
-                'Unitsread_kva': ['mean', 'std'],
-                'valid_calculated':'sum', 
-                'total_hours':'sum'})
-        daytypedemand.columns = ['_'.join(col).strip() for col in daytypedemand.columns.values]
-        daytypedemand.rename(columns={
-                'Unitsread_kw_mean':'kw_mean', 
-                'Unitsread_kw_std':'kw_std', 
-                'Unitsread_kva_mean':'kva_mean', 
-                'Unitsread_kva_std':'kva_std', 
-                'valid_calculated_sum':'valid_hours'}, inplace=True)
-    # For years < 2009 where only V and I were observed
-    except: 
-        daytypedemand = data.groupby(['ProfileID_i', 'month', 'daytype', 'hour']).agg({
-                'kw_calculated': ['mean', 'std'],
-                'valid_calculated':'sum', 
-                'total_hours':'sum'})
-        daytypedemand.columns = ['_'.join(col).strip() for col in daytypedemand.columns.values]
-        daytypedemand.rename(columns={
-                'kw_calculated_mean':'kw_mean', 
-                'kw_calculated_std':'kw_std', 
-                'valid_calculated_sum':'valid_hours'}, inplace=True)
-
-    daytypedemand['valid_obs_ratio'] = daytypedemand['valid_hours'] / daytypedemand['total_hours_sum']
-        
-    return daytypedemand.reset_index()
-
-def generateAggProfiles(year, interval='M'):
-    """Generates the aggregate input data required for building the experimental model
-    """
-    # Generate folder structure and file names
-    feather_path= {}
-    csv_path= {}
-    for i in ['pp', 'aggpp_' + interval, 'a' + interval + 'd', 'adtd']: 
-        ipath = os.path.join(pdata_dir, 'aggProfiles', i)
-        feather_path[i] = os.path.join(ipath, 'feather', i + '_' + str(year) + '.feather')
-        csv_path[i] = os.path.join(ipath, 'csv', i + '_' + str(year) + '.csv')
-        os.makedirs(os.path.join(ipath, 'feather'), exist_ok=True)
-        os.makedirs(os.path.join(ipath, 'csv'), exist_ok=True)
-
-    try:        
-        pp = getProfilePower(year)
-        feather.write_dataframe(pp, feather_path['pp'])
-        pp.to_csv(csv_path['pp'], index=False)
-        print(str(year) + ': successfully saved profile power file')
-        
-        aggpp = aggProfilePower(pp, interval)
-        feather.write_dataframe(aggpp, feather_path['aggpp_' + interval])
-        aggpp.to_csv(csv_path['aggpp_' + interval], index=False)
-        print(str(year) + ': successfully saved aggregate ' + interval + ' profile power file')
-        
-        aid = annualIntervalDemand(aggpp)
-        feather.write_dataframe(aid, feather_path['a' + interval + 'd'])
-        aid.to_csv(csv_path['a' + interval + 'd'], index=False)
-        print(str(year) + ': successfully saved aggregate ' + interval + ' demand file')
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _saveArtifactManifest(manifest, year):
+    """Saves the artifact manifest atomically so that an interrupted run can resume."""
+    dir_path = os.path.join(pdata_dir, 'aggProfiles', 'manifest')
+    os.makedirs(dir_path, exist_ok=True)
+    path = os.path.join(dir_path, 'manifest_' + str(year) + '.json')
+    with open(tempPath(path), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tempPath(path), path)
+
+
+def _artifactEntry(path, fingerprint):
+    stat = os.stat(path)
+    return {'fingerprint':fingerprint, 'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns}
+
+
+def _isFresh(entry, path, fingerprint):
+    """Checks that an artifact was saved from the same inputs and has not been 
+    modified or removed since.
+    """
+    if entry is None or entry['fingerprint'] != fingerprint:
+        return False
+    try:
+        return entry == _artifactEntry(path, fingerprint)
+    except FileNotFoundError:
+        return False
+
+
+def _buildArtifact(artifact, values, path):
+    """Computes an artifact from the values of its parents and queues it to be 
+    saved in the background. Returns the artifact and the future of the write.
+    """
+    data = artifact['compute'](*values)
+    if 'save' in artifact:
+        written = artifact['save'](data)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        written = writeAsync(path, lambda tmp_path: feather.write_dataframe(data, tmp_path))
+    
+    return data, written
+
+
+def _loadArtifact(artifacts, name, year):
+    if 'load' in artifacts[name]:
+        return artifacts[name]['load']()
+    return readAggProfiles(year, name)
+
+
+def generateAggProfiles(year, interval='M', batchsize=None, jobs=2, csv=False, force=False, 
+                        dir_name='H', topology=None):
+    """Generates the aggregate input data required for building the experimental model.
+    
+    The outputs form a graph of artifacts: profile power (pp) is computed from 
+    the reduced profiles, the aggregate profile power (aggpp_interval) and the 
+    daytype demand cube (adtd_cube) from pp, the annual interval demand 
+    (a[interval]d) from aggpp, the average daytype demand (adtd) from the 
+    cube and the kW quantile sketches (kw_sketch) from pp. Every artifact is fingerprinted with the content of the reduced profile files, the 
+    parameters and the fingerprints of the artifacts it depends on. The 
+    fingerprints are recorded in aggProfiles/manifest and only artifacts that 
+    are stale or missing are recomputed. Artifacts that do not depend on each 
+    other are computed concurrently.
+    
+    If batchsize is specified and profile power must be recomputed, it is 
+    computed for batches of batchsize recorders with iterProfilePower(). Each 
+    batch is written and aggregated as it arrives, so that the profile power of 
+    the whole year is not held in memory.
+    
+    Parameters:
+        year (int)
+        interval (str): interval of the aggregate profile power. Defaults to 'M'.
+        batchsize (int): number of recorders per batch. Defaults to None.
+        jobs (int): number of artifacts computed concurrently. Defaults to 2.
+        csv (bool): also export the artifacts as csv files with 
+            exportAggProfiles(). Defaults to False.
+        force (bool): recompute all artifacts. Defaults to False.
+        dir_name (str): interval of the reduced profiles. Defaults to 'H'.
+        topology (dict): channel index returned by channelTopology(). Defaults 
+            to None (built from the profiles table).
+    
+    Returns:
+        list of artifacts that were recomputed
+    """
+    artifacts = _aggArtifacts(year, interval, dir_name, topology)
+    manifest = _loadArtifactManifest(year)
+    # Input signatures are recorded, so that unchanged inputs are not hashed again
+    manifest['inputs'] = _artifactInputs(year, dir_name, manifest.get('inputs'))
+    _saveArtifactManifest(manifest, year)
+    fingerprints = _artifactFingerprints(artifacts, year, dir_name, manifest['inputs'])
+    paths = {name:_artifactPath(artifacts, name, year) for name in artifacts.keys()}
+    stale = [name for name in artifacts.keys() if force or not _isFresh(
+            manifest.get(name), paths[name], fingerprints[name])]
+    
+    if batchsize is not None and 'pp' in stale:
+        _generateAggProfileBatches(year, interval, batchsize, paths, dir_name, topology)
+        stale = list(artifacts.keys())
+        for name in stale:
+            manifest[name] = _artifactEntry(paths[name], fingerprints[name])
+            if 'path' not in artifacts[name]:
+                catalogAggProfiles(year, name, artifacts[name]['interval'], fingerprints[name])
+        _saveArtifactManifest(manifest, year)
+    else:
+        _runArtifacts(artifacts, stale, year, paths, fingerprints, manifest, jobs)
         
-        adtd = aggDaytypeDemand(pp)
-        feather.write_dataframe(adtd, feather_path['adtd'])
-        adtd.to_csv(csv_path['adtd'], index=False)
-        print(str(year) + ': successfully saved average daytype demand file')
+    if csv is True:
+        exports = [_exportAggProfiles(year, name) for name in artifacts.keys() 
+                   if 'path' not in artifacts[name]]
+        for written in exports:
+            written.result()
+    
+    return stale
+
+
+def _runArtifacts(artifacts, stale, year, paths, fingerprints, manifest, jobs):
+    """Computes the stale artifacts, as soon as the artifacts they depend on are 
+    available, with up to jobs threads. Fresh artifacts are loaded from file if 
+    a stale artifact depends on them. Artifacts are written in the background 
+    and recorded in the manifest once their file is complete.
+    """
+    children = {name:[c for c in stale if name in artifacts[c]['parents']] for name in artifacts}
+    values = {}
+    for name in artifacts.keys():
+        if name not in stale and len(children[name]) > 0:
+            values[name] = _loadArtifact(artifacts, name, year)
+    
+    todo = list(stale)
+    running = {}
+    writing = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(todo) > 0 or len(running) > 0 or len(writing) > 0:
+            for name in [n for n in todo if all(p in values for p in artifacts[n]['parents'])]:
+                todo.remove(name)
+                parents = [values[p] for p in artifacts[name]['parents']]
+                running[executor.submit(_buildArtifact, artifacts[name], parents, 
+                                        paths[name])] = name
+            done, not_done = wait(list(running) + list(writing), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in writing:
+                    name = writing.pop(future)
+                    future.result()
+                    manifest[name] = _artifactEntry(paths[name], fingerprints[name])
+                    _saveArtifactManifest(manifest, year)
+                    if 'path' not in artifacts[name]:
+                        catalogAggProfiles(year, name, artifacts[name]['interval'], 
+                                           fingerprints[name])
+                    print(str(year) + ': successfully saved ' + artifacts[name]['description'])
+                    continue
+                name = running.pop(future)
+                values[name], written = future.result()
+                writing[written] = name
+                # Release values that no remaining artifact depends on
+                for p in artifacts[name]['parents'] + [name]:
+                    if all(c in values for c in children[p]):
+                        values[p] = None
+
+
+def _generateAggProfileBatches(year, interval, batchsize, paths, dir_name='H', topology=None):
+    """Batch mode of generateAggProfiles()."""
+    for path in paths.values():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    aggpp = []
+    aid = []
+    cubes = []
+    sketches = []
+    writer = None
+    for pp in iterProfilePower(year, dir_name, batchsize, topology):
+        table = pa.Table.from_pandas(pp, preserve_index=False)
+        if writer is None:
+            # Feather files are arrow ipc files and can be written in batches
+            schema = table.schema
+            writer = pa.ipc.new_file(tempPath(paths['pp']), schema)
+        else:
+            table = table.cast(schema)
+        writer.write_table(table)
         
-    except Exception as e:
-        print(e)
-        raise
+        aggbatch = aggProfilePower(pp, interval)
+        aggpp.append(aggbatch)
+        aid.append(annualIntervalDemand(aggbatch))
+        cubes.append(daytypeCube(pp))
+        sketches.append(kwSketch(pp))
+        del pp, table
+    if writer is None:
+        raise InputError(year, 'No profile power data for this year.')
+    writer.close()
+    os.replace(tempPath(paths['pp']), paths['pp'])
+    print(str(year) + ': successfully saved profile power file')
+    
+    # Outputs are written in the background while the next ones are computed
+    writes = []
+    aggpp = pd.concat(aggpp, ignore_index=True)
+    writes.append((_writeFeather(aggpp, paths['aggpp_' + interval]), 
+                   'aggregate ' + interval + ' profile power file'))
+    aid = mergeDemand(pd.concat(aid, ignore_index=True), ['RecorderID','ProfileID_i'])
+    writes.append((_writeFeather(aid, paths['a' + interval + 'd']), 
+                   'aggregate ' + interval + ' demand file'))
+    cube = mergeDaytypeCubes(cubes)
+    writes.append((saveDaytypeCube(cube, year), 'daytype demand cube'))
+    writes.append((_writeFeather(cubeDaytypeDemand(cube), paths['adtd']), 
+                   'average daytype demand file'))
+    writes.append((_writeFeather(mergeSketches(sketches), paths['kw_sketch']), 
+                   'kW quantile sketch file'))
+    for written, description in writes:
+        written.result()
+        print(str(year) + ': successfully saved ' + description)
+
+
+def _writeFeather(data, path):
+    """Writes a dataframe to a feather file in the background."""
+    return writeAsync(path, lambda tmp_path: feather.write_dataframe(data, tmp_path))
+
+
+# Channel index shared by the worker processes of generateAggProfilesMulti()
+_worker_topology = None
+
+
+def _initAggWorker(topology):
+    global _worker_topology
+    _worker_topology = topology
+
+
+def _generateAggYear(year, kwargs):
+    """Runs generateAggProfiles() for a year in a worker process and times it."""
+    start = time.perf_counter()
+    stale = generateAggProfiles(year, topology=_worker_topology, **kwargs)
+    
+    return time.perf_counter() - start, stale
+
+
+def generateAggProfilesMulti(year_start, year_end, interval='M', jobs=1, **kwargs):
+    """Runs generateAggProfiles() for a range of years. The channel index of the 
+    profiles table (see channelTopology()) is built once and shared by all years. 
+    If jobs > 1, the years are processed in a pool of jobs processes that each 
+    receive the channel index when they start.
+    
+    Parameters:
+        year_start (int)
+        year_end (int)
+        interval (str): interval of the aggregate profile power. Defaults to 'M'.
+        jobs (int): number of worker processes. Defaults to 1.
+        kwargs: batchsize, csv, force and dir_name of generateAggProfiles()
+    
+    Returns:
+        pandas dataframe with columns ['year', 'seconds', 'artifacts', 'error'] 
+        reporting the wall time, recomputed artifacts and error of every year. 
+        Failures are also logged to agg_profiles_failures.
+    """
+    validYears(year_start, year_end)
+    topology = channelTopology()
+    kwargs = dict(kwargs, interval=interval)
+    years = list(range(year_start, year_end + 1))
+    report = {}
+    
+    if jobs == 1:
+        _initAggWorker(topology)
+        for year in years:
+            try:
+                seconds, stale = _generateAggYear(year, kwargs)
+                report[year] = [seconds, ','.join(stale), None]
+            except Exception as e:
+                report[year] = [None, None, repr(e)]
+            print('{}: {}'.format(year, report[year][2] or '{:.2f}s'.format(report[year][0])))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_initAggWorker, 
+                                 initargs=(topology,)) as executor:
+            futures = {executor.submit(_generateAggYear, year, kwargs):year for year in years}
+            for future in as_completed(futures):
+                year = futures[future]
+                try:
+                    seconds, stale = future.result()
+                    report[year] = [seconds, ','.join(stale), None]
+                except Exception as e:
+                    report[year] = [None, None, repr(e)]
+                print('{}: {}'.format(year, report[year][2] or '{:.2f}s'.format(report[year][0])))
+    
+    report = pd.DataFrame([[y] + report[y] for y in years], 
+                          columns=['year', 'seconds', 'artifacts', 'error'])
+    failures = report[report.error.notnull()]
+    if len(failures) > 0:
+        for f in failures.itertuples():
+            print('FAILED {}: {}'.format(f.year, f.error))
+        writeLog(failures[['year', 'error']].copy(), 'agg_profiles_failures')
+    
+    return report
+
+
+def _writeAggCsv(feather_path, csv_path):
+    """Converts a feather file to csv one record batch at a time."""
+    reader = pa.ipc.open_file(pa.memory_map(feather_path))
+    if reader.num_record_batches == 0:
+        reader.schema.empty_table().to_pandas().to_csv(csv_path, index=False)
+    for i in range(reader.num_record_batches):
+        reader.get_batch(i).to_pandas().to_csv(csv_path, mode='w' if i==0 else 'a', 
+                                               header=(i==0), index=False)
+
+
+def _exportAggProfiles(year, aggfunc):
+    """Queues the csv export of exportAggProfiles() and returns its future."""
+    validYears(year)
+    feather_path = _aggProfilesPath(aggfunc, year)
+    csv_path = _aggProfilesPath(aggfunc, year, 'csv')
+    if not os.path.isfile(feather_path):
+        raise InputError(aggfunc, 'No aggregate profile file for ' + str(year) + '.')
+    if os.path.isfile(csv_path) and os.stat(csv_path).st_mtime_ns >= os.stat(
+            feather_path).st_mtime_ns:
+        written = Future()
+        written.set_result(csv_path)
+        return written
+    os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+    
+    return writeAsync(csv_path, lambda tmp_path: _writeAggCsv(feather_path, tmp_path))
+
+
+def exportAggProfiles(year, aggfunc='adtd'):
+    """Exports an aggregate profile file to aggProfiles/aggfunc/csv. The csv file 
+    is only written if it does not exist or is older than the feather file. 
+    Record batches are converted one at a time, so that large files are not 
+    loaded into memory.
+    
+    Returns:
+        path of the csv file
+    """
+    return _exportAggProfiles(year, aggfunc).result()
+
+
+def _catalogPath(year):
+    return os.path.join(pdata_dir, 'aggProfiles', 'catalog', 'catalog_' + str(year) + '.json')
+
+
+def _loadCatalog(year):
+    """Loads the catalog of aggregate profile files of a year. The parsed catalog 
+    is kept in memory until the catalog file changes.
+    """
+    path = _catalogPath(year)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    # Catalogs are replaced on write, so a new inode indicates a change
+    signature = (stat.st_ino, stat.st_mtime_ns)
+    cached = _catalogs.get(year)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    try:
+        with open(path) as f:
+            catalog = json.load(f)
+    except ValueError:
+        catalog = {}
+    _catalogs[year] = (signature, catalog)
+    
+    return catalog
+
+
+def catalogAggProfiles(year, aggfunc, interval=None, fingerprint=None, data=None):
+    """Records an aggregate profile file in the catalog of its year with its 
+    interval, row count, schema, fingerprint, size and modification time. 
+    
+    Parameters:
+        year (int)
+        aggfunc (str): eg pp, aggpp_M, aMd, adtd, adtd_season
+        interval (str): interval of the rows. Defaults to None.
+        fingerprint (str): fingerprint of the inputs of the file. Defaults to None.
+        data (dataframe): contents of the file. Defaults to None (the row count 
+            and schema are read from the file footer).
+    """
+    path = _aggProfilesPath(aggfunc, year)
+    if data is None:
+        reader = pa.ipc.open_file(pa.memory_map(path))
+        schema = reader.schema
+        rows = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+    else:
+        schema = pa.Schema.from_pandas(data, preserve_index=False)
+        rows = len(data)
+    stat = os.stat(path)
+    catalog = dict(_loadCatalog(year))
+    catalog[aggfunc] = {'year':year, 'aggfunc':aggfunc, 'interval':interval, 'rows':rows,
+                        'schema':[[f.name, str(f.type)] for f in schema 
+                                  if f.name != '__index_level_0__'],
+                        'fingerprint':fingerprint, 'path':os.path.relpath(path, pdata_dir),
+                        'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns}
+    
+    dir_path = os.path.dirname(_catalogPath(year))
+    os.makedirs(dir_path, exist_ok=True)
+    with open(tempPath(_catalogPath(year)), 'w') as f:
+        json.dump(catalog, f, indent=1, sort_keys=True)
+    os.replace(tempPath(_catalogPath(year)), _catalogPath(year))
+    stat = os.stat(_catalogPath(year))
+    _catalogs[year] = ((stat.st_ino, stat.st_mtime_ns), catalog)
+
+
+def aggProfilesCatalog(years=None):
+    """Lists the aggregate profile files recorded in the catalog.
+    
+    Parameters:
+        years (list): years to list. Defaults to None (all catalogued years).
+    
+    Returns:
+        pandas dataframe with columns ['year', 'aggfunc', 'interval', 'rows', 
+        'schema', 'fingerprint', 'path', 'size', 'mtime_ns']
+    """
+    if years is None:
+        catalogs = glob(os.path.join(os.path.dirname(_catalogPath(0)), 'catalog_*.json'))
+        years = sorted(int(os.path.basename(c)[8:-5]) for c in catalogs)
+    entries = [e for y in years for e in _loadCatalog(y).values()]
+    
+    return pd.DataFrame(entries, columns=['year', 'aggfunc', 'interval', 'rows', 'schema', 
+                                          'fingerprint', 'path', 'size', 'mtime_ns'])
+
+
+def _findAggProfiles(year, aggfunc):
+    """Finds an aggregate profile file that is not in the catalog."""
+    path = _aggProfilesPath(aggfunc, year)
+    if os.path.isfile(path):
+        return path
+    paths = glob(os.path.join(os.path.dirname(path), '*_' + str(year) + '.*'))
+    if len(paths) == 0:
+        raise InputError(aggfunc, 'No aggregate profile file for ' + str(year) + 
+                         '. Run generateAggProfiles() first.')
+    
+    return paths[0]
+
+
+def _cacheAggProfiles(key, signature, data):
+    """Adds a frame to the cache of readAggProfiles() and evicts the least 
+    recently used frames until the cache is within agg_cache_bytes.
+    """
+    nbytes = int(data.memory_usage(index=True).sum())
+    with _agg_cache_lock:
+        _agg_cache.pop(key, None)
+        if nbytes > agg_cache_bytes:
+            return
+        _agg_cache[key] = {'signature':signature, 'data':data, 'nbytes':nbytes}
+        while sum(c['nbytes'] for c in _agg_cache.values()) > agg_cache_bytes:
+            _agg_cache.popitem(last=False)
+
+
+def clearAggCache():
+    """Empties the cache of readAggProfiles()."""
+    with _agg_cache_lock:
+        _agg_cache.clear()
+
 
 def readAggProfiles(year, aggfunc = 'adtd'):
     """
-    This function fetches aggregate load profile data from disk. aggfunc can be one of pp, aggpp_M, aMd, adtd
+    This function fetches aggregate load profile data from disk. aggfunc can be one of pp, aggpp_M, aMd, adtd, adtd_season
+    
+    Files are looked up in the catalog of the year. Loaded frames are kept in an 
+    in-process LRU cache of up to agg_cache_bytes and reloaded if the size or 
+    modification time of their file changes. Every call returns a copy, so 
+    that returned frames can be modified without changing the cache.
+    
+    Raises InputError if the file does not exist.
     """
     validYears(year) 
-    try:       
-        path = Path(os.path.join(pdata_dir, 'aggProfiles', aggfunc, 'feather'))
-        for child in path.iterdir():
-            n = child.name
-            nu = n.split('.')[0].split('_')[-1]
-            if int(nu)==year:
-                df = feather.read_dataframe(str(child))
-                return df
-            else:
-                pass        
+    entry = _loadCatalog(year).get(aggfunc)
+    try:
+        path = _findAggProfiles(year, aggfunc) if entry is None else os.path.join(
+                pdata_dir, entry['path'])
+        stat = os.stat(path)
     except FileNotFoundError:
-        print('The input files did not exist or were incomplete.')        
+        entry = None
+        path = _findAggProfiles(year, aggfunc)
+        stat = os.stat(path)
+    
+    key = (aggfunc, year)
+    signature = (path, stat.st_size, stat.st_mtime_ns)
+    with _agg_cache_lock:
+        cached = _agg_cache.get(key)
+        if cached is not None and cached['signature'] == signature:
+            _agg_cache.move_to_end(key)
+            return cached['data'].copy()
+    
+    data = feather.read_dataframe(path)
+    if path == _aggProfilesPath(aggfunc, year) and (entry is None or (
+            entry['size'], entry['mtime_ns']) != signature[1:]):
+        # The file is not catalogued or was modified since
+        catalogAggProfiles(year, aggfunc, None if entry is None else entry['interval'], 
+                           data=data)
+    _cacheAggProfiles(key, signature, data)
+    
+    return data.copy()
+
 
 def season(month):
     if month in [5,6,7,8]:
@@ -249,29 +1187,33 @@ def season(month):
         season = 'low'
     return season
 
-def generateSeasonADTD(year):
-
+def generateSeasonADTD(year, csv=False):
+    """Reduces the daytype demand cube of a year to average daytype demand per 
+    season. If csv is True, the output is also exported as csv file.
+    """
     #generate folder structure and file names    
-    path = os.path.join(pdata_dir, 'aggProfiles', 'adtd_season')
-    feather_path = os.path.join(path, 'feather', 'adtd_season' + '_' + str(year) + '.feather')
-    csv_path = os.path.join(path, 'csv', 'adtd_season' + '_' + str(year) + '.csv')
-    os.makedirs(os.path.join(path, 'feather'), exist_ok=True)
-    os.makedirs(os.path.join(path, 'csv'), exist_ok=True)
-    
-    #read data
-    df = readAggProfiles(year, 'adtd')
-    df['season'] = df['month'].map(lambda x: season(x)).astype('category')
-    
-    seasons = df.groupby(['ProfileID_i', 'season', 'daytype', 'hour']).agg({
-                'kw_mean': 'mean', 
-                'kw_std': 'mean',
-                'valid_hours':'sum',
-                'valid_obs_ratio':'mean',
-                'total_hours_sum':'sum'}).reset_index()  
-    
-    #write data to file
-    feather.write_dataframe(seasons, feather_path)
-    seasons.to_csv(csv_path, index=False)
+    feather_path = _aggProfilesPath('adtd_season', year)
+    os.makedirs(os.path.dirname(feather_path), exist_ok=True)
+    
+    #reduce the daytype cube to seasons
+    calendar = calendarMeta('M', year)
+    seasons = cubeDaytypeDemand(readDaytypeCube(year), 
+                                dict(zip(calendar.month, calendar.season)), 'season')
+    seasons = seasons[['ProfileID_i', 'season', 'daytype', 'hour', 'kw_mean', 'kw_std', 
+                       'valid_hours', 'valid_obs_ratio', 'total_hours_sum']]
+    
+    #write data to file in the background, csv export from memory in parallel
+    writes = [_writeFeather(seasons, feather_path)]
+    if csv is True:
+        csv_path = _aggProfilesPath('adtd_season', year, 'csv')
+        os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+        writes.append(writeAsync(csv_path, lambda tmp_path: seasons.to_csv(tmp_path, index=False)))
+    for written in writes:
+        written.result()
+    cube = _loadArtifactManifest(year).get('adtd_cube')
+    fingerprint = None if cube is None else hashlib.md5(json.dumps(
+            [_artifact_version, 'adtd_season', cube['fingerprint']]).encode()).hexdigest()
+    catalogAggProfiles(year, 'adtd_season', 'H', fingerprint, seasons)
     print(str(year) + ': successfully saved seasonal average daytype demand file')    
     
-    return 
\ No newline at end of file
+    return
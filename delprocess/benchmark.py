@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module benchmarks the processing pipeline on synthetic DEL data generated
+with delprocess.synthetic.
+
+Every stage is run for every year in a separate python process with the HOME
+environment variable set to a synthetic user directory, so that delprocess
+reads and writes synthetic data only and peak memory is measured per stage.
+"""
+
+import pandas as pd
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import json
+import time
+import resource
+from collections import OrderedDict
+
+from .synthetic import generateSyntheticData, syntheticHome
+from .support import InputError
+
+
+def _rawRows(year, units):
+    """Returns the number of synthetic raw rows of a year for a list of units."""
+    from .support import obs_dir
+    counts = pd.read_csv(os.path.join(obs_dir, 'synthetic.csv'))
+
+    return int(counts.loc[(counts.year==year) & (counts.unit.isin(units)), 'rows'].sum())
+
+
+def _benchReduce(year):
+    from .loadprofiles import saveReducedProfiles
+    saveReducedProfiles(year, 'H', 'feather')
+    return _rawRows(year, ['A', 'V', 'Hz', 'kVA', 'kW'])
+
+
+def _benchPower(year):
+    from .loadprofiles import getProfilePower
+    return len(getProfilePower(year))
+
+
+def _benchAggProfiles(year):
+    from .aggprofiles import generateAggProfiles, readAggProfiles
+    generateAggProfiles(year)
+    return len(readAggProfiles(year, 'pp'))
+
+
+def _benchX(year):
+    from .loadprofiles import genX
+    return len(genX([year, year]))
+
+
+def _benchS(year):
+    from .surveys import genS
+    return len(genS(['binned_base'], year, year))
+
+
+# Directories that a benchmark writes in its data directory
+_benchmark_dirs = ['observations', 'resampled_profiles', 'survey_features', 'home']
+
+# Pipeline stages in the order in which they depend on each other. Each stage
+# function processes one year and returns the number of rows processed: raw
+# readings for reduceRawProfiles and output rows for all other stages.
+stages = OrderedDict([('reduceRawProfiles', _benchReduce),
+                      ('getProfilePower', _benchPower),
+                      ('generateAggProfiles', _benchAggProfiles),
+                      ('genX', _benchX),
+                      ('genS', _benchS)])
+
+
+def _peakRss():
+    """Returns the peak resident memory of the current process in bytes. On 
+    linux ru_maxrss is inherited across exec from the parent process, so the 
+    high water mark in /proc/self/status is used instead.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except FileNotFoundError:
+        pass
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale
+
+
+def runStage(stage, year):
+    """Runs a benchmark stage for a year in the current process and prints its
+    wall time, peak resident memory and rows as a json line prefixed with
+    'BENCHMARK '. Modules are imported in the stage functions, so that the data
+    directory is read from the synthetic user directory.
+    """
+    start = time.perf_counter()
+    rows = stages[stage](year)
+    seconds = time.perf_counter() - start
+    print('BENCHMARK ' + json.dumps({'seconds':seconds, 'peak_rss_mb':_peakRss()/2**20,
+                                     'rows':rows}))
+
+
+def _runStageProcess(stage, year, home_dir, verbose=False):
+    """Runs runStage() in a python subprocess with home_dir as user directory."""
+    env = dict(os.environ)
+    env['HOME'] = home_dir
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([package_dir] + [
+            p for p in [env.get('PYTHONPATH')] if p])
+    code = 'import sys; from delprocess.benchmark import runStage; runStage(sys.argv[1], int(sys.argv[2]))'
+    proc = subprocess.run([sys.executable, '-c', code, stage, str(year)], env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    if verbose is True:
+        print(proc.stdout, proc.stderr)
+    for line in proc.stdout.splitlines():
+        if line.startswith('BENCHMARK '):
+            result = json.loads(line[len('BENCHMARK '):])
+            result['error'] = None
+            return result
+    error = proc.stderr.strip().splitlines()
+
+    return {'seconds':None, 'peak_rss_mb':None, 'rows':None,
+            'error':error[-1] if len(error)>0 else 'exit code ' + str(proc.returncode)}
+
+
+def benchmark(data_dir=None, years=[2008, 2012], groups=2, households=12,
+              months=[1], days=7, run_stages=None, keep=False, verbose=False):
+    """Generates synthetic data and benchmarks the pipeline stages on it.
+
+    Parameters:
+        data_dir (str): directory for the synthetic data. Defaults to None (a
+            temporary directory). An existing directory may only contain the
+            directories of a previous benchmark. Unless keep is True, only the
+            directories that the benchmark writes are removed from it.
+        years (list): survey years. Years up to 2009 use the pre-2009 recorder
+            topology.
+        groups, households, months, days: scale of the synthetic data, see
+            synthetic.generateSyntheticData()
+        run_stages (list): names of stages to run. Defaults to None (all stages).
+        keep (bool): keep the synthetic data and outputs. Defaults to False.
+        verbose (bool): print the output of the stages. Defaults to False.
+
+    Returns:
+        pandas dataframe with columns ['stage', 'year', 'seconds', 'peak_rss_mb',
+        'rows', 'rows_per_sec', 'error']
+    """
+    # Only directories that the benchmark created are removed as a whole
+    created = data_dir is None or not os.path.exists(data_dir)
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix='delprocess_benchmark_')
+    elif created is False:
+        other = [f for f in os.listdir(data_dir) if f not in _benchmark_dirs]
+        if len(other) > 0:
+            raise InputError(data_dir, 'Directory contains files that were not written by ' 
+                             'a benchmark: ' + ', '.join(sorted(other)))
+        if os.path.isdir(os.path.join(data_dir, 'observations')) and not os.path.isfile(
+                os.path.join(data_dir, 'observations', 'synthetic.csv')):
+            raise InputError(data_dir, 'Directory contains observations that are not synthetic.')
+    if run_stages is None:
+        run_stages = list(stages.keys())
+    for s in run_stages:
+        if s not in stages:
+            raise InputError(s, 'Invalid stage. Select from ' + ', '.join(stages.keys()))
+
+    # Remove data and outputs of previous benchmarks
+    for d in _benchmark_dirs:
+        shutil.rmtree(os.path.join(data_dir, d), ignore_errors=True)
+    counts = generateSyntheticData(data_dir, years, groups, households, months, days)
+    home_dir = syntheticHome(data_dir)
+    print('Generated {} synthetic raw readings in {}'.format(counts.rows.sum(), data_dir))
+
+    results = []
+    try:
+        for stage in run_stages:
+            for year in years:
+                result = _runStageProcess(stage, year, home_dir, verbose)
+                results.append([stage, year, result['seconds'], result['peak_rss_mb'],
+                                result['rows'], result['error']])
+                print('{} {}: {}'.format(stage, year, result['error'] or
+                      '{:.2f}s, {:.0f}MB'.format(result['seconds'], result['peak_rss_mb'])))
+    finally:
+        if keep is False and created is True:
+            shutil.rmtree(data_dir, ignore_errors=True)
+        elif keep is False:
+            for d in _benchmark_dirs:
+                shutil.rmtree(os.path.join(data_dir, d), ignore_errors=True)
+
+    results = pd.DataFrame(results, columns=['stage', 'year', 'seconds', 'peak_rss_mb',
+                                             'rows', 'error'])
+    for c in ['seconds', 'peak_rss_mb', 'rows']:
+        results[c] = pd.to_numeric(results[c])
+    results.insert(5, 'rows_per_sec', results.rows / results.seconds)
+
+    return results
@@ -11,8 +11,10 @@ Updated: 4 May 2019
 import optparse
 
 from .surveys import genS
-from .loadprofiles import saveReducedProfiles
-from .support import validYears
+from .loadprofiles import saveReducedProfiles, cacheRawProfiles
+from .benchmark import benchmark
+from .aggprofiles import generateAggProfilesMulti
+from .support import validYears, writeLog
 
 def list_callback(option, opt, value, parser):
   setattr(parser.values, option.dest, value.split(','))
@@ -22,11 +24,16 @@ def process_profiles():
     Resample 5 minute metered electricity readings.
     """
     parser = optparse.OptionParser()
-    parser.add_option('-i', '--intervalresample', dest='interval', default='30T', type=str, help='Reduce load profiles to interval')
+    parser.add_option('-i', '--intervalresample', dest='interval', default='30T', type=str, action='callback', callback=list_callback, 
+                      help='Reduce load profiles to interval(s), eg 30T or 30T,H,D')
     parser.add_option('-s', '--startyear', dest='startyear', type=int, help='Data start year')
     parser.add_option('-e', '--endyear', dest='endyear', type=int, help='Data end year')
     parser.add_option('-c', '--csv', action='store_true', dest='csv', help='Format and save output as csv files')
-    parser.set_defaults(csv=False)
+    parser.add_option('-p', '--parquet', action='store_true', dest='parquet', help='Format and save output as parquet dataset partitioned by year and month')
+    parser.add_option('-j', '--jobs', dest='jobs', default=1, type=int, help='Number of worker processes')
+    parser.add_option('--compact', action='store_true', dest='compact', help='Save output with float32 readings, int32 ProfileIDs, categorical RecorderIDs and int8 Valid flags')
+    parser.add_option('--cache', action='store_true', dest='cache', help='Convert raw files to a memory-mapped binary cache before reducing them')
+    parser.set_defaults(csv=False, parquet=False, compact=False, cache=False)
 
     (options, args) = parser.parse_args()
 		
@@ -36,17 +43,57 @@ def process_profiles():
         options.endyear = int(input('Enter observation end year: '))
     if options.csv == True:
         filetype = 'csv'
+    elif options.parquet == True:
+        filetype = 'parquet'
     else:
         filetype = 'feather'
 
     validYears(options.startyear, options.endyear)   #check that year input is valid 
+    if isinstance(options.interval, list) and len(options.interval) == 1:
+        options.interval = options.interval[0]
     
-    for year in range (options.startyear, options.endyear + 1):
-        saveReducedProfiles(year, options.interval, filetype)
+    if options.cache == True:
+        for year in range(options.startyear, options.endyear + 1):
+            cacheRawProfiles(year)
+    
+    saveReducedProfiles(range(options.startyear, options.endyear + 1), 
+                        options.interval, filetype, jobs=options.jobs, 
+                        compact=options.compact)
 	
     return print('>>>Load profile data processing end.<<<')
 
 
+def process_aggprofiles():
+    """
+    Generate aggregate load profiles for a range of years.
+    """
+    parser = optparse.OptionParser()
+    parser.add_option('-s', '--startyear', dest='startyear', type=int, help='Data start year')
+    parser.add_option('-e', '--endyear', dest='endyear', type=int, help='Data end year')
+    parser.add_option('-i', '--interval', dest='interval', default='M', type=str, help='Interval of the aggregate profile power, eg M or D')
+    parser.add_option('-j', '--jobs', dest='jobs', default=1, type=int, help='Number of worker processes, each processing one year')
+    parser.add_option('-b', '--batchsize', dest='batchsize', type=int, help='Compute profile power for batches of batchsize recorders')
+    parser.add_option('-c', '--csv', action='store_true', dest='csv', help='Also export aggregate profiles as csv files')
+    parser.add_option('-f', '--force', action='store_true', dest='force', help='Recompute all aggregate profiles, including those that are up to date')
+    parser.set_defaults(csv=False, force=False)
+
+    (options, args) = parser.parse_args()
+		
+    if options.startyear is None:
+        options.startyear = int(input('Enter observation start year: '))
+    if options.endyear is None:
+        options.endyear = int(input('Enter observation end year: '))
+
+    validYears(options.startyear, options.endyear)   #check that year input is valid 
+    
+    report = generateAggProfilesMulti(options.startyear, options.endyear, options.interval, 
+                                      options.jobs, batchsize=options.batchsize, 
+                                      csv=options.csv, force=options.force)
+    print(report.to_string(index=False))
+    
+    return print('>>>Aggregate profile processing end.<<<')
+
+
 def process_surveys():
     """
     Extract features from household surveys as specified in specfile.
@@ -73,3 +120,34 @@ def process_surveys():
     return print('>>>Survey data extraction end.<<<')
 	
 
+
+def process_benchmark():
+    """
+    Benchmark the processing pipeline on synthetic data.
+    """
+    parser = optparse.OptionParser()
+    parser.add_option('-y', '--years', dest='years', default=['2008','2012'], type=str, action='callback', callback=list_callback, 
+                      help='Synthetic survey years, eg 2008,2012. Years up to 2009 use the pre-2009 recorder topology')
+    parser.add_option('-g', '--groups', dest='groups', default=2, type=int, help='Number of groups per year')
+    parser.add_option('-n', '--households', dest='households', default=12, type=int, help='Number of households per group')
+    parser.add_option('-m', '--months', dest='months', default=['1'], type=str, action='callback', callback=list_callback, 
+                      help='Months with readings, eg 1,6')
+    parser.add_option('-d', '--days', dest='days', default=7, type=int, help='Number of days with readings per month')
+    parser.add_option('--stages', dest='stages', type=str, action='callback', callback=list_callback, 
+                      help='Stages to benchmark, eg reduceRawProfiles,getProfilePower. Defaults to all stages')
+    parser.add_option('--datadir', dest='datadir', type=str, help='Directory for the synthetic data. Defaults to a temporary directory')
+    parser.add_option('-k', '--keep', action='store_true', dest='keep', help='Keep the synthetic data and outputs')
+    parser.set_defaults(keep=False)
+    
+    (options, args) = parser.parse_args()
+    
+    years = [int(y) for y in options.years]
+    validYears(*years)   #check that year input is valid 
+    
+    results = benchmark(options.datadir, years, options.groups, options.households, 
+                        [int(m) for m in options.months], options.days, options.stages, 
+                        options.keep)
+    print(results.to_string(index=False))
+    writeLog(results.copy(), 'benchmark')
+    
+    return print('>>>Benchmark end.<<<')
@@ -12,16 +12,735 @@ Updated: 4 May 2019
 import pandas as pd
 import numpy as np
 import feather
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.csv as pv
 from glob import glob
 import os
 import gc
+import shutil
+import json
+import hashlib
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import chain
+from pandas.tseries.frequencies import to_offset
 
 from .surveys import loadID, loadTable
-from .support import rawprofiles_dir, pdata_dir, InputError, validYears#, writeLog
+from .support import profiles_dir, rawprofiles_dir, pdata_dir, InputError, validYears, writeLog, writeAsync, tempPath
 
 
-def loadRawProfiles(year, month, unit):
-    """Loads raw load profiles for a year, month and unit.
+def intervalCodes(datefield, interval):
+    """Maps timestamps to the integer codes of the interval buckets that they 
+    fall in, without building a resampled grid.
+    
+    Fixed frequencies (eg '5T', '30T', 'H', 'D') are computed by integer division 
+    of the epoch nanoseconds. These buckets are aligned to the epoch, which 
+    matches resample() for intervals that divide a day. Weekly ('W'), monthly ('M') and annual ('A') 
+    buckets are computed with calendar arithmetic and all other offset aliases 
+    from pandas period ordinals.
+    
+    Parameters:
+        datefield (pandas series or array): datetime64[ns] values
+        interval (str): pandas offset alias
+    
+    Returns:
+        numpy int64 array of bucket codes. Codes increase with time.
+    """
+    ns = np.asarray(datefield, dtype='datetime64[ns]').view(np.int64)
+    offset = to_offset(interval)
+    
+    if isinstance(offset, (pd.offsets.Tick, pd.offsets.Day)):
+        return ns // _intervalNanos(offset)
+    days = ns // 86400000000000
+    if interval in ['W', 'W-SUN']:
+        # Weeks end on Sunday, 1970-01-01 was a Thursday
+        return (days + 3) // 7
+    if interval == 'M':
+        return days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    if interval in ['A', 'A-DEC', 'Y', 'Y-DEC']:
+        return days.astype('datetime64[D]').astype('datetime64[Y]').astype(np.int64)
+    periods = pd.Series(ns.view('datetime64[ns]')).dt.to_period(interval)
+    return np.asarray(periods.array.asi8, dtype=np.int64)
+
+
+def intervalLabels(codes, interval, datefield=None):
+    """Converts interval bucket codes to the timestamps that pandas resample() 
+    uses as labels: the start of fixed frequency buckets and the end date of 
+    calendar buckets (eg month end for 'M').
+    
+    Parameters:
+        codes (array): bucket codes returned by intervalCodes()
+        interval (str): pandas offset alias
+        datefield (array): one timestamp from each bucket. If it is None and 
+            _arithmeticInterval(interval) is False, the labels are derived from 
+            the period ordinals that intervalCodes() returns for such intervals.
+    
+    Returns:
+        numpy datetime64[ns] array
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    offset = to_offset(interval)
+    
+    if isinstance(offset, (pd.offsets.Tick, pd.offsets.Day)):
+        return (codes * _intervalNanos(offset)).view('datetime64[ns]')
+    if interval in ['W', 'W-SUN']:
+        return (codes * 7 + 3).astype('datetime64[D]').astype('datetime64[ns]')
+    if interval == 'M':
+        return ((codes + 1).astype('datetime64[M]').astype('datetime64[D]') - 
+                np.timedelta64(1, 'D')).astype('datetime64[ns]')
+    if interval in ['A', 'A-DEC', 'Y', 'Y-DEC']:
+        return ((codes + 1).astype('datetime64[Y]').astype('datetime64[D]') - 
+                np.timedelta64(1, 'D')).astype('datetime64[ns]')
+    if datefield is None:
+        periods = pd.Series(pd.PeriodIndex(ordinal=codes, freq=interval))
+    else:
+        periods = pd.Series(np.asarray(datefield, dtype='datetime64[ns]')).dt.to_period(interval)
+    return periods.dt.to_timestamp(how='end').dt.normalize().values
+
+
+def _arithmeticInterval(interval):
+    """Checks if interval bucket codes and labels can be computed with integer 
+    arithmetic rather than pandas periods.
+    """
+    return isinstance(to_offset(interval), (pd.offsets.Tick, pd.offsets.Day)) or (
+            interval in ['W', 'W-SUN', 'M', 'A', 'A-DEC', 'Y', 'Y-DEC'])
+
+
+def _intervalNanos(offset):
+    """Returns the length of a fixed frequency offset in nanoseconds."""
+    if isinstance(offset, pd.offsets.Tick):
+        return offset.nanos
+    return offset.n * 86400000000000
+
+
+def _aggName(how):
+    """Returns the name of an aggregation function passed as string or numpy function."""
+    return {np.mean:'mean', np.sum:'sum', np.min:'min', np.max:'max', 
+            np.nanmean:'mean', np.nansum:'sum'}.get(how, how)
+
+
+def _segmentReduce(values, group, ngroups, how, order=None, starts=None):
+    """Reduces values by group with bincount or sorted segment reductions. NaN 
+    values are skipped like in pandas. 
+    
+    how must be one of 'mean', 'sum', 'count', 'min' or 'max'. order and starts 
+    sort the values by group and are only required for 'min' and 'max'.
+    """
+    if how == 'count':
+        return np.bincount(group, weights=pd.notnull(values), 
+                           minlength=ngroups).astype(np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    notnull = ~np.isnan(values)
+    if how in ['sum', 'mean']:
+        total = np.bincount(group, weights=np.where(notnull, values, 0), 
+                            minlength=ngroups)
+        if how == 'sum':
+            return total
+        count = np.bincount(group, weights=notnull, minlength=ngroups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / count
+    if how in ['min', 'max']:
+        ufunc = np.fmin if how == 'min' else np.fmax
+        return ufunc.reduceat(values[order], starts)
+    raise InputError(how, 'Invalid aggregation function')
+
+
+def resampleReadings(data, interval, by=['RecorderID', 'ProfileID'], 
+                     on='Datefield', agg={'Unitsread':'mean', 'Valid':'mean'}, fill=False):
+    """Vectorised replacement for data.groupby(by).resample(interval, on=on).agg(agg).
+    
+    Timestamps are converted to integer bucket codes with intervalCodes() and 
+    each column is reduced with bincount or sorted segment reductions. Unlike 
+    groupby().resample(), only buckets that contain readings are returned, 
+    unless fill is True, and the group columns are not aggregated.
+    
+    Parameters:
+        data (dataframe): must contain the columns in by, on and agg
+        interval (str): pandas offset alias, eg '30T', 'H', 'D', 'M'
+        by (list): group columns
+        on (str): datetime column
+        agg (dict): column:aggfunc pairs. aggfunc is one of 'mean', 'sum', 
+            'count', 'min', 'max' (or numpy equivalents), or a list of these. 
+            Lists produce columns named column_aggfunc.
+        fill (bool): also return the empty buckets between the first and last 
+            bucket of each group, as groupby().resample() does. Their sums and 
+            counts are 0 and all other aggregates NaN. Defaults to False.
+        
+    Returns:
+        pandas dataframe with columns by + [on] + aggregated columns, sorted by 
+        by and on.
+    """
+    codes = []
+    uniques = []
+    for col in by:
+        c, u = pd.factorize(data[col], sort=True)
+        codes.append(c.astype(np.int64))
+        uniques.append(u)
+    bucket = intervalCodes(data[on], interval)
+    
+    # Rows with missing group keys are dropped, as in groupby()
+    keep = np.ones(len(data[on]), dtype=bool)
+    for c in codes:
+        keep &= c >= 0
+    if keep.all():
+        keep = slice(None)
+    else:
+        codes = [c[keep] for c in codes]
+        bucket = bucket[keep]
+    
+    # Combine group keys and bucket codes into a single sortable integer key
+    bmin = bucket.min() if len(bucket) > 0 else 0
+    key = bucket - bmin
+    span = int(key.max()) + 1 if len(key) > 0 else 1
+    radix = span
+    for c, u in zip(reversed(codes), reversed(uniques)):
+        key = key + c * radix
+        radix *= len(u)
+    group, ukey = pd.factorize(key, sort=True)
+    ngroups = len(ukey)
+    
+    how_cols = []
+    for col, how in agg.items():
+        if isinstance(how, (list, tuple)):
+            how_cols.extend([(col, _aggName(h), col + '_' + _aggName(h)) for h in how])
+        else:
+            how_cols.append((col, _aggName(how), col))
+    order = starts = None
+    if not _arithmeticInterval(interval) or any(
+            how in ['min', 'max'] for col, how, name in how_cols):
+        order = np.argsort(group, kind='mergesort')
+        starts = np.searchsorted(group[order], np.arange(ngroups))
+    
+    # Decode the combined keys into group values and bucket labels
+    result = {}
+    rem = np.asarray(ukey, dtype=np.int64)
+    bucket_codes = rem % span + bmin
+    rem = rem // span
+    key_codes = []
+    for u in reversed(uniques):
+        key_codes.insert(0, rem % len(u))
+        rem = rem // len(u)
+    for col, u, c in zip(by, uniques, key_codes):
+        result[col] = u.take(c)
+    if _arithmeticInterval(interval) or fill is True:
+        result[on] = intervalLabels(bucket_codes, interval)
+    else:
+        # Period labels are derived from one timestamp in each bucket
+        result[on] = intervalLabels(bucket_codes, interval, 
+                                    np.asarray(data[on])[keep][order[starts]])
+    
+    for col, how, name in how_cols:
+        result[name] = _segmentReduce(np.asarray(data[col])[keep], group, ngroups, 
+                                      how, order, starts)
+    
+    if fill is True and ngroups > 0:
+        result = _fillBuckets(result, np.asarray(ukey, dtype=np.int64) // span, 
+                              bucket_codes, by, on, interval, how_cols)
+    
+    return pd.DataFrame(result, columns=list(result.keys()))
+
+
+def _fillBuckets(result, group_keys, bucket_codes, by, on, interval, how_cols):
+    """Inserts the empty buckets between the first and last bucket of each group 
+    into the columns of resampleReadings(), which are sorted by group_keys and 
+    bucket_codes.
+    """
+    first = np.r_[True, group_keys[1:] != group_keys[:-1]]
+    starts = np.flatnonzero(first)
+    ends = np.r_[starts[1:], len(group_keys)] - 1
+    lo = bucket_codes[starts]
+    lengths = bucket_codes[ends] - lo + 1
+    offsets = np.r_[0, np.cumsum(lengths)[:-1]]
+    
+    # Positions of the existing buckets in the filled grid
+    gid = np.cumsum(first) - 1
+    pos = offsets[gid] + bucket_codes - lo[gid]
+    fill_gid = np.repeat(np.arange(len(starts)), lengths)
+    fill_codes = lo[fill_gid] + np.arange(lengths.sum()) - offsets[fill_gid]
+    
+    filled = {}
+    for col in by:
+        filled[col] = result[col].take(starts[fill_gid])
+    filled[on] = intervalLabels(fill_codes, interval)
+    for col, how, name in how_cols:
+        values = np.asarray(result[name])
+        if how in ['sum', 'count']:
+            filled[name] = np.zeros(len(fill_codes), dtype=values.dtype)
+        else:
+            filled[name] = np.full(len(fill_codes), np.nan)
+        filled[name][pos] = values
+    
+    return filled
+
+
+def _decodeValid(valid):
+    """Decodes the 'Y'/'N' Valid flags of raw profiles to 1/0. The flags are 
+    factorised, so that only the unique values are stripped and mapped. 
+    Missing and unknown flags are decoded as 0.
+    """
+    codes, uniques = pd.factorize(valid)
+    lookup = np.array([{'Y':1, 'N':0}.get(str(u).strip(), 0) for u in uniques] + [0], 
+                      dtype=np.int8)
+    
+    return lookup[codes]
+
+
+def compactProfiles(data):
+    """Casts profile data to a compact schema: float32 Unitsread, int32 ProfileID, 
+    categorical RecorderID and int8 Valid. Columns that are missing are skipped. 
+    Reduced profiles keep 0/1 Valid values, so int8 is lossless for both raw 
+    and reduced data.
+    """
+    dtypes = {'Unitsread':np.float32, 'ProfileID':np.int32, 'RecorderID':'category', 
+              'Valid':np.int8}
+    for col, dtype in dtypes.items():
+        # Columns are only replaced if they need a cast, as assignment copies them
+        if col in data.columns and data[col].dtype != dtype:
+            data[col] = data[col].astype(dtype)
+    
+    return data
+
+
+def _formatRawProfiles(data, compact=False):
+    """Rounds raw timestamps to the nearest second, decodes the Valid flag and 
+    casts ProfileIDs to int. If compact is True, compactProfiles() is applied.
+    """
+    data.reset_index(inplace=True, drop=True)
+    data.Datefield = np.round(data.Datefield.astype(np.int64), -9).astype('datetime64[ns]')
+    data['Valid'] = _decodeValid(data['Valid'])
+    if compact is True:
+        return compactProfiles(data)
+    data['Valid'] = data['Valid'].astype(np.int64)
+    data['ProfileID'] = data['ProfileID'].astype(int)
+    
+    return data
+
+
+_raw_column_types = {'RecorderID':pa.string(), 'ProfileID':pa.int64(), 
+                     'Datefield':pa.timestamp('ns'), 'Unitsread':pa.float64(), 
+                     'Valid':pa.string()}
+
+_raw_readers = OrderedDict()
+
+
+def registerRawReader(name, reader, magic=None, extensions=[], chunk_reader=None):
+    """Registers a reader for a raw profile file format. Formats are detected 
+    by rawFileFormat() from the leading bytes of a file, and otherwise from its 
+    extension.
+    
+    Parameters:
+        name (str): format name
+        reader (function): reader(childpath) returns a pandas dataframe
+        magic (bytes or tuple): leading bytes of files in this format. Defaults 
+            to None.
+        extensions (list): file extensions, eg ['.csv']
+        chunk_reader (function): chunk_reader(childpath, chunksize) yields 
+            dataframes of chunksize rows. Defaults to None, in which case files 
+            are read whole and sliced.
+    """
+    _raw_readers[name] = {'reader':reader, 'magic':magic, 
+                          'extensions':[e.lower() for e in extensions], 
+                          'chunk_reader':chunk_reader}
+    
+    
+def rawFileFormat(childpath):
+    """Detects the format of a raw profile file from its magic bytes or file 
+    extension. Files that match no registered format are read as csv.
+    
+    Returns:
+        name of the registered format
+    """
+    with open(childpath, 'rb') as f:
+        head = f.read(16)
+    for name, r in _raw_readers.items():
+        if r['magic'] is not None and head.startswith(r['magic']):
+            return name
+    ext = os.path.splitext(childpath)[1].lower()
+    for name, r in _raw_readers.items():
+        if ext in r['extensions']:
+            return name
+    
+    return 'csv'
+
+
+def _rawCsvOptions():
+    """Returns pyarrow csv conversion options with the column types of raw 
+    profiles. Empty strings are read as missing values, as with pd.read_csv(). 
+    Datefield is read as string and converted with _rawCsvFrame().
+    """
+    column_types = dict(_raw_column_types, Datefield=pa.string())
+    return pv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+
+
+def _rawCsvFrame(table):
+    """Converts a table read with _rawCsvOptions() to a dataframe. ISO 8601 
+    timestamps are cast by pyarrow. Tables with other timestamp formats, which 
+    pyarrow can not cast, are parsed with pd.to_datetime() like pd.read_csv() 
+    with parse_dates does.
+    """
+    i = table.schema.get_field_index('Datefield')
+    try:
+        table = table.set_column(i, 'Datefield', table.column(i).cast(pa.timestamp('ns')))
+    except pa.ArrowInvalid:
+        data = table.to_pandas()
+        data['Datefield'] = pd.to_datetime(data['Datefield'])
+        return data
+    
+    return table.to_pandas()
+
+
+def _readRawCsv(childpath):
+    """Reads a raw csv file with the multithreaded pyarrow csv parser."""
+    return _rawCsvFrame(pv.read_csv(childpath, convert_options=_rawCsvOptions()))
+
+
+def _readRawCsvChunks(childpath, chunksize):
+    """Streams a raw csv file with the pyarrow csv reader and yields dataframes 
+    of chunksize rows.
+    """
+    reader = pv.open_csv(childpath, convert_options=_rawCsvOptions())
+    batches = []
+    rows = 0
+    for batch in reader:
+        batches.append(batch)
+        rows += batch.num_rows
+        while rows >= chunksize:
+            table = pa.Table.from_batches(batches)
+            yield _rawCsvFrame(table.slice(0, chunksize))
+            table = table.slice(chunksize)
+            batches = table.to_batches()
+            rows = table.num_rows
+    if rows > 0:
+        yield _rawCsvFrame(pa.Table.from_batches(batches))
+
+
+registerRawReader('csv', _readRawCsv, extensions=['.csv', '.txt'], 
+                  chunk_reader=_readRawCsvChunks)
+registerRawReader('feather', feather.read_dataframe, magic=(b'FEA1', b'ARROW1'), 
+                  extensions=['.feather'])
+registerRawReader('parquet', pd.read_parquet, magic=b'PAR1', 
+                  extensions=['.parquet'])
+
+
+def _readRawChunks(childpath, chunksize=None):
+    """Yields a raw profile file in chunks of chunksize rows, using the reader 
+    registered for its format. Formats without a chunk reader are read whole 
+    and sliced. If chunksize is None, the whole file is yielded at once.
+    """
+    r = _raw_readers[rawFileFormat(childpath)]
+    if chunksize is None:
+        yield r['reader'](childpath)
+    elif r['chunk_reader'] is not None:
+        yield from r['chunk_reader'](childpath, chunksize)
+    else:
+        data = r['reader'](childpath)
+        for i in range(0, len(data), chunksize):
+            yield data.iloc[i:i+chunksize].copy()
+
+
+def _rawCachePath(childpath):
+    """Returns the cache directory of a raw profile file, which mirrors the 
+    raw/unit/year directory structure in profiles/raw_cache.
+    """
+    return os.path.join(profiles_dir, 'raw_cache', 
+                        os.path.relpath(childpath, rawprofiles_dir))
+
+
+def _rawCacheMeta(childpath):
+    """Returns the metadata of the cached copy of a raw profile file, or None if 
+    the cache does not exist or is older than the raw file.
+    """
+    try:
+        with open(os.path.join(_rawCachePath(childpath), 'meta.json')) as f:
+            meta = json.load(f)
+        stat = os.stat(childpath)
+    except (FileNotFoundError, ValueError):
+        return None
+    if meta['size'] != stat.st_size or meta['mtime_ns'] != stat.st_mtime_ns:
+        return None
+    
+    return meta
+
+
+def _writeRawCache(data, childpath):
+    """Writes formatted raw profiles to a memory-mappable columnar cache: one .npy 
+    file per column, with timestamps stored as int64 epoch nanoseconds, Valid 
+    flags as int8 and text columns (eg RecorderID) dictionary-encoded as int32 codes.
+    """
+    cache_path = _rawCachePath(childpath)
+    tmp_path = tempPath(cache_path)
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    stat = os.stat(childpath)
+    meta = {'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns, 'rows':len(data), 
+            'columns':[], 'dtypes':{}, 'categories':{}}
+    for col in data.columns:
+        values = data[col]
+        if values.dtype.kind == 'M':
+            array = values.values.astype('datetime64[ns]').view(np.int64)
+            meta['dtypes'][col] = 'datetime64[ns]'
+        elif col == 'Valid':
+            array = values.values.astype(np.int8)
+            meta['dtypes'][col] = array.dtype.str
+        elif values.dtype.kind in 'biuf':
+            array = values.values
+            meta['dtypes'][col] = array.dtype.str
+        else:
+            codes, uniques = pd.factorize(values)
+            array = codes.astype(np.int32)
+            meta['dtypes'][col] = 'category'
+            meta['categories'][col] = [str(u) for u in uniques]
+        np.save(os.path.join(tmp_path, col + '.npy'), np.ascontiguousarray(array))
+        meta['columns'].append(col)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(cache_path, ignore_errors=True)
+    os.rename(tmp_path, cache_path)
+
+
+def rawProfileColumns(childpath):
+    """Returns the columns of a raw profile file from its memory-mapped cache.
+    
+    Numeric columns are read-only memory maps and timestamps are datetime64 
+    views of the cached int64 values, so no data is parsed or copied. 
+    Dictionary-encoded columns are returned as pandas Categoricals built on 
+    the memory-mapped codes.
+    
+    Parameters:
+        childpath (str): path of the raw GroupYear file
+        
+    Returns:
+        OrderedDict of column:array pairs, or None if the cache is missing or stale
+    """
+    meta = _rawCacheMeta(childpath)
+    if meta is None:
+        return None
+    cache_path = _rawCachePath(childpath)
+    columns = OrderedDict()
+    for col in meta['columns']:
+        array = np.load(os.path.join(cache_path, col + '.npy'), mmap_mode='r')
+        if meta['dtypes'][col] == 'datetime64[ns]':
+            array = array.view('datetime64[ns]')
+        elif meta['dtypes'][col] == 'category':
+            array = pd.Categorical.from_codes(array, meta['categories'][col])
+        columns[col] = array
+    
+    return columns
+
+
+def cacheRawProfiles(year, unit=None):
+    """Converts the raw profile files of a year to the memory-mapped cache that 
+    loadRawProfiles() and reduceRawProfiles() read from. Files with a fresh 
+    cache are skipped, so this only needs to be rerun when raw files change.
+    
+    Parameters:
+        year (int)  
+        unit (str): one of 'A', 'V', 'Hz', 'kVA', 'kW'. Defaults to None (all units).
+    """
+    units = _rawProfileUnits(year) if unit is None else [unit]
+    for u in units:
+        try:
+            childpaths = _rawProfileFiles(year, u)
+        except FileNotFoundError as e:
+            print(e)
+            continue
+        for childpath in childpaths:
+            if _rawCacheMeta(childpath) is not None:
+                continue
+            data = next(_readRawChunks(childpath))
+            if len(data)>0:
+                _writeRawCache(_formatRawProfiles(data), childpath)
+                print('Cached', childpath)
+    
+    return
+
+
+def _formattedRawChunks(childpath, chunksize=None, compact=False):
+    """Yields formatted raw profiles in chunks of chunksize rows. Chunks are read 
+    from the memory-mapped cache if it is fresh and are then returned as dicts of 
+    column arrays, otherwise the raw file is parsed and formatted.
+    """
+    columns = rawProfileColumns(childpath)
+    if columns is None:
+        for chunk in _readRawChunks(childpath, chunksize):
+            yield _formatRawProfiles(chunk, compact)
+        return
+    rows = len(columns['Datefield'])
+    step = rows if chunksize is None else chunksize
+    for i in range(0, rows, max(step, 1)):
+        yield OrderedDict([(col, array[i:i+step]) for col, array in columns.items()])
+
+
+def _loadRawFrame(childpath, compact=False):
+    """Loads a formatted raw profile file as dataframe, from the memory-mapped 
+    cache if it is fresh. Cached columns that already have the dtype of the 
+    formatted profiles are read-only views of the memory maps, not copies.
+    """
+    columns = rawProfileColumns(childpath)
+    if columns is None:
+        data = next(_readRawChunks(childpath))
+        if len(data)==0:
+            return data
+        return _formatRawProfiles(data, compact)
+    data = pd.DataFrame(columns, copy=False)
+    if compact is True:
+        return compactProfiles(data)
+    for col in data.columns:
+        if data[col].dtype.name == 'category':
+            data[col] = data[col].astype(object)
+    # Valid flags are cached as int8, formatted profiles hold them as int64
+    data['Valid'] = data['Valid'].astype(np.int64)
+    
+    return data
+
+
+def _intervalLength(interval):
+    """Returns the nominal length of an interval in nanoseconds, used to order 
+    intervals from fine to coarse.
+    """
+    offset = to_offset(interval)
+    if isinstance(offset, (pd.offsets.Tick, pd.offsets.Day)):
+        return _intervalNanos(offset)
+    ref = pd.Timestamp('2001-01-01')
+    
+    return ((ref + offset) - ref).value
+
+
+def _nestsIn(fine, coarse):
+    """Checks if every bucket of the fine interval lies within a single bucket of 
+    the coarse interval.
+    """
+    day = 86400000000000
+    fine_offset = to_offset(fine)
+    coarse_offset = to_offset(coarse)
+    fixed = (pd.offsets.Tick, pd.offsets.Day)
+    if isinstance(fine_offset, fixed):
+        fine_ns = _intervalNanos(fine_offset)
+        if isinstance(coarse_offset, fixed):
+            return _intervalNanos(coarse_offset) % fine_ns == 0
+        return day % fine_ns == 0 and _arithmeticInterval(coarse)
+    
+    return (fine, coarse) in [('M', 'Q'), ('M', 'A'), ('Q', 'A'), ('M', 'M'), 
+                              ('W', 'W'), ('A', 'A')]
+
+
+def cascadeIntervals(intervals):
+    """Orders intervals from finest to coarsest and finds the finer interval that 
+    each coarser interval can be derived from.
+    
+    Parameters:
+        intervals (list): pandas offset aliases, eg ['30T', 'H', 'D']
+        
+    Returns:
+        OrderedDict of interval:source pairs, where source is the coarsest finer 
+        interval that interval nests in (None for the finest interval)
+    """
+    ordered = sorted(set(intervals), key=_intervalLength)
+    cascade = OrderedDict([(ordered[0], None)])
+    for i, interval in enumerate(ordered[1:]):
+        sources = [s for s in ordered[:i+1] if _nestsIn(s, interval)]
+        if len(sources)==0:
+            raise InputError(interval, 'Interval cannot be derived from ' + ordered[0])
+        cascade[interval] = sources[-1]
+    
+    return cascade
+
+
+def _partialSums(data, interval):
+    """Reduces formatted readings to running sums and counts of Unitsread and 
+    Valid for each RecorderID, ProfileID and interval bucket.
+    """
+    return resampleReadings(data, interval, agg={'Unitsread':['sum', 'count'], 
+                                                 'Valid':['sum', 'count']})
+
+
+def _mergePartialSums(partials, interval):
+    """Merges partial sums computed on separate chunks of the same file, or 
+    rolls up the partial sums of a finer interval to interval.
+    """
+    partial = pd.concat(partials, ignore_index=True)
+    
+    return resampleReadings(partial, interval, agg={
+            c:'sum' for c in ['Unitsread_sum', 'Unitsread_count', 'Valid_sum', 'Valid_count']})
+
+
+def _streamPartialSums(chunks, interval):
+    """Reduces chunks of formatted readings to the partial sums of _partialSums(), 
+    merging each chunk as it arrives. Raw files list the readings of a profile 
+    in time order, so every bucket other than the bucket of the last reading of 
+    a chunk is complete. Complete buckets are set aside and only the last bucket 
+    is carried to the next chunk. If a chunk has readings of a bucket that was 
+    already set aside, the file is not ordered and all partial sums are merged 
+    again at the end.
+    
+    Returns:
+        pandas dataframe of partial sums sorted by RecorderID, ProfileID and 
+        Datefield, or None if there are no readings
+    """
+    keys = ['RecorderID', 'ProfileID']
+    done = []
+    carry = None
+    # Last bucket code that was set aside for each RecorderID and ProfileID
+    flushed = {}
+    ordered = True
+    for chunk in chunks:
+        if len(chunk['Datefield'])==0:
+            continue
+        partial = _partialSums(chunk, interval)
+        last = [np.asarray(chunk[c][-1:])[0] for c in keys]
+        last_code = intervalCodes(np.asarray(chunk['Datefield'][-1:]), interval)[0]
+        del chunk
+        codes = intervalCodes(partial['Datefield'], interval)
+        groups = [np.asarray(partial[c]) for c in keys]
+        if ordered is True:
+            # Buckets that were set aside must not have further readings
+            first = pd.Series(codes).groupby(groups).min()
+            ordered = all(code > flushed.get(key, code - 1) for key, code in first.items())
+        if ordered is False:
+            done.append(partial)
+            continue
+        if carry is not None:
+            partial = _mergePartialSums([carry, partial], interval)
+            codes = intervalCodes(partial['Datefield'], interval)
+            groups = [np.asarray(partial[c]) for c in keys]
+        current = (groups[0] == last[0]) & (groups[1] == last[1]) & (codes == last_code)
+        carry = partial[current]
+        if not current.all():
+            done.append(partial[~current])
+            flushed.update(pd.Series(codes[~current]).groupby(
+                    [g[~current] for g in groups]).max().to_dict())
+        del partial
+    if carry is not None:
+        done.append(carry)
+    if len(done)==0:
+        return None
+    if ordered is False:
+        return _mergePartialSums(done, interval)
+    
+    partial = pd.concat(done, ignore_index=True)
+    del done
+    
+    return partial.sort_values(keys + ['Datefield'], kind='mergesort', ignore_index=True)
+
+
+def _partialMeans(partial):
+    """Converts partial sums and counts to interval means."""
+    # Buckets without a single Unitsread value are dropped, as with dropna()
+    partial = partial[partial['Unitsread_count'] > 0]
+    aggdata = partial[['RecorderID', 'ProfileID', 'Datefield']].copy()
+    aggdata['Unitsread'] = partial['Unitsread_sum'] / partial['Unitsread_count']
+    aggdata['Valid'] = partial['Valid_sum'] / partial['Valid_count']
+    aggdata.reset_index(inplace=True, drop=True)
+    
+    return aggdata
+
+
+def loadRawProfiles(year, month, unit, compact=False):
+    """Loads raw load profiles for a year, month and unit. If compact is True, the 
+    data is cast to the compact schema of compactProfiles(). Files are read from 
+    the memory-mapped cache created by cacheRawProfiles() if it is up to date.
     
     """
     validYears(year)
@@ -33,39 +752,105 @@ def loadRawProfiles(year, month, unit):
     
     filename = str(year)+'-'+str(month)+'_G*'    
     filepath = glob(os.path.join(rawprofiles_dir, unit, str(year), filename))
-    ts = pd.DataFrame()
+    ts = []
     
     for p in filepath:
-        try:
-            data = pd.read_csv(p, parse_dates=['Datefield'], low_memory=False)  
-        except:
-            data = feather.read_dataframe(p)      
-        ts = ts.append(data)
+        data = _loadRawFrame(p, compact)
+        ts.append(data)
         del data
 
     if len(ts)>0:
-        ts.reset_index(inplace=True, drop=True)
-        ts.Datefield = np.round(ts.Datefield.astype(np.int64), -9).astype('datetime64[ns]')
-        ts['Valid'] = ts['Valid'].map(lambda x: x.strip()).map({'Y':1, 'N':0})
-        ts['Valid'].fillna(0, inplace=True)
-        ts['ProfileID'] = ts['ProfileID'].astype(int)
+        ts = pd.concat(ts, ignore_index=True)
+        if compact is True:
+            ts = compactProfiles(ts)
+    else:
+        ts = pd.DataFrame()
         
     print('{} {}: data loaded'.format(unit, year))
     
     return ts    
     
 
-def reduceRawProfiles(year, unit, interval):
-    """Resamples all raw load profiles for a specific observation 
-    unit in a particular year to their mean values over an interval.  
+def _finaliseReduced(aggdata, compact=False):
+    """Removes duplicates from reduced profiles and marks intervals that contain 
+    invalid readings as invalid.
+    """
+    aggdata.drop_duplicates(inplace=True)
+    aggdata.loc[(aggdata.Valid!=1)&(aggdata.Valid>0), 'Valid'] = 0
+    if compact is True:
+        aggdata = compactProfiles(aggdata)
+    elif aggdata['RecorderID'].dtype.name == 'category':
+        # Cached RecorderIDs are dictionary-encoded
+        aggdata['RecorderID'] = aggdata['RecorderID'].astype(object)
     
-    Parameters:
-        year (int)  
-        unit (str): one of 'A', 'V', 'Hz', 'kVA', 'kW' 
-        interval (str): 'H' for hourly, '30T' for 30min
+    return aggdata
+
+
+def _reduceRawFile(childpath, interval, chunksize=None, compact=False):
+    """Resamples a single raw GroupYear file to mean values over an interval. 
+    
+    If chunksize is specified, the file is read in chunks of chunksize rows that 
+    are merged into running sums and counts as they arrive, see 
+    _streamPartialSums(). If compact is True, the result is cast to the compact 
+    schema of compactProfiles(). The memory-mapped cache created by 
+    cacheRawProfiles() is used if it is up to date.
+    
+    interval can also be a list of intervals. The raw data is then reduced to 
+    sums and counts at the finest interval only and coarser intervals are 
+    rolled up from finer ones as ordered by cascadeIntervals().
+    
+    Returns:
+        pandas dataframe with columns [
+                'RecorderID', 'ProfileID', 'Datefield', 'Unitsread', 'Valid'],  
+        an OrderedDict of such dataframes keyed by interval if interval is a list, 
+        or None if the file contains no data
     """
-    # Clear any memory garbage
-    gc.collect()     
+    child = os.path.basename(childpath)
+    
+    if isinstance(interval, (list, tuple)) or chunksize is not None:
+        if isinstance(interval, (list, tuple)):
+            cascade = cascadeIntervals(interval)
+        else:
+            cascade = OrderedDict([(interval, None)])
+        finest = list(cascade.keys())[0]
+        partial = _streamPartialSums(_formattedRawChunks(childpath, chunksize, compact), 
+                                     finest)
+        if partial is None:
+            # Skip if file does not exist
+            print('FAILED to load data for ' + child)
+            return None
+        print('Data loaded for {}'.format(child))    
+        partials = {finest:partial}
+        del partial
+        for i, source in cascade.items():
+            if source is not None:
+                partials[i] = _mergePartialSums([partials[source]], i)
+        reduced = OrderedDict([(i, _finaliseReduced(_partialMeans(partials[i]), 
+                                                    compact)) for i in cascade.keys()])
+        del partials
+        if isinstance(interval, (list, tuple)):
+            return reduced
+        return reduced[interval]
+    
+    # Load formatted data
+    data = next(_formattedRawChunks(childpath, None, compact))
+    if len(data['Datefield'])==0:
+        # Skip if file does not exist
+        print('FAILED to load data for ' + child)
+        return None
+    print('Data loaded for {}'.format(child))    
+    # Resample data
+    aggdata = resampleReadings(data, interval)
+    del data
+    # Buckets without valid readings have nan values
+    aggdata.dropna(inplace=True)   
+    aggdata.reset_index(inplace=True, drop=True)
+    
+    return _finaliseReduced(aggdata, compact)
+
+
+def _rawProfileFiles(year, unit):
+    """Lists the paths of all raw GroupYear files for a year and unit."""
     validYears(year)
     
     if unit in ['A','V','Hz','kVA','kW']:
@@ -75,185 +860,1044 @@ def reduceRawProfiles(year, unit, interval):
         
     p = os.path.join(rawprofiles_dir, unit, str(year))
     
-    ts = pd.DataFrame()
-    for child in os.listdir(p):
-        childpath = os.path.join(p, child)
-        try:
-            data = pd.read_csv(childpath, parse_dates=['Datefield'], 
-                               low_memory=False)
-        except:
-            data = feather.read_dataframe(childpath)
-        if len(data)>0:
-            print('Data loaded for {}'.format(child))    
-            # Format data
-            data.reset_index(inplace=True, drop=True)
-            data.Datefield = np.round(data.Datefield.astype(np.int64), -9).astype('datetime64[ns]')
-            data['Valid'] = data['Valid'].map(lambda x: x.strip()).map({'Y':1, 'N':0})
-            data['Valid'].fillna(0, inplace=True)
-            data['ProfileID'] = data['ProfileID'].astype(int)
-            # Resample data
-            data.sort_values(by=['RecorderID', 'ProfileID','Datefield'], inplace=True)
-            data.reset_index(inplace=True)
-            aggdata = data.groupby(['RecorderID', 'ProfileID']).resample(
-                    interval, on='Datefield').mean()
-            del data
-            # Resampling creates lots of nan values
-            aggdata.dropna(inplace=True)   
-            ts = ts.append(aggdata)
-            del aggdata        
-        else:
-            # Skip if file does not exist
-            print('FAILED to load data for ' + child)   
+    return [os.path.join(p, child) for child in sorted(os.listdir(p))]
+
+
+def _rawProfileUnits(year):
+    """Lists the units in the raw profile layout of a year, ie the units with a 
+    raw/unit/year directory. Years up to 2009 only contain A and V profiles.
+    """
+    return [unit for unit in ['A', 'V', 'kVA', 'Hz', 'kW'] if os.path.isdir(
+            os.path.join(rawprofiles_dir, unit, str(year)))]
+
+
+def iterReducedProfiles(year, unit, interval, chunksize=100000, compact=False):
+    """Generator that reduces the raw load profiles for a specific observation 
+    unit and year one GroupYear file at a time. 
+    
+    Each file is read in chunks of chunksize rows and only the running sums and 
+    counts per RecorderID, ProfileID and interval are kept in memory, so that 
+    peak memory is set by chunksize rather than by the size of the year.
+    
+    Parameters:
+        year (int)  
+        unit (str): one of 'A', 'V', 'Hz', 'kVA', 'kW' 
+        interval (str): 'H' for hourly, '30T' for 30min
+        chunksize (int): number of raw rows read at a time
+        compact (bool): cast output to the compact schema of compactProfiles()
+    
+    Yields:
+        pandas dataframe with columns [
+                'RecorderID', 'ProfileID', 'Datefield', 'Unitsread', 'Valid']
+    """
+    for childpath in _rawProfileFiles(year, unit):
+        aggdata = _reduceRawFile(childpath, interval, chunksize, compact)
+        if aggdata is not None:
+            yield aggdata
+
+
+def reduceRawProfiles(year, unit, interval, chunksize=None, compact=False):
+    """Resamples all raw load profiles for a specific observation 
+    unit in a particular year to their mean values over an interval.  
+    
+    Parameters:
+        year (int)  
+        unit (str): one of 'A', 'V', 'Hz', 'kVA', 'kW' 
+        interval (str): 'H' for hourly, '30T' for 30min
+        chunksize (int): if specified, raw files are reduced in streaming mode
+            with iterReducedProfiles(). Defaults to None (read files whole).
+        compact (bool): cast output to the compact schema of compactProfiles()
+    """
+    # Clear any memory garbage
+    gc.collect()     
+    
+    ts = [_reduceRawFile(childpath, interval, chunksize, compact) for childpath in 
+          _rawProfileFiles(year, unit)]
+    ts = [aggdata for aggdata in ts if aggdata is not None]
 
-    if ts is None:
+    if len(ts)==0:
         return print('No profiles for {} {}'.format(year, unit))
     else:      
-        aggts = ts.loc[:, ['Unitsread', 'Valid']]
-        aggts.reset_index(inplace=True)
+        # Collect results and concatenate once to avoid repeated copies
+        aggts = pd.concat(ts, ignore_index=True)
         aggts.drop_duplicates(inplace=True)
-        aggts.loc[(aggts.Valid!=1)&(aggts.Valid>0), 'Valid'] = 0
+        if compact is True:
+            aggts = compactProfiles(aggts)
         # Free memory
         del ts 
            
         return aggts
 
 
-def saveReducedProfiles(year, interval, filetype='csv'):
+def _reducedProfilesPath(year, unit, interval, filetype):
+    """Returns the output path of reduced profiles. For parquet this is the year 
+    partition of the unit's dataset. The directory is only created when profiles 
+    are written with _writeReducedProfiles().
+    """
+    dir_path = os.path.join(pdata_dir, interval, unit)
+    if filetype=='parquet':
+        return os.path.join(dir_path, 'parquet', 'year=' + str(year))
+    
+    return os.path.join(dir_path, str(year) + '_' + unit + '.'+filetype)
+
+
+def _writeReducedProfiles(ts, wpath, filetype, mode='w'):
+    """Writes reduced profiles to wpath as feather, csv or parquet file and creates 
+    its directory. Csv files can be appended to with mode='a'.
+    """
+    os.makedirs(os.path.dirname(wpath), exist_ok=True)
+    if filetype=='feather':
+        if ts['RecorderID'].dtype.name != 'category':
+            ts['RecorderID']=ts['RecorderID'].astype(str)
+        feather.write_dataframe(ts, wpath)
+    elif filetype=='csv':
+        ts.to_csv(wpath, mode=mode, header=(mode=='w'), index=False)
+    elif filetype=='parquet':
+        _writeReducedDataset(ts, wpath)
+    else:
+        raise InputError(filetype, 'Invalid filetype')
+
+
+def _writeReducedDataset(ts, wpath, row_group_size=50000):
+    """Writes a year of reduced profiles to wpath as parquet dataset partitioned 
+    by month. Rows are sorted by ProfileID and Datefield, so that the row group 
+    statistics can be used to skip row groups when filtering by ProfileID or date. 
+    The year partition is replaced once all months have been written.
+    """
+    tmp_path = tempPath(wpath)
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    ts = ts.sort_values(by=['ProfileID', 'Datefield'])
+    if ts['RecorderID'].dtype.name != 'category':
+        ts['RecorderID']=ts['RecorderID'].astype(str)
+    for month, data in ts.groupby(ts['Datefield'].dt.month):
+        month_path = os.path.join(tmp_path, 'month=' + str(month))
+        os.makedirs(month_path)
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        pq.write_table(table, os.path.join(month_path, 'part-0.parquet'), 
+                       row_group_size=row_group_size)
+    shutil.rmtree(wpath, ignore_errors=True)
+    os.rename(tmp_path, wpath)
+    
+
+def _fileSignature(path, entry=None):
+    """Returns the size, modification time and md5 hash of a file. The hash is 
+    only recomputed if size or mtime differ from those recorded in entry.
+    
+    If path is a directory, eg a parquet dataset partition, the signature covers 
+    all its files: size is their total size, mtime the latest modification of 
+    the files and directories and the hash is computed over their relative 
+    paths and contents.
+    """
+    if os.path.isdir(path):
+        files = []
+        stats = [os.stat(path)]
+        for root, dirs, fs in os.walk(path):
+            stats.extend(os.stat(os.path.join(root, d)) for d in dirs)
+            files.extend(os.path.join(root, f) for f in fs)
+        files.sort()
+        filestats = [os.stat(f) for f in files]
+        size = sum(s.st_size for s in filestats)
+        mtime = max(s.st_mtime for s in stats + filestats)
+    else:
+        files = [path]
+        stat = os.stat(path)
+        size = stat.st_size
+        mtime = stat.st_mtime
+    signature = {'size':size, 'mtime':mtime}
+    if entry is not None and entry.get('size')==size and entry.get('mtime')==mtime:
+        signature['md5'] = entry['md5']
+        return signature
+    md5 = hashlib.md5()
+    for file_path in files:
+        if file_path != path:
+            md5.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1048576), b''):
+                md5.update(block)
+    signature['md5'] = md5.hexdigest()
+    
+    return signature
+
+
+def _partsDir(year, unit, interval):
+    """Returns the directory holding per-file partial outputs and the manifest 
+    of reduced profiles for a year and unit.
+    """
+    return os.path.join(pdata_dir, interval, unit, '.parts', str(year))
+
+
+def _loadManifest(year, unit, interval):
+    """Loads the raw file manifest of reduced profiles for a year and unit."""
+    path = os.path.join(_partsDir(year, unit, interval), 'manifest.json')
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _saveManifest(manifest, year, unit, interval):
+    """Saves the raw file manifest atomically so that an interrupted run can resume."""
+    dir_path = _partsDir(year, unit, interval)
+    os.makedirs(dir_path, exist_ok=True)
+    path = os.path.join(dir_path, 'manifest.json')
+    with open(tempPath(path), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tempPath(path), path)
+
+
+def _staleRawFiles(manifest, childpaths, year, unit, interval):
+    """Compares raw files against the manifest. Entries of raw files that no 
+    longer exist are removed together with their partial outputs.
+    
+    Returns:
+        list of childpaths that must be reduced again, dict of their signatures 
+        and list of removed raw files
+    """
+    dir_path = _partsDir(year, unit, interval)
+    children = [os.path.basename(p) for p in childpaths]
+    removed = []
+    for child in list(manifest.keys()):
+        if child not in children:
+            part = manifest.pop(child).get('part')
+            if part is not None and os.path.isfile(os.path.join(dir_path, part)):
+                os.remove(os.path.join(dir_path, part))
+            removed.append(child)
+
+    stale = []
+    signatures = {}
+    for childpath, child in zip(childpaths, children):
+        entry = manifest.get(child)
+        signatures[childpath] = _fileSignature(childpath, entry)
+        if entry is None or entry['md5'] != signatures[childpath]['md5'] or (
+                entry['part'] is not None and not os.path.isfile(
+                        os.path.join(dir_path, entry['part']))):
+            stale.append(childpath)
+        elif entry['mtime'] != signatures[childpath]['mtime']:
+            # Touched but unchanged
+            entry.update(signatures[childpath])
+            
+    return stale, signatures, removed
+
+
+def _saveReducedPart(aggdata, manifest, childpath, signature, year, unit, interval):
+    """Saves the reduced profiles of a single raw file as partial output and 
+    records it in the manifest.
+    """
+    dir_path = _partsDir(year, unit, interval)
+    os.makedirs(dir_path, exist_ok=True)
+    child = os.path.basename(childpath)
+    entry = dict(signature)
+    if aggdata is None:
+        entry.update({'part':None, 'rows':0})
+    else:
+        part = child + '.feather'
+        if aggdata['RecorderID'].dtype.name != 'category':
+            aggdata['RecorderID'] = aggdata['RecorderID'].astype(str)
+        feather.write_dataframe(aggdata.reset_index(drop=True), 
+                                tempPath(os.path.join(dir_path, part)))
+        os.replace(tempPath(os.path.join(dir_path, part)), os.path.join(dir_path, part))
+        entry.update({'part':part, 'rows':len(aggdata)})
+    manifest[child] = entry
+    _saveManifest(manifest, year, unit, interval)
+
+
+def _saveMergedParts(manifest, childpaths, year, unit, interval, filetype, compact=False, 
+                     writes=None):
+    """Splices the partial outputs of all raw files for a year and unit into the 
+    reduced profiles file. Csv output is written one part at a time. Returns a 
+    list of failures.
+    """
+    dir_path = _partsDir(year, unit, interval)
+    parts = [manifest[os.path.basename(p)]['part'] for p in childpaths 
+             if os.path.basename(p) in manifest]
+    parts = [os.path.join(dir_path, p) for p in parts if p is not None]
+    
+    if len(parts)==0:
+        print('No profiles for {} {}'.format(year, unit))
+        # Remove the output of raw files that no longer exist
+        wpath = _reducedProfilesPath(year, unit, interval, filetype)
+        if os.path.isdir(wpath):
+            shutil.rmtree(wpath)
+        elif os.path.isfile(wpath):
+            os.remove(wpath)
+        return []
+    
+    if filetype == 'csv':
+        wpath = _reducedProfilesPath(year, unit, interval, filetype)
+        try:
+            mode = 'w'
+            for part in parts:
+                _writeReducedProfiles(feather.read_dataframe(part), tempPath(wpath), 
+                                      filetype, mode)
+                mode = 'a'
+            os.replace(tempPath(wpath), wpath)
+            print('Write success for', year, unit)
+        except Exception as e:
+            return [[year, unit, wpath, repr(e)]]
+        return []
+    
+    return _saveMergedProfiles([feather.read_dataframe(part) for part in parts], 
+                               year, unit, interval, filetype, compact, writes)
+
+
+def _saveMergedProfiles(ts, year, unit, interval, filetype, compact=False, writes=None):
+    """Merges the reduced profiles of all GroupYear files for a year and unit and 
+    writes them to file in the background with writeAsync(). If writes is a list, 
+    [year, unit, path, future] of the write is appended to it and the function 
+    returns without waiting for the write to complete. Returns a list of failures.
+    """
+    ts = [aggdata for aggdata in ts if aggdata is not None]
+    if len(ts)==0:
+        print('No profiles for {} {}'.format(year, unit))
+        return []
+    aggts = pd.concat(ts, ignore_index=True)
+    aggts.drop_duplicates(inplace=True)
+    if compact is True:
+        aggts = compactProfiles(aggts)
+    del ts
+    wpath = _reducedProfilesPath(year, unit, interval, filetype)
+    written = writeAsync(wpath, lambda tmp_path: _writeReducedProfiles(aggts, tmp_path, filetype))
+    if writes is not None:
+        writes.append([year, unit, wpath, written])
+        return []
+    #write to reduced data to file            
+    try:
+        written.result()
+        print('Write success for', year, unit)
+    except Exception as e:
+        return [[year, unit, wpath, repr(e)]]
+    
+    return []
+    
+
+def _reduceRawFileIntervals(childpath, intervals, chunksize=None, compact=False):
+    """Reduces a single raw GroupYear file to each interval in intervals. 
+    
+    Returns:
+        dict of reduced profiles keyed by interval or None if the file contains no data
+    """
+    if len(intervals)==1:
+        aggdata = _reduceRawFile(childpath, intervals[0], chunksize, compact)
+        if aggdata is None:
+            return None
+        return {intervals[0]:aggdata}
+    
+    return _reduceRawFile(childpath, intervals, chunksize, compact)
+
+
+def saveReducedProfiles(year, interval, filetype='csv', chunksize=None, jobs=1, 
+                        incremental=False, compact=False):
     """Iterates through profile units, reduces all profiles with 
     reduceRawProfiles() and saves the result as a feather object in a directory tree.
     
-    """ 
-    for unit in ['A', 'V', 'kVA', 'Hz', 'kW']:
-        gc.collect() #clear any memory garbage
+    If interval is a list, the raw data is read once and every interval is written 
+    in the same pass. The finest interval is reduced from the raw readings and 
+    coarser intervals are rolled up from the sums and counts of finer ones.
+    
+    If chunksize is specified, raw files are reduced in streaming mode with 
+    iterReducedProfiles() and csv output is written as each file is reduced.
+    
+    If jobs > 1, every (year, unit, GroupYear file) is reduced as a separate task 
+    in a pool of jobs processes. Per-file results are merged into one output 
+    file per year and unit.
+    
+    If incremental is True, the size, mtime and md5 hash of every raw file and 
+    the partial output reduced from it are recorded in a manifest in 
+    interval/unit/.parts/year. Only new or changed raw files are reduced and 
+    their results are spliced into the output with the unchanged partial outputs. 
+    The manifest is updated after each file, so that interrupted runs resume 
+    where they stopped.
+    
+    Parameters:
+        year (int or list): a single year or a list of years
+        interval (str or list): 'H' for hourly, '30T' for 30min, or a list of intervals
+        filetype (str): 'csv', 'feather' or 'parquet'
+        chunksize (int): number of raw rows read at a time. Defaults to None.
+        jobs (int): number of worker processes. Defaults to 1.
+        incremental (bool): only reduce raw files that changed. Defaults to False.
+        compact (bool): write output in the compact schema of compactProfiles(). 
+            Defaults to False.
         
-        dir_path = os.path.join(pdata_dir, interval, unit)
-        os.makedirs(dir_path, exist_ok=True)
+    Returns:
+        pandas dataframe of failed tasks with columns [
+                'year', 'unit', 'file', 'error']. Failures are also logged to 
+                USER_HOME/del_data/usr/logs/reduce_profiles_failures.csv
+    """ 
+    if isinstance(year, int):
+        years = [year]
+    else:
+        years = list(year)
+    if isinstance(interval, str):
+        intervals = [interval]
+    else:
+        intervals = list(cascadeIntervals(interval).keys())
         
-        try:
-            ts = reduceRawProfiles(year, unit, interval)
-            wpath = os.path.join(dir_path, str(year) + '_' + unit + '.'+filetype)
-            #write to reduced data to file            
+    failures = []
+    writes = []
+    tasks = OrderedDict()
+    pending = OrderedDict()
+    manifests = {}
+    signatures = {}
+    for y in years:
+        # Units that are not in the raw profile layout of the year are skipped
+        units = _rawProfileUnits(y)
+        if len(units) == 0:
+            failures.append([y, None, os.path.join(rawprofiles_dir, '*', str(y)), 
+                             'No raw profiles for this year'])
+        for unit in units:
             try:
-                if filetype=='feather':
-                    ts['RecorderID']=ts['RecorderID'].astype(str)
-                    feather.write_dataframe(ts, wpath)
-                elif filetype=='csv':
-                    ts.to_csv(wpath, index=False)
-                print('Write success for', year, unit)
-            except Exception as e:
-                print(e)
-                pass
-
+                tasks[(y, unit)] = _rawProfileFiles(y, unit)
+            except FileNotFoundError as e:
+                failures.append([y, unit, e.filename, repr(e)])
+                continue
+            if incremental is True:
+                stale = []
+                # Outputs must also be merged again if raw files were removed
+                missing = False
+                for i in intervals:
+                    manifests[(y, unit, i)] = _loadManifest(y, unit, i)
+                    istale, sig, removed = _staleRawFiles(manifests[(y, unit, i)], 
+                                                          tasks[(y, unit)], y, unit, i)
+                    signatures.update(sig)
+                    _saveManifest(manifests[(y, unit, i)], y, unit, i)
+                    stale.extend(istale)
+                    missing |= len(removed) > 0
+                    missing |= not os.path.exists(_reducedProfilesPath(y, unit, i, filetype))
+                if len(stale)==0 and missing is False:
+                    print('Reduced profiles up to date for', y, unit)
+                    del tasks[(y, unit)]
+                    continue
+                pending[(y, unit)] = [p for p in tasks[(y, unit)] if p in stale]
+            else:
+                pending[(y, unit)] = tasks[(y, unit)]
+                
+    if jobs == 1:
+        for (y, unit), childpaths in pending.items():
+            gc.collect() #clear any memory garbage
+            ts = {i:[] for i in intervals}
+            mode = {i:'w' for i in intervals}
+            wpaths = {i:_reducedProfilesPath(y, unit, i, filetype) for i in intervals}
+            try:
+                for childpath in childpaths:
+                    try:
+                        reduced = _reduceRawFileIntervals(childpath, intervals, chunksize, 
+                                                          compact)
+                    except Exception as e:
+                        failures.append([y, unit, childpath, repr(e)])
+                        continue
+                    for i in intervals:
+                        aggdata = None if reduced is None else reduced[i]
+                        if incremental is True:
+                            _saveReducedPart(aggdata, manifests[(y, unit, i)], childpath, 
+                                             signatures[childpath], y, unit, i)
+                        elif chunksize is not None and filetype=='csv' and aggdata is not None:
+                            # Write streaming output as each file is reduced to a 
+                            # temporary file that replaces the output once the unit is done
+                            _writeReducedProfiles(aggdata, tempPath(wpaths[i]), filetype, 
+                                                  mode[i])
+                            mode[i] = 'a'
+                        else:
+                            ts[i].append(aggdata)
+                    del reduced, aggdata #clear memory
+            except BaseException:
+                # Interrupted runs leave the previous output in place
+                for i in intervals:
+                    if os.path.isfile(tempPath(wpaths[i])):
+                        os.remove(tempPath(wpaths[i]))
+                raise
+            for i in intervals:
+                if incremental is True:
+                    failures.extend(_saveMergedParts(manifests[(y, unit, i)], 
+                            tasks[(y, unit)], y, unit, i, filetype, compact, writes))
+                elif mode[i] == 'a':
+                    os.replace(tempPath(wpaths[i]), wpaths[i])
+                    print('Write success for', y, unit)
+                else:
+                    failures.extend(_saveMergedProfiles(ts[i], y, unit, i, filetype, 
+                                                        compact, writes))
             del ts #clear memory
-        except FileNotFoundError as e:
-            print(e)
-            pass
+            
+    else:
+        remaining = {k:len(v) for k, v in pending.items()}
+        results = {k:{} for k in pending.keys()}
+        done_units = [k for k, v in remaining.items() if v==0]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            for (y, unit), childpaths in pending.items():
+                for childpath in childpaths:
+                    futures[executor.submit(_reduceRawFileIntervals, childpath, intervals, 
+                                            chunksize, compact)] = (y, unit, childpath)
+            for future in chain([None], as_completed(futures)):
+                if future is not None:
+                    y, unit, childpath = futures.pop(future)
+                    try:
+                        reduced = future.result()
+                        if incremental is True:
+                            for i in intervals:
+                                _saveReducedPart(None if reduced is None else reduced[i], 
+                                                 manifests[(y, unit, i)], childpath, 
+                                                 signatures[childpath], y, unit, i)
+                        elif reduced is not None:
+                            results[(y, unit)][childpath] = reduced
+                        del reduced
+                    except Exception as e:
+                        failures.append([y, unit, childpath, repr(e)])
+                    remaining[(y, unit)] -= 1
+                    if remaining[(y, unit)] == 0:
+                        done_units.append((y, unit))
+                # Merge per-file results in file order once all tasks of a unit are done
+                for (y, unit) in done_units:
+                    done = results.pop((y, unit))
+                    for i in intervals:
+                        if incremental is True:
+                            failures.extend(_saveMergedParts(manifests[(y, unit, i)], 
+                                    tasks[(y, unit)], y, unit, i, filetype, compact, writes))
+                        else:
+                            failures.extend(_saveMergedProfiles(
+                                    [done[p][i] for p in tasks[(y, unit)] if p in done], 
+                                    y, unit, i, filetype, compact, writes))
+                    del done
+                done_units = []
+    
+    # Units are written in the background while the next units are reduced
+    for y, unit, wpath, written in writes:
+        try:
+            written.result()
+            print('Write success for', y, unit)
+        except Exception as e:
+            failures.append([y, unit, wpath, repr(e)])
+                    
+    failures = pd.DataFrame(failures, columns=['year', 'unit', 'file', 'error'])
+    if len(failures) > 0:
+        for f in failures.itertuples():
+            print('FAILED {} {}: {} ({})'.format(f.year, f.unit, f.file, f.error))
+        writeLog(failures.copy(), 'reduce_profiles_failures')
 
-    return
+    return failures
 
 
-def loadReducedProfiles(year, unit, interval):
+def loadReducedDataset(unit, interval, year=None, profileids=None, start=None, 
+                       end=None, columns=None, recorderids=None):
+    """Loads reduced profiles from the partitioned parquet dataset written by 
+    saveReducedProfiles(filetype='parquet'). 
+    
+    Filters are pushed down to the dataset: year and month partitions outside 
+    the selection are not opened and row groups are skipped based on their 
+    ProfileID and Datefield statistics.
+    
+    Parameters:
+        unit (str): one of 'A', 'V', 'Hz', 'kVA', 'kW' 
+        interval (str): 'H' for hourly, '30T' for 30min
+        year (int or list): year(s) to load. Defaults to None (all years).
+        profileids (list): ProfileIDs to load. Defaults to None (all profiles).
+        start (str or datetime): first Datefield to load. Defaults to None.
+        end (str or datetime): last Datefield to load. Defaults to None.
+        columns (list): columns to load. Defaults to None (all columns).
+        recorderids (list): RecorderIDs to load. Defaults to None (all recorders).
+    
+    Returns:
+        pandas dataframe with columns [
+                'RecorderID', 'ProfileID', 'Datefield', 'Unitsread', 'Valid']
+    """
+    root = os.path.join(pdata_dir, interval, unit, 'parquet')
+    if not os.path.isdir(root):
+        raise FileNotFoundError('No parquet dataset in ' + root)
+
+    filters = []
+    if year is not None:
+        filters.append(('year', 'in', [year] if isinstance(year, int) else list(year)))
+    if profileids is not None:
+        filters.append(('ProfileID', 'in', [int(i) for i in profileids]))
+    if recorderids is not None:
+        filters.append(('RecorderID', 'in', [str(i) for i in recorderids]))
+    if start is not None:
+        filters.append(('Datefield', '>=', pd.Timestamp(start)))
+    if end is not None:
+        filters.append(('Datefield', '<=', pd.Timestamp(end)))
+    if start is not None and end is not None:
+        # Prune month partitions outside the date range
+        filters = [filters + [('year', '=', p.year), ('month', '=', p.month)] for p in 
+                   pd.period_range(pd.Timestamp(start), pd.Timestamp(end), freq='M')]
+    
+    table = pq.read_table(root, columns=columns, filters=filters if len(filters)>0 else None)
+    data = table.to_pandas()
+    data.drop(columns=[c for c in ['year', 'month'] if c in data.columns and (
+            columns is None or c not in columns)], inplace=True)
+    
+    return data
+
+
+def _reducedProfilesInput(year, unit, interval):
+    """Returns the path of the saved reduced profiles of a year and unit: the 
+    year partition of the parquet dataset or the feather or csv file. Returns 
+    None if the profiles have not been saved. Nothing is reduced or created.
+    """
+    dataset_path = _reducedProfilesPath(year, unit, interval, 'parquet')
+    if os.path.isdir(dataset_path):
+        return dataset_path
+    # Only files of the reduced profile filetypes, not temporary or other files
+    paths = sorted(glob(os.path.join(pdata_dir, interval, unit, str(year)+'_'+unit+'.*')))
+    paths = [p for p in paths if os.path.splitext(p)[1] in ['.feather', '.csv']]
+    try:
+        return paths[-1]
+    # Index error indicates file does not exist    
+    except IndexError:
+        return None
+
+
+def _reducedProfilesFile(year, unit, interval):
+    """Returns the path of the reduced profiles of a year and unit with 
+    _reducedProfilesInput(). The profiles are reduced and saved first if they 
+    do not exist. Raises InputError if they can not be reduced, eg because there 
+    are no raw profiles.
+    """
+    for attempt in range(2):
+        path = _reducedProfilesInput(year, unit, interval)
+        if path is not None:
+            return path
+        if attempt == 0:
+            # Save profiles to disk
+            saveReducedProfiles(year, interval)
+    
+    raise InputError(year, 'No reduced ' + unit + ' profiles for this year.')
+
+
+def _reducedProfilesReader(year, unit, interval, key='ProfileID'):
+    """Returns a function that loads the reduced profiles of a year and unit 
+    for a list of key values (ProfileIDs or RecorderIDs), together with the 
+    key values in the data.
+    
+    Parquet datasets are filtered on read. Feather files are memory-mapped and 
+    indexed by record batch, so that only the record batches that contain the 
+    key values are decoded. Other files are loaded once and sliced.
+    """
+    if os.path.isdir(_reducedProfilesPath(year, unit, interval, 'parquet')):
+        keys = loadReducedDataset(unit, interval, year, columns=[key])[key].unique()
+        def load(values):
+            selection = {'profileids' if key=='ProfileID' else 'recorderids':values}
+            return loadReducedDataset(unit, interval, year, **selection).drop_duplicates()
+        return load, keys
+    
+    file_path = _reducedProfilesFile(year, unit, interval)
+    try:
+        reader = pa.ipc.open_file(pa.memory_map(file_path))
+    except pa.ArrowInvalid:
+        reader = None
+    if reader is not None:
+        index = {}
+        for i in range(reader.num_record_batches):
+            for v in reader.get_batch(i).column(key).unique().to_pylist():
+                index.setdefault(v, []).append(i)
+        def load(values):
+            batches = sorted(set(i for v in values for i in index.get(v, [])))
+            data = pa.Table.from_batches([reader.get_batch(i) for i in batches], 
+                                         reader.schema).to_pandas()
+            return data[data[key].isin(values)].drop_duplicates()
+        return load, np.array(list(index.keys()))
+    
+    data = loadReducedProfiles(year, unit, interval)
+    data = data.iloc[np.argsort(np.asarray(data[key]), kind='mergesort')]
+    values = np.asarray(data[key])
+    def load(selection):
+        selection = np.unique(selection)
+        lo = np.searchsorted(values, selection, 'left')
+        hi = np.searchsorted(values, selection, 'right')
+        return data.iloc[np.concatenate([np.arange(l, h) for l, h in zip(lo, hi)] + [
+                np.arange(0)]).astype(int)]
+    return load, pd.unique(values)
+
+
+def loadReducedProfiles(year, unit, interval, profileids=None, start=None, end=None, 
+                        columns=None, compact=False):
     """Loads a year's unit profiles from the dir_name in profiles 
     directory into a dataframe and returns it together with the year and unit concerned.
+    
+    profileids, start, end and columns select a subset of the data. If the profiles 
+    were saved as parquet dataset, the selection is pushed down to the reader with 
+    loadReducedDataset(), otherwise it is applied after loading. If compact is True, 
+    the data is cast to the compact schema of compactProfiles().
     """    
-    file_path = None
-    while file_path is None:
-        try:
-            # Load profiles
-            file_path = glob(os.path.join(pdata_dir, interval, unit,
-                                 str(year)+'_'+unit+'.*'))[-1]
-        # Index error indicates file does not exist    
-        except IndexError:      
-            # Save profiles to disk
-            saveReducedProfiles(year, interval)
-   
+    if os.path.isdir(_reducedProfilesPath(year, unit, interval, 'parquet')):
+        data = loadReducedDataset(unit, interval, year, profileids, start, end, columns)
+        data.drop_duplicates(inplace=True)
+        if compact is True:
+            data = compactProfiles(data)
+        return data
+    
+    file_path = _reducedProfilesFile(year, unit, interval)
     try:
-        data = pd.read_csv(file_path) 
+        data = pd.read_csv(file_path, parse_dates=['Datefield']) 
     except:
         data = feather.read_dataframe(file_path)              
 
-    data.drop_duplicates(inplace=True)
+    if profileids is not None:
+        data = data[data['ProfileID'].isin(profileids)]
+    if start is not None:
+        data = data[data['Datefield'] >= pd.Timestamp(start)]
+    if end is not None:
+        data = data[data['Datefield'] <= pd.Timestamp(end)]
+    if columns is not None:
+        data = data[columns]
+    data = data.drop_duplicates()
+    if compact is True:
+        data = compactProfiles(data)
     
     return data
       
 
-def getProfilePower(year, dir_name='H'):
+def channelTopology(profiles=None, profileids=None):
+    """Builds an index of the recording channels of DLR recorders from the 
+    profiles table.
+    
+    Pre-2009 recorders have a single voltage channel (Unit of measurement 1) 
+    that is shared by up to 12 current channels. Post-2009 recorders meter each 
+    current channel with its own voltage, kVA and kW channels, which are on 
+    consecutive channel numbers: V = 2, 6, 10; A = 3, 7, 11; kVA = 4, 8, 12 and 
+    kW = 5, 9, 13.
+    
+    The channels paired by channel number are checked against the pairing by 
+    ProfileID offsets (A = V+1, kVA = V+2 and kW = V+3) that getProfilePower() 
+    used originally. If they disagree, a warning is issued and the ProfileID 
+    offsets are used.
+    
+    Parameters:
+        profiles (dataframe): profiles table. Defaults to None (loadTable('profiles')).
+        profileids (list): ProfileIDs of voltage channels that may be shared. 
+            Defaults to None (ProfileIDs returned by loadID()).
+    
+    Returns:
+        dict of pandas dataframes: 
+            'shared' with columns ['RecorderID', 'ProfileID_v']
+            'channel' with columns ['RecorderID', 'ProfileID_v', 'ProfileID_i', 
+                                    'ProfileID_kva', 'ProfileID_kw']
+    """
+    if profiles is None:
+        profiles = loadTable('profiles')
+    if profileids is None:
+        profileids = loadID()['ProfileID']
+    uom = profiles['Unit of measurement']
+    channels = profiles[['RecorderID', 'ChannelNo', 'ProfileId']].rename(
+            columns={'ProfileId':'ProfileID'})
+    
+    vchan = channels[(uom==1) & channels.ProfileID.isin(profileids)]
+    shared = vchan[['RecorderID', 'ProfileID']].rename(columns={'ProfileID':'ProfileID_v'})
+    
+    channel = channels[uom==1].rename(columns={'ProfileID':'ProfileID_v'})
+    offsets = channel[['RecorderID', 'ProfileID_v']]
+    for suffix, code, offset in [('_i', 2, 1), ('_kva', 4, 2), ('_kw', 5, 3)]:
+        c = channels[uom==code].rename(columns={'ProfileID':'ProfileID' + suffix})
+        channel = channel.merge(c.assign(ChannelNo = c.ChannelNo - offset), 
+                                on=['RecorderID', 'ChannelNo'])
+        c = c.assign(ProfileID_v = c['ProfileID' + suffix] - offset)
+        offsets = offsets.merge(c.drop(columns='ChannelNo'), on=['RecorderID', 'ProfileID_v'])
+    channel = channel.drop(columns='ChannelNo').drop_duplicates(subset='ProfileID_v')
+    offsets = offsets.drop_duplicates(subset='ProfileID_v')
+    
+    columns = ['RecorderID', 'ProfileID_v', 'ProfileID_i', 'ProfileID_kva', 'ProfileID_kw']
+    channel = channel[columns].sort_values('ProfileID_v').reset_index(drop=True)
+    offsets = offsets[columns].sort_values('ProfileID_v').reset_index(drop=True)
+    if not channel.equals(offsets):
+        differ = len(set(map(tuple, channel.values)) ^ set(map(tuple, offsets.values)))
+        warnings.warn('Channel numbers and ProfileID offsets pair {} channels differently. '
+                      'The ProfileID offsets are used.'.format(differ))
+        channel = offsets
+    
+    return {'shared':shared.reset_index(drop=True), 'channel':channel}
+
+
+def _matchKeys(left, right):
+    """Returns the positions (l, r) of all pairs of equal integer keys in left 
+    and right. This is the equivalent of an inner merge on a single integer 
+    key: pairs are ordered by the first appearance of their key in left, then 
+    by position in left and then by position in right.
+    """
+    codes, uniques = pd.factorize(left)
+    grouped = None
+    if len(uniques) < len(left):
+        # Group repeated left keys, as merge() does
+        grouped = np.argsort(codes, kind='mergesort')
+        left = left[grouped]
+    order = np.argsort(right, kind='mergesort')
+    ordered = right[order]
+    lo = np.searchsorted(ordered, left, 'left')
+    counts = np.searchsorted(ordered, left, 'right') - lo
+    l = np.repeat(np.arange(len(left)), counts)
+    within = np.arange(len(l)) - np.repeat(np.cumsum(counts) - counts, counts)
+    r = order[np.repeat(lo, counts) + within]
+    if grouped is not None:
+        l = grouped[l]
+    
+    return l, r
+
+
+def _timeCodes(*datefields):
+    """Maps Datefield columns to integer positions on their shared, sorted 
+    time axis. Returns the length of the axis and a code array per column.
+    """
+    ns = [np.asarray(d, dtype='datetime64[ns]').view(np.int64) for d in datefields]
+    axis = np.unique(np.concatenate(ns))
+    
+    return len(axis), [np.searchsorted(axis, n) for n in ns]
+
+
+def _channelKeys(profileids, channels, tcodes, ntimes):
+    """Combines the position of profileids in the channel index with time codes 
+    into integer keys. Profiles that are not in the index get the key -1.
+    """
+    pos = pd.Index(channels).get_indexer(np.asarray(profileids))
+    
+    return np.where(pos >= 0, pos * ntimes + tcodes, -1)
+
+
+def _takeColumns(data, rows, columns, suffix=''):
+    """Selects rows of columns in data as an OrderedDict of arrays."""
+    return OrderedDict([(c + suffix, data[c].take(rows).values) for c in columns])
+
+
+def getProfilePower(year, dir_name='H', topology=None):
     """Retrieves and computes kW and kVA readings for all profiles in a year.
     
     Contains important and unintuitive information about how the metered 
-    electricity data is stored in the database.
+    electricity data is stored in the database. Channels are paired with the 
+    channel index built by channelTopology() and aligned on integer keys that 
+    combine the position of a channel in the index with the position of its 
+    timestamps on a shared time axis. 
+    
+    Parameters:
+        year (int)
+        dir_name (str): interval of the reduced profiles. Defaults to 'H'.
+        topology (dict): channel index returned by channelTopology(). Defaults 
+            to None (built from the profiles table).
+    
+    Returns:
+        pandas dataframe with columns (pre-2009) [
+                'ProfileID_i', 'Datefield', 'Unitsread_i', 'Valid_i', 'RecorderID', 
+                'ProfileID_v', 'Unitsread_v', 'Valid_v', 'kw_calculated', 
+                'valid_calculated'] 
+            or (post-2009) [
+                'ProfileID_v', 'Datefield', 'Unitsread_v', 'Valid_v', 'ProfileID_i',
+                'Unitsread_i', 'Valid_i', 'RecorderID', 'ProfileID_kw', 
+                'Unitsread_kw', 'Valid_kw', 'ProfileID_kva', 'Unitsread_kva', 
+                'Valid_kva', 'kw_calculated', 'valid_calculated']
     """
-    # Get list of ProfileIDs in variable year
-    p_id = loadID()['ProfileID']   
-    # Get profile metadata (recorder ID, recording channel, recorder type, units of measurement)
-    profiles = loadTable('profiles')
+    if not 1994 <= year <= 2015:
+        return print('Year is out of range. Please select a year between 1994 and 2015')
+    if topology is None:
+        # Get profile metadata (recorder ID, recording channel, recorder type, units of measurement)
+        topology = channelTopology()
         
     # Get profile data for year
-    iprofile = loadReducedProfiles(year, 'A', dir_name)[0]    
-    vprofile = loadReducedProfiles(year, 'V', dir_name)[0]
+    units = ['A', 'V'] if year <= 2009 else ['A', 'V', 'kW', 'kVA']
+    data = {unit:loadReducedProfiles(year, unit, dir_name) for unit in units}
+    
+    return _profilePower(year, data, topology)
+
+
+def _profilePower(year, data, topology):
+    """Pairs the reduced A, V, kW and kVA profiles in the dict data with the 
+    channel index topology and computes kW readings. See getProfilePower().
+    """
+    iprofile = data['A']
+    vprofile = data['V']
+    readings = ['Unitsread', 'Valid']
     
     # Pre-2009 recorder type is set up so that up to 12 current profiles share one voltage profile
     if year <= 2009: 
-        # Get list of ProfileIDs in variable year
-        year_profiles = profiles[profiles.ProfileId.isin(p_id)] 
-        # Get metadata for voltage profiles
-        vchan = year_profiles.loc[year_profiles['Unit of measurement']==1, ['ProfileId','RecorderID']] 
-        iprofile = iprofile.merge(vchan, on='RecorderID', suffixes=('_i','_v'))
-        iprofile.rename(columns={"ProfileId": "matchcol"}, inplace=True)        
-        power = iprofile.merge(vprofile, left_on=['matchcol', 'Datefield'], 
-                               right_on=['ProfileID','Datefield'], suffixes=['_i', '_v'])
-        power.drop(['RecorderID_i', 'matchcol'], axis=1, inplace=True)
-        power.rename(columns={'RecorderID_v':'RecorderID'}, inplace=True)
+        vchan = topology['shared']
+        recorders = pd.Index(vchan.RecorderID.unique())
+        # Pair current readings with all voltage channels of their recorder
+        ipos, vpos = _matchKeys(recorders.get_indexer(np.asarray(iprofile.RecorderID)), 
+                                recorders.get_indexer(np.asarray(vchan.RecorderID)))
+        ntimes, (itime, vtime) = _timeCodes(iprofile.Datefield, vprofile.Datefield)
+        vchannels = vchan.ProfileID_v.unique()
+        ikey = _channelKeys(vchan.ProfileID_v.values[vpos], vchannels, itime[ipos], ntimes)
+        vkey = _channelKeys(vprofile.ProfileID, vchannels, vtime, ntimes)
+        l, vrows = _matchKeys(ikey, vkey)
+        irows = ipos[l]
+        
+        power = _takeColumns(iprofile, irows, ['ProfileID'], '_i')
+        power['Datefield'] = iprofile['Datefield'].take(irows).values
+        power.update(_takeColumns(iprofile, irows, readings, '_i'))
+        power.update(_takeColumns(vprofile, vrows, ['RecorderID']))
+        power.update(_takeColumns(vprofile, vrows, ['ProfileID'] + readings, '_v'))
     
     # Recorder type is set up so that each current profile has its own voltage profile
-    elif 2009 < year <= 2015:
-        vprofile['matchcol'] = vprofile['ProfileID'] + 1
-        power_temp = vprofile.merge(iprofile, left_on=['matchcol', 'Datefield'], 
-                                    right_on=['ProfileID','Datefield'], suffixes=['_v', '_i'])
-        power_temp.drop(['RecorderID_v','RecorderID_i', 'matchcol'], axis=1, inplace=True)
-        # Get kW readings
-        kwprofile = loadReducedProfiles(year, 'kW', dir_name)[0] 
-        kwprofile['matchcol'] = kwprofile['ProfileID'] - 3 #UoM = 5, ChannelNo = 5, 9, 13
-        # Get kVA readings
-        kvaprofile = loadReducedProfiles(year, 'kVA', dir_name)[0] 
-        kvaprofile['matchcol'] = kvaprofile['ProfileID'] - 2 #UoM = 4, ChannelNo = 4, 8 or 12        
-        kvaprofile.drop(columns='RecorderID',inplace=True)
-        power_temp2 = power_temp.merge(kwprofile, right_on=['matchcol', 'Datefield'],
-                                       left_on=['ProfileID_v','Datefield'])
-        power = power_temp2.merge(kvaprofile, right_on=['matchcol', 'Datefield'], 
-                                  left_on=['matchcol','Datefield'], suffixes=['_kw','_kva'])
-        power.drop(['matchcol'], axis=1, inplace=True)        
     else:
-        return print('Year is out of range. Please select a year between 1994 and 2015')
+        kwprofile = data['kW']
+        kvaprofile = data['kVA']
+        channel = topology['channel']
+        ntimes, times = _timeCodes(vprofile.Datefield, iprofile.Datefield, 
+                                   kwprofile.Datefield, kvaprofile.Datefield)
+        keys = [_channelKeys(data.ProfileID, channel['ProfileID' + suffix], t, ntimes) 
+                for data, suffix, t in zip([vprofile, iprofile, kwprofile, kvaprofile], 
+                                           ['_v', '_i', '_kw', '_kva'], times)]
+        # Align current, kW and kVA readings with voltage readings
+        vrows = np.flatnonzero(keys[0] >= 0)
+        rows = [vrows]
+        for key in keys[1:]:
+            l, r = _matchKeys(keys[0][rows[0]], key)
+            rows = [x[l] for x in rows] + [r]
+        vrows, irows, kwrows, kvarows = rows
+        
+        power = _takeColumns(vprofile, vrows, ['ProfileID'], '_v')
+        power['Datefield'] = vprofile['Datefield'].take(vrows).values
+        power.update(_takeColumns(vprofile, vrows, readings, '_v'))
+        power.update(_takeColumns(iprofile, irows, ['ProfileID'] + readings, '_i'))
+        power.update(_takeColumns(kwprofile, kwrows, ['RecorderID']))
+        power.update(_takeColumns(kwprofile, kwrows, ['ProfileID'] + readings, '_kw'))
+        power.update(_takeColumns(kvaprofile, kvarows, ['ProfileID'] + readings, '_kva'))
     
+    power = pd.DataFrame(power)
+    # Profiles reduced with the compact schema of compactProfiles() are cast back, 
+    # so that profile power and its aggregates do not depend on the schema
+    for col in power.columns:
+        if col == 'RecorderID':
+            power[col] = power[col].astype(str)
+        elif col.startswith('ProfileID'):
+            power[col] = power[col].astype(np.int64)
+        elif col != 'Datefield':
+            power[col] = power[col].astype(np.float64)
     power['kw_calculated'] = power.Unitsread_v*power.Unitsread_i*0.001
     power['valid_calculated'] = power.Valid_i * power.Valid_v
     
     return power
 
 
+def iterProfilePower(year, dir_name='H', batchsize=1, topology=None):
+    """Yields the output of getProfilePower() for batches of batchsize recorders, 
+    in order of RecorderID. Only the rows of the recorders in a batch are read 
+    from the reduced profiles, so that memory use is bounded by the largest batch 
+    rather than by the year. 
+    
+    Parquet datasets are filtered on read and feather files are memory-mapped 
+    and decoded by record batch. Csv files are loaded once.
+    
+    Parameters:
+        year (int)
+        dir_name (str): interval of the reduced profiles. Defaults to 'H'.
+        batchsize (int): number of recorders per batch. Defaults to 1.
+        topology (dict): channel index returned by channelTopology(). Defaults 
+            to None (built from the profiles table).
+    
+    Yields:
+        pandas dataframes with the columns of getProfilePower()
+    """
+    validYears(year)
+    if topology is None:
+        topology = channelTopology()
+        
+    if year <= 2009:
+        # Current channels are selected by recorder, voltage channels by profile
+        iload, recorders = _reducedProfilesReader(year, 'A', dir_name, 'RecorderID')
+        vload, vkeys = _reducedProfilesReader(year, 'V', dir_name)
+        channels = topology['shared']
+        channels = channels[channels.RecorderID.isin(recorders)]
+    else:
+        loaders = {unit:_reducedProfilesReader(year, unit, dir_name)[0] 
+                   for unit in ['A', 'kW', 'kVA']}
+        vload, vkeys = _reducedProfilesReader(year, 'V', dir_name)
+        channels = topology['channel']
+        channels = channels[channels.ProfileID_v.isin(vkeys)]
+    
+    recorders = np.sort(channels.RecorderID.unique())
+    for i in range(0, len(recorders), batchsize):
+        batch = channels[channels.RecorderID.isin(recorders[i:i+batchsize])]
+        data = {'V':vload(batch.ProfileID_v.values)}
+        if year <= 2009:
+            data['A'] = iload(recorders[i:i+batchsize])
+        else:
+            for unit, suffix in [('A', '_i'), ('kW', '_kw'), ('kVA', '_kva')]:
+                data[unit] = loaders[unit](batch['ProfileID' + suffix].values)
+        power = _profilePower(year, data, topology)
+        if len(power) > 0:
+            yield power
+
+
+def dailyHourlyMatrix(profileid, datefield, values):
+    """Arranges readings in a matrix of daily hourly profiles. Day and hour codes 
+    are computed from the epoch nanoseconds and the readings are scattered into 
+    a (profile-day x 24) array of sums and counts with bincount, which replaces 
+    groupby([ProfileID, date, hour]).mean().unstack(). NaN values are skipped.
+    
+    Parameters:
+        profileid (array): ProfileID of every reading
+        datefield (array): datetime64[ns] timestamp of every reading
+        values (array): readings
+    
+    Returns:
+        pandas dataframe indexed by ProfileID and date (datetime.date objects), 
+        with a column for every hour that has readings, sorted by ProfileID and date
+    """
+    ns = np.asarray(datefield, dtype='datetime64[ns]').view(np.int64)
+    day = ns // 86400000000000
+    hour = ns // 3600000000000 - day*24
+    pcode, profileids = pd.factorize(np.asarray(profileid), sort=True)
+    
+    # Rows with missing keys are dropped, as in groupby()
+    keep = (pcode >= 0) & (ns != np.iinfo(np.int64).min)
+    if not keep.all():
+        pcode, day, hour = pcode[keep], day[keep], hour[keep]
+        values = np.asarray(values)[keep]
+    # Combine profile and day codes into a single sortable integer key
+    dmin = day.min() if len(day) > 0 else 0
+    span = int(day.max() - dmin + 1) if len(day) > 0 else 1
+    row, rowkey = pd.factorize(pcode.astype(np.int64)*span + day - dmin, sort=True)
+    
+    values = np.asarray(values, dtype=np.float64)
+    notnull = ~np.isnan(values)
+    cell = row*24 + hour
+    total = np.bincount(cell, weights=np.where(notnull, values, 0), minlength=len(rowkey)*24)
+    count = np.bincount(cell, weights=notnull, minlength=len(rowkey)*24)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        matrix = (total / count).reshape(len(rowkey), 24)
+    hours = np.flatnonzero(np.bincount(hour, minlength=24))
+    
+    rowkey = np.asarray(rowkey, dtype=np.int64)
+    index = pd.MultiIndex.from_arrays([profileids.take(rowkey // span), 
+        (rowkey % span + dmin).astype('datetime64[D]').astype(object)], names=['ProfileID', 'date'])
+    
+    return pd.DataFrame(matrix[:, hours], index=index, columns=pd.Index(hours, name='hour'))
+
+
 def dailyHourlyProfiles(year, unit):
     """Creates a clean dataframe of daily hourly loadprofiles for year and unit.
     """
     data = loadReducedProfiles(year, unit, 'H')
-    data.drop(labels=['RecorderID'],axis=1,inplace=True)
     # VERY NB to use != 1 and NOT ==0: 
     # Valid is a mean value of 12 5min readings averaged over an hour. 
     # A single incorrect 5min reading can cause havoc. 
-    data.loc[data['Valid']!=1,'Unitsread'] = np.nan 
-    data['date'] = data.Datefield.dt.date
-    data['hour'] = data.Datefield.dt.hour
-    df = data['Unitsread'].groupby([data.ProfileID, data.date, data.hour], sort=True).mean().unstack()
-    df.columns.name = 'hour'
+    values = np.where(data['Valid']!=1, np.nan, data['Unitsread'])
     
-    return df
+    return dailyHourlyMatrix(data['ProfileID'].values, data['Datefield'].values, values)
 
 
 def resampleProfiles(dailyprofiles, interval, aggfunc = 'mean'):
-    """
+    """Resamples daily hourly profiles to interval for every ProfileID.
+    
+    Calendar intervals ('M', 'A', 'W'), fixed frequencies that divide a day 
+    (eg 'D') and custom period maps are reduced with integer period codes: the 
+    period of every date is computed once and the hourly columns are reduced 
+    per (ProfileID, period) with segment reductions. Only periods with data are 
+    returned. Other intervals and aggregation functions are resampled with 
+    groupby().resample(), which also returns empty periods.
+    
+    Parameters:
+        dailyprofiles (dataframe): output of dailyHourlyProfiles()
+        interval (str or series): pandas offset alias, or a series indexed by 
+            date that maps dates to period labels. None returns dailyprofiles.
+        aggfunc (str): one of 'mean', 'sum', 'min', 'max' or 'count' for 
+            period codes. Defaults to 'mean'.
+    
+    Returns:
+        pandas dataframe indexed by ProfileID and date (the period label that 
+        pandas resample() uses), or by ProfileID and the name of the period map
     """
     if interval is None:
         return dailyprofiles
+    how = _aggName(aggfunc)
+    if how in ['mean', 'sum', 'min', 'max', 'count'] and _periodInterval(interval):
+        return _reducePeriods(dailyprofiles, interval, how)
     else:
         df = dailyprofiles.reset_index()
         df['date'] = pd.to_datetime(df.date)
@@ -262,71 +1906,390 @@ def resampleProfiles(dailyprofiles, interval, aggfunc = 'mean'):
         return output
 
 
-def genX(year_range, drop_0=False, **kwargs):
+def _periodInterval(interval):
+    """Checks if daily profiles can be resampled to interval with period codes. 
+    Fixed frequencies must divide a day, so that their epoch aligned buckets 
+    match resample().
+    """
+    if isinstance(interval, pd.Series):
+        return True
+    offset = to_offset(interval)
+    if isinstance(offset, (pd.offsets.Tick, pd.offsets.Day)):
+        return 86400000000000 % _intervalNanos(offset) == 0
+    
+    return _arithmeticInterval(interval)
+
+
+def _reducePeriods(dailyprofiles, interval, how):
+    """Period code reduction of resampleProfiles()."""
+    dates = pd.to_datetime(dailyprofiles.index.get_level_values('date')).values
+    if isinstance(interval, pd.Series):
+        position = pd.DatetimeIndex(interval.index).get_indexer(dates)
+        label_codes, labels = pd.factorize(interval.values, sort=True)
+        bucket = np.where(position >= 0, label_codes[position], -1).astype(np.int64)
+        name = interval.name or 'period'
+    else:
+        bucket = intervalCodes(dates, interval)
+        name = 'date'
+    pcode, profileids = pd.factorize(dailyprofiles.index.get_level_values('ProfileID'), sort=True)
+    
+    keep = pcode >= 0
+    if isinstance(interval, pd.Series):
+        # Dates outside of the period map are dropped
+        keep &= bucket >= 0
+    values = dailyprofiles.to_numpy(np.float64)
+    if not keep.all():
+        pcode, bucket, values = pcode[keep], bucket[keep], values[keep]
+    
+    # Combine profile and period codes into a single sortable integer key
+    bmin = bucket.min() if len(bucket) > 0 else 0
+    span = int(bucket.max() - bmin + 1) if len(bucket) > 0 else 1
+    group, ukey = pd.factorize(pcode.astype(np.int64)*span + bucket - bmin, sort=True)
+    ngroups = len(ukey)
+    order = starts = None
+    if how in ['min', 'max']:
+        order = np.argsort(group, kind='mergesort')
+        starts = np.searchsorted(group[order], np.arange(ngroups))
+    
+    ukey = np.asarray(ukey, dtype=np.int64)
+    bucket_codes = ukey % span + bmin
+    if isinstance(interval, pd.Series):
+        periods = labels.take(bucket_codes)
+    else:
+        periods = intervalLabels(bucket_codes, interval)
+    index = pd.MultiIndex.from_arrays([profileids.take(ukey // span), periods], 
+                                      names=['ProfileID', name])
+    
+    return pd.DataFrame({c:_segmentReduce(values[:, j], group, ngroups, how, order, starts) 
+                         for j, c in enumerate(dailyprofiles.columns)}, 
+                        index=index, columns=dailyprofiles.columns)
+
+
+def _genXYear(year, interval, aggfunc, unit):
+    """Generates the rows of X for a single year, without missing values."""
+    data = resampleProfiles(dailyHourlyProfiles(year, unit), interval, aggfunc)
+    # Remove missing values
+    Xbatch = data.dropna() 
+    Xbatch.reset_index(inplace=True)
+    
+    return Xbatch
+
+
+# Version of the X cache layout. Changing it invalidates all cached X blocks.
+_x_cache_version = 2
+
+
+def _xCacheDir(interval, aggfunc, unit):
+    """Returns the directory of the X cache for a set of parameters."""
+    return os.path.join(pdata_dir, 'X', 'cache', (interval or '')+aggfunc+unit)
+
+
+def _loadXManifest(cache_dir):
+    """Loads the manifest of the X cache in cache_dir."""
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _saveXManifest(manifest, cache_dir):
+    """Saves the manifest of the X cache atomically."""
+    path = os.path.join(cache_dir, 'manifest.json')
+    with open(tempPath(path), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tempPath(path), path)
+
+
+def _xFingerprint(*values):
+    """Returns the md5 hash of json serialisable values."""
+    return hashlib.md5(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+
+def _valueRange(values):
+    """Returns the smallest and largest value of an array, or None if it is empty."""
+    if values.size == 0:
+        return None, None
+    return float(np.nanmin(values)), float(np.nanmax(values))
+
+
+def _saveXBlock(path, year, interval, aggfunc, unit):
+    """Generates the X block of a year and saves it to path.
+    
+    Returns:
+        number of rows, smallest and largest value of the block
+    """
+    Xbatch = _genXYear(year, interval, aggfunc, unit)
+    Xbatch['date'] = pd.to_datetime(Xbatch['date'])
+    Xbatch.columns = Xbatch.columns.astype(str)
+    writeAsync(path, lambda tmp_path: feather.write_dataframe(Xbatch, tmp_path)).result()
+    
+    return (len(Xbatch),) + _valueRange(Xbatch.iloc[:,2:].to_numpy(np.float64))
+
+
+def updateXCache(year_range, interval=None, aggfunc='mean', unit='A', jobs=1):
+    """Brings the X blocks of every year in year_range up to date. The X cache 
+    of a set of parameters is saved in pdata_dir/X/cache/[interval][aggfunc][unit] 
+    with a manifest that records the parameters and, for every year block, the 
+    size, modification time and md5 hash of the reduced profiles it was built 
+    from. Only blocks whose reduced profiles or parameters have changed are 
+    rebuilt. Years are independent, so if jobs > 1 the blocks are rebuilt in a 
+    pool of jobs processes.
+    
+    Returns:
+        manifest (dict) and list of rebuilt years
+    """
+    cache_dir = _xCacheDir(interval, aggfunc, unit)
+    os.makedirs(cache_dir, exist_ok=True)
+    params = {'interval':interval, 'aggfunc':aggfunc, 'unit':unit, 'version':_x_cache_version}
+    manifest = _loadXManifest(cache_dir)
+    if manifest.get('params') != params:
+        manifest = {'params':params, 'blocks':{}, 'views':{}}
+    
+    stale = OrderedDict()
+    for y in range(year_range[0], year_range[1]+1):
+        entry = manifest['blocks'].get(str(y))
+        # Resolves parquet datasets as well; profiles that have not been reduced 
+        # yet are reduced, as the block is built from them
+        signature = _fileSignature(_reducedProfilesFile(y, unit, 'H'), 
+                                   None if entry is None else entry['input'])
+        fingerprint = _xFingerprint(params, signature['md5'])
+        path = os.path.join(cache_dir, str(y) + '.feather')
+        if entry is None or entry['fingerprint'] != fingerprint or not os.path.isfile(path):
+            stale[y] = {'fingerprint':fingerprint, 'input':signature}
+        else:
+            entry['input'] = signature
+    _saveXManifest(manifest, cache_dir)
+    
+    def saved(y, block):
+        rows, minx, maxx = block
+        stale[y].update({'rows':rows, 'min':minx, 'max':maxx})
+        manifest['blocks'][str(y)] = stale[y]
+        _saveXManifest(manifest, cache_dir)
+    
+    if jobs == 1 or len(stale) < 2:
+        for y in stale.keys():
+            gc.collect() #clear any memory garbage
+            saved(y, _saveXBlock(os.path.join(cache_dir, str(y) + '.feather'), y, 
+                                 interval, aggfunc, unit))
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(stale))) as executor:
+            futures = {executor.submit(_saveXBlock, os.path.join(cache_dir, str(y) + '.feather'), 
+                                       y, interval, aggfunc, unit):y for y in stale.keys()}
+            for future in as_completed(futures):
+                saved(futures[future], future.result())
+    
+    return manifest, list(stale.keys())
+
+
+def _checkX(aggfunc, minx, maxx):
+    """Checks the value range of X for outliers. Returns an error message or None."""
+    if aggfunc != 'sum' and minx is not None:
+        if minx < 0: 
+            return 'Input dataset contains outliers and invalid data. Aborting....'
+        if maxx > 1000: 
+            return 'Input dataset may contain outliers and invalid data. Aborting....'
+    
+    return None
+
+
+def genX(year_range, drop_0=False, memmap=False, jobs=1, **kwargs):
     """Generates a dataframe of hourly daily profiles. The dataframe is indexed by 
+    ProfileID and date.
+    
+    X is assembled from year blocks in the X cache (see updateXCache()), so 
+    only years whose reduced profiles or parameters have changed are recomputed. 
+    The assembled dataframe of a year range is saved as a view of the cache, 
+    separately for drop_0, together with the fingerprints of its blocks and its 
+    value range. If the blocks have not changed, the view is loaded and checked 
+    for outliers with the recorded value range. Otherwise the blocks are 
+    concatenated once in year order.
     
     Variables:
         year_range -- [list]
         drop_0 -- boolean
+        memmap -- boolean: return a memory-mapped matrix, see genXMatrix()
+        jobs -- number of worker processes that build year blocks (default = 1)
         **kwargs -- interval (options = M, A, None; default = None)
                   aggfunc (default = mean)
                   unit (default = A)
-                  filetype (default = feather)
-    """
-    if 'interval' in kwargs: 
-        interval = kwargs['interval'] 
-        intstr = interval
-    else: 
-        interval = None
-        intstr = ''
-        
-    if 'aggfunc' in kwargs: aggfunc = kwargs['aggfunc']
-    else: aggfunc = 'mean'
-        
-    if 'unit' in kwargs: unit = kwargs['unit']
-    else: unit = 'A'
-        
-    if 'filetype' in kwargs: filetype = kwargs['filetype']
-    else: filetype = 'feather'
+    """
+    if memmap == True:
+        return genXMatrix(year_range, drop_0, jobs, **kwargs)
+    
+    interval = kwargs.get('interval', None)
+    aggfunc = kwargs.get('aggfunc', 'mean')
+    unit = kwargs.get('unit', 'A')
     
     gc.collect()
-   
-    try:
-        # Check if file exists
-        xpath = glob(os.path.join(pdata_dir, 'X', str(year_range[0])+'_'+
-                                  str(year_range[1])+intstr+aggfunc+unit+'.*'))[-1] 
+    
+    manifest, rebuilt = updateXCache(year_range, interval, aggfunc, unit, jobs)
+    cache_dir = _xCacheDir(interval, aggfunc, unit)
+    years = [str(y) for y in range(year_range[0], year_range[1]+1)]
+    name = str(year_range[0])+'_'+str(year_range[1]) + ('_drop0' if drop_0 == True else '')
+    fingerprint = _xFingerprint([manifest['blocks'][y]['fingerprint'] for y in years], 
+                                drop_0 == True)
+    xpath = os.path.join(cache_dir, name + '.feather')
+    view = manifest['views'].get(name)
+    
+    if view is not None and view['fingerprint'] == fingerprint and os.path.isfile(xpath):
         X = feather.read_dataframe(xpath)
-        
-    except IndexError:
-        xpath = os.path.join(pdata_dir, 'X', str(year_range[0])+'_'+
-                                  str(year_range[1])+intstr+aggfunc+unit+'.'+filetype)
-        X = pd.DataFrame()
-        
-        for y in range(year_range[0], year_range[1]+1):
-            data = resampleProfiles(dailyHourlyProfiles(y, unit), interval, aggfunc)
-            # Remove missing values
-            Xbatch = data.dropna() 
-            Xbatch.reset_index(inplace=True)
-            X = X.append(Xbatch)
-        
-        X.reset_index(drop=True, inplace=True)
-        X['date'] = pd.to_datetime(X['date'])
-        feather.write_dataframe(X, xpath)
-        
-        if aggfunc != 'sum':
-            minx = X.iloc[:,2::].min()
-            maxx = X.iloc[:,2::].max()
-                
-            if len(minx[minx<0]) != 0: return print('Input dataset contains \
-                  outliers and invalid data. Aborting....')
-            if len(maxx[maxx>1000]) != 0: return print('Input dataset may contain \
-                  outliers and invalid data. Aborting....')
-      
-    X.set_index(['ProfileID','date'], inplace=True)
+    else:
+        X = pd.concat([feather.read_dataframe(os.path.join(cache_dir, y + '.feather')) 
+                       for y in years], ignore_index=True)
+        X.set_index(['ProfileID','date'], inplace=True)
+        # Clean and shape X by requirements
+        if drop_0 == True:
+            print('dropping all zero rows')
+            X = X[~(X.sum(axis=1)==0)]
+        # X is written in the background while its value range is computed
+        written = writeAsync(xpath, lambda tmp_path: feather.write_dataframe(X, tmp_path))
+        minx, maxx = _valueRange(X.to_numpy(np.float64))
+        written.result()
+        view = {'fingerprint':fingerprint, 'rows':len(X), 'min':minx, 'max':maxx}
+        manifest['views'][name] = view
+        _saveXManifest(manifest, cache_dir)
     
-    # Clean and shape X by requirements
-    if drop_0 == True:
-        print('dropping all zero rows')
-        X = X[~(X.sum(axis=1)==0)]
+    error = _checkX(aggfunc, view['min'], view['max'])
+    if error is not None:
+        return print(error)
         
     return X
+
+
+def _writeXMatrix(tmp_path, cache_dir, years, meta):
+    """Streams the cached X blocks of years into a float32 matrix file in 
+    tmp_path and saves the ProfileID, date and non-zero row side arrays and 
+    metadata.
+    
+    The matrix has the union of the columns of all blocks in order of appearance, 
+    as pd.concat() in genX(). Columns that a block does not have are NaN.
+    """
+    os.makedirs(tmp_path)
+    paths = [os.path.join(cache_dir, y + '.feather') for y in years]
+    # Column names are read from the block schemas without loading the blocks
+    columns = []
+    for path in paths:
+        names = pa.ipc.open_file(pa.memory_map(path)).schema.names
+        columns.extend(c for c in names[2:] if c not in columns)
+    profileids = []
+    dates = []
+    nonzero = []
+    rows = 0
+    with open(os.path.join(tmp_path, 'X.f32'), 'wb') as f:
+        for path in paths:
+            Xbatch = feather.read_dataframe(path)
+            values = Xbatch.reindex(columns=columns).to_numpy(np.float64)
+            f.write(values.astype(np.float32).tobytes())
+            profileids.append(Xbatch['ProfileID'].to_numpy(np.int64))
+            dates.append(Xbatch['date'].values)
+            nonzero.append(np.nansum(values, axis=1) != 0)
+            rows += len(values)
+            del Xbatch, values
+    np.save(os.path.join(tmp_path, 'ProfileID.npy'), np.concatenate(profileids))
+    np.save(os.path.join(tmp_path, 'date.npy'), np.concatenate(dates).astype('datetime64[ns]'))
+    np.save(os.path.join(tmp_path, 'nonzero.npy'), np.concatenate(nonzero))
+    meta.update({'shape':[rows, len(columns)], 'dtype':'float32', 'columns':columns})
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def genXMatrix(year_range, drop_0=False, jobs=1, **kwargs):
+    """Generates X as an on-disk float32 matrix that is memory-mapped rather than 
+    loaded, for datasets that do not fit in memory. The matrix is streamed from 
+    the year blocks of the X cache (see updateXCache()) one year at a time and 
+    saved in the cache as [start]_[end]_matrix. It is rebuilt when any of its 
+    blocks has changed.
+    
+    Parameters:
+        year_range (list): [start year, end year]
+        drop_0 (bool): exclude all zero rows. Defaults to False.
+        jobs (int): number of worker processes that build year blocks. Defaults to 1.
+        **kwargs: interval, aggfunc and unit, see genX()
+    
+    Returns:
+        dict, see loadXMatrix(). None if X contains outliers or invalid data.
+    """
+    interval = kwargs.get('interval', None)
+    aggfunc = kwargs.get('aggfunc', 'mean')
+    unit = kwargs.get('unit', 'A')
+    
+    manifest, rebuilt = updateXCache(year_range, interval, aggfunc, unit, jobs)
+    cache_dir = _xCacheDir(interval, aggfunc, unit)
+    years = [str(y) for y in range(year_range[0], year_range[1]+1)]
+    blocks = [manifest['blocks'][y] for y in years]
+    fingerprint = _xFingerprint([b['fingerprint'] for b in blocks])
+    xpath = os.path.join(cache_dir, str(year_range[0])+'_'+str(year_range[1])+'_matrix')
+    try:
+        with open(os.path.join(xpath, 'meta.json')) as f:
+            current = json.load(f).get('fingerprint') == fingerprint
+    except (FileNotFoundError, ValueError):
+        current = False
+    if current is False:
+        ranges = [b for b in blocks if b['min'] is not None]
+        meta = {'fingerprint':fingerprint, 'year_range':list(year_range), 
+                'interval':interval, 'aggfunc':aggfunc, 'unit':unit, 
+                'min':min([b['min'] for b in ranges], default=None), 
+                'max':max([b['max'] for b in ranges], default=None)}
+        writeAsync(xpath, lambda tmp_path: _writeXMatrix(tmp_path, cache_dir, years, 
+                                                          meta)).result()
+    xmatrix = loadXMatrix(xpath, drop_0)
+    
+    meta = xmatrix['meta']
+    error = _checkX(aggfunc, meta['min'], meta['max'])
+    if error is not None:
+        return print(error)
+    
+    return xmatrix
+
+
+def loadXMatrix(xpath, drop_0=False):
+    """Memory-maps an X matrix saved by genXMatrix().
+    
+    Parameters:
+        xpath (str): matrix directory
+        drop_0 (bool): exclude all zero rows. Defaults to False.
+    
+    Returns:
+        dict with keys 'X' (read-only float32 memmap of shape rows x columns), 
+        'ProfileID' and 'date' (side arrays with a value for every row), 
+        'columns', 'rows' (indices of the rows to use) and 'meta'
+    """
+    with open(os.path.join(xpath, 'meta.json')) as f:
+        meta = json.load(f)
+    rows = meta['shape'][0]
+    if rows > 0:
+        X = np.memmap(os.path.join(xpath, 'X.f32'), dtype=meta['dtype'], mode='r', 
+                      shape=tuple(meta['shape']))
+    else:
+        X = np.empty(meta['shape'], dtype=meta['dtype'])
+    if drop_0 == True:
+        select = np.flatnonzero(np.load(os.path.join(xpath, 'nonzero.npy')))
+    else:
+        select = np.arange(rows)
+    
+    return {'X':X, 'ProfileID':np.load(os.path.join(xpath, 'ProfileID.npy'), mmap_mode='r'), 
+            'date':np.load(os.path.join(xpath, 'date.npy'), mmap_mode='r'), 
+            'columns':meta['columns'], 'rows':select, 'meta':meta}
+
+
+def iterXBatches(xmatrix, batchsize=1024, shuffle=False, seed=None):
+    """Iterates over the rows of an X matrix in batches, eg for training loops, 
+    without loading the whole matrix. 
+    
+    Parameters:
+        xmatrix (dict): output of genXMatrix() or loadXMatrix()
+        batchsize (int): rows per batch. Defaults to 1024.
+        shuffle (bool): yield rows in random order. Defaults to False (row order).
+        seed (int): random seed for shuffling
+    
+    Yields:
+        tuple of numpy arrays (X, ProfileID, date) of a batch
+    """
+    rows = xmatrix['rows']
+    if shuffle == True:
+        rows = np.random.RandomState(seed).permutation(rows)
+    for i in range(0, len(rows), batchsize):
+        batch = rows[i:i+batchsize]
+        yield (np.asarray(xmatrix['X'][batch]), np.asarray(xmatrix['ProfileID'][batch]), 
+               np.asarray(xmatrix['date'][batch]))
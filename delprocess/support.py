@@ -12,6 +12,11 @@ import os
 from pathlib import Path
 import datetime as dt
 import pandas as pd
+import shutil
+import queue
+import threading
+import atexit
+from concurrent.futures import Future
 
 import shapefile as shp
 from shapely.geometry import Point
@@ -182,6 +187,109 @@ def writeLog(log_line, file_name):
         print('Log file created and log entries added to log/' + file_name + '.csv\n')    
     return log_line
 
+# Maximum number of outputs waiting to be written and number of writer threads
+write_queue_size = 4
+write_threads = 2
+_write_queue = None
+_write_lock = threading.Lock()
+
+
+def _removePath(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def tempPath(path):
+    """Returns the temporary path to which an output is written before it is 
+    renamed to path. The temporary path is hidden and lies in the same directory, 
+    so that globs over the output directory and dataset readers do not pick up 
+    partially written outputs, and the rename stays on the same filesystem.
+    """
+    dir_path, name = os.path.split(path)
+    return os.path.join(dir_path, '.' + name + '.tmp')
+
+
+def _writerLoop(write_queue):
+    """Writes queued outputs to temporary paths and renames them on completion."""
+    while True:
+        future, path, write = write_queue.get()
+        tmp_path = tempPath(path)
+        try:
+            if future.set_running_or_notify_cancel():
+                _removePath(tmp_path)
+                write(tmp_path)
+                if os.path.isdir(tmp_path):
+                    # Directories such as parquet datasets can not be replaced atomically
+                    _removePath(path)
+                os.replace(tmp_path, path)
+                future.set_result(path)
+        except BaseException as e:
+            _removePath(tmp_path)
+            future.set_exception(e)
+        finally:
+            write_queue.task_done()
+            del future, write
+
+
+def writeAsync(path, write):
+    """
+    This function writes an output file in a background writer thread, so that 
+    the caller can continue computing while the output is serialised. 
+    
+    *input*
+    -------
+    path (str): output path
+    write (function): called with a temporary path to which it must write the 
+        output. The temporary file (or directory) is renamed to path once it is 
+        complete, so that path never holds a partially written output.
+    
+    Outputs are queued in a queue of write_queue_size outputs that is drained by 
+    write_threads threads. The caller blocks while the queue is full. 
+    
+    Returns a concurrent.futures.Future that resolves to path or raises the 
+    error of the write.
+    """
+    global _write_queue
+    with _write_lock:
+        if _write_queue is None:
+            _write_queue = queue.Queue(maxsize=write_queue_size)
+            for i in range(write_threads):
+                threading.Thread(target=_writerLoop, args=(_write_queue,), 
+                                 daemon=True).start()
+    future = Future()
+    _write_queue.put((future, path, write))
+    
+    return future
+
+
+def flushWrites():
+    """
+    This function blocks until all outputs queued with writeAsync() have been 
+    written. Errors are reported by the futures returned by writeAsync().
+    """
+    if _write_queue is not None:
+        _write_queue.join()
+
+
+# Outputs that are still queued when python exits are written before exiting
+atexit.register(flushWrites)
+
+
+def _resetWriter():
+    """Writer threads are not inherited by forked processes, eg process pool 
+    workers, so the child starts its own queue and threads on its first write.
+    """
+    global _write_queue, _write_lock
+    _write_queue = None
+    _write_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_resetWriter)
+
+
 def geoMeta():
     """
     This function generates geographic metadata for groups by combining GroupID 
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module generates synthetic DEL data in the local directory structure of
+the DLR observations, so that the processing pipeline can be run and
+benchmarked without access to the DLR database.
+
+The synthetic data mimics both recorder topologies of the DLR:
+    - pre-2009 (year <= 2009): one voltage channel per recorder is shared by up
+      to 12 current channels, each of which meters a household
+    - post-2009: each household is metered by its own V, A, kVA and kW channels,
+      with consecutive ProfileIDs. A recorder meters 3 households and has one
+      Hz channel.
+
+The data directory has the structure expected by delprocess.support:
+    |-- data_dir
+        |-- observations
+            |-- profiles
+                |-- raw
+                    |-- unit
+                        |-- year
+                            |-- year-month_GGroupID_unit.csv
+            |-- tables
+                |-- profiles.csv, links.csv, groups.csv, questions.csv,
+                    answers.csv, answers_*_anonymised.csv
+        |-- home/del_data/usr (see syntheticHome())
+            |-- store_path.txt
+            |-- specs
+"""
+
+import numpy as np
+import pandas as pd
+import os
+import shutil
+import calendar
+
+# Units of measurement codes in the profiles table
+uom = {'V':1, 'A':2, 'Hz':3, 'kVA':4, 'kW':5}
+
+# Numeric survey questions with (min, max) answer values. QuestionaireID 1 is
+# used for 1994 - 1999 and QuestionaireID 3 for 2000 - 2014. The questions
+# match the searchlist of the binned_base feature specifications.
+survey_questions = {
+        1: [('income', 0, 12000), ('watersource', 0, 3), ('roof', 0, 10),
+            ('wall', 0, 10), ('main switch', 20, 80), ('floor area', 20, 400)],
+        3: [('earn per month', 0, 40000), ('watersource', 1, 4), ('roof', 1, 11),
+            ('wall', 1, 11), ('main switch', 20, 80), ('floor area', 20, 400)]}
+
+
+def _readingTimes(year, month, days):
+    """Returns the 5min reading timestamps of the first days of a month."""
+    days = min(days, calendar.monthrange(year, month)[1])
+    return pd.date_range('{}-{}-01'.format(year, month), periods=days*288, freq='5T')
+
+
+def _currentReadings(times, households, rng):
+    """Returns an array of shape (households, len(times)) of current readings
+    with a base load, morning and evening peaks and higher winter demand.
+    """
+    hour = (times.hour + times.minute/60).values
+    daily = (np.exp(-0.5*((hour - 7)/1.2)**2) +
+             1.6*np.exp(-0.5*((hour - 19)/1.8)**2))
+    winter = 1.3 if times[0].month in [5, 6, 7, 8] else 1.0
+    base = rng.uniform(0.2, 1.5, (households, 1))
+    peak = rng.uniform(1, 12, (households, 1))
+    noise = rng.gamma(2, 0.3, (households, len(times)))
+
+    return np.clip(base + winter*peak*daily + noise - 0.6, 0, None)
+
+
+def _rawFrame(recorderid, profileids, times, readings, rng, missing=0.001,
+              invalid=0.0002):
+    """Formats readings of shape (len(profileids), len(times)) as raw profiles.
+    Timestamps are jittered by up to 400ms, a fraction of readings is dropped
+    and a fraction is flagged as invalid.
+    """
+    n = len(times)
+    ns = np.tile(times.values.view(np.int64), len(profileids))
+    ns = ns + rng.randint(-4, 5, len(ns))*100000000
+    data = pd.DataFrame({'RecorderID':recorderid,
+                         'ProfileID':np.repeat(profileids, n),
+                         'Datefield':ns.view('datetime64[ns]'),
+                         'Unitsread':np.round(readings.ravel(), 3),
+                         'Valid':np.where(rng.rand(len(ns)) < invalid, 'N ', 'Y ')})
+
+    return data[rng.rand(len(data)) >= missing]
+
+
+def _writeRawFile(data, obs_dir, unit, year, month, groupid):
+    """Writes a raw profile file and returns the number of rows written."""
+    dir_path = os.path.join(obs_dir, 'profiles', 'raw', unit, str(year))
+    os.makedirs(dir_path, exist_ok=True)
+    data.to_csv(os.path.join(dir_path, '{}-{}_G{}_{}.csv'.format(year, month, groupid, unit)),
+                index=False, date_format='%Y-%m-%d %H:%M:%S.%f')
+
+    return len(data)
+
+
+def _surveyTables(answers):
+    """Generates the questions, answers and anonymised answer tables for a
+    dataframe of AnswerIDs and QuestionaireIDs.
+    """
+    rng = np.random.RandomState(len(answers))
+    questions = []
+    number = answers[['AnswerID']].copy()
+    number['lock'] = 0
+    for q, qu in survey_questions.items():
+        for i, (question, low, high) in enumerate(qu):
+            questions.append([len(questions) + 1, q, question, 'num', i + 1,
+                              question.replace(' ', '_'), 0])
+    # Questionaires share the ColumnNo of the anonymised answer tables
+    for i in range(max(len(qu) for qu in survey_questions.values())):
+        values = np.full(len(answers), np.nan)
+        for q, qu in survey_questions.items():
+            select = (answers.QuestionaireID == q).values
+            if i < len(qu):
+                values[select] = rng.randint(qu[i][1], qu[i][2] + 1, select.sum())
+        number[str(i + 1)] = values
+    for dt in ['blob', 'char']:
+        for q in survey_questions.keys():
+            questions.append([len(questions) + 1, q, 'interviewer comments', dt, 1,
+                              'comments', 0])
+    questions = pd.DataFrame(questions, columns=['QuestionID', 'QuestionaireID',
+                                                 'Question', 'Datatype', 'ColumnNo',
+                                                 'ColumnAlias', 'lock'])
+    text = answers[['AnswerID']].copy()
+    text['lock'] = 0
+    text['1'] = 'none'
+    answers = answers.copy()
+    answers['lock'] = 0
+
+    return {'questions':questions, 'answers':answers, 'answers_number_anonymised':number,
+            'answers_char_anonymised':text, 'answers_blob_anonymised':text}
+
+
+def generateSyntheticData(data_dir, years=[2008, 2012], groups=2, households=12,
+                          months=[1], days=7, seed=0):
+    """Generates synthetic raw profiles, database tables and survey responses
+    in data_dir. Years up to 2009 use the shared-voltage recorder topology and
+    later years use per-household channels.
+
+    Parameters:
+        data_dir (str): root directory of the synthetic data
+        years (list): survey years, 1994 <= year <= 2014
+        groups (int): number of groups (survey sites) per year
+        households (int): number of metered households per group
+        months (list): months with readings
+        days (int): number of days with readings per month
+        seed (int): random seed
+
+    Returns:
+        pandas dataframe with columns ['year', 'unit', 'files', 'rows'] counting
+        the raw profile files and rows generated. It is also saved to
+        data_dir/observations/synthetic.csv
+    """
+    rng = np.random.RandomState(seed)
+    obs_dir = os.path.join(data_dir, 'observations')
+    os.makedirs(os.path.join(obs_dir, 'tables'), exist_ok=True)
+    this_dir = os.path.dirname(__file__)
+    sites = pd.read_csv(os.path.join(this_dir, 'data', 'geometa', 'site_geo.csv'))
+
+    profiles = []
+    links = []
+    group_table = []
+    answers = []
+    counts = []
+    profileid = 1
+    for year in years:
+        pre2009 = year <= 2009
+        questionaireid = 1 if year < 2000 else 3
+        # Households per recorder and channels per household
+        per_recorder = 12 if pre2009 else 3
+        for g in range(groups):
+            groupid = len(group_table) + 1
+            site = sites.iloc[rng.randint(len(sites))]
+            group_table.append([groupid, groupid, 'Dom', 'Synthetic DLR', year,
+                                site.GPSName, site.GPSName])
+            recorders = []
+            for r in range(int(np.ceil(households/per_recorder))):
+                recorderid = 'SYN{:04d}{:02d}'.format(groupid, r)
+                n = min(per_recorder, households - r*per_recorder)
+                channels = {}
+                if pre2009:
+                    channels['V'] = [profileid]
+                    channels['A'] = list(range(profileid + 1, profileid + 1 + n))
+                    chan_no = {'V':[1], 'A':list(range(2, 2 + n))}
+                    households_ids = [[p] for p in channels['A']]
+                    profileid += 1 + n
+                else:
+                    channels['Hz'] = [profileid]
+                    first = np.arange(n)*4 + profileid + 1
+                    for k, unit in enumerate(['V', 'A', 'kVA', 'kW']):
+                        channels[unit] = list(first + k)
+                    chan_no = {'Hz':[1]}
+                    for k, unit in enumerate(['V', 'A', 'kVA', 'kW']):
+                        chan_no[unit] = list(np.arange(n)*4 + 2 + k)
+                    households_ids = [[int(p + k) for k in range(4)] for p in first]
+                    profileid += 1 + 4*n
+                for unit, pids in channels.items():
+                    for p, c in zip(pids, chan_no[unit]):
+                        profiles.append([int(p), recorderid, int(c),
+                                         'pre-2009' if pre2009 else 'post-2009',
+                                         uom[unit], 1, np.nan, 0])
+                        links.append([len(links) + 1, 0, 0, groupid, int(p)])
+                for pids in households_ids:
+                    answerid = 1000000 + len(answers) + 1
+                    answers.append([answerid, questionaireid])
+                    for p in pids:
+                        links.append([len(links) + 1, 0, answerid, 0, p])
+                recorders.append((recorderid, channels))
+
+            for month in months:
+                times = _readingTimes(year, month, days)
+                raw = {}
+                for recorderid, channels in recorders:
+                    current = _currentReadings(times, len(channels['A']), rng)
+                    volts = (230 + 6*np.sin(np.arange(len(times))*2*np.pi/288) +
+                             rng.normal(0, 1.5, (len(channels['V']), len(times))))
+                    readings = {'A':current, 'V':volts}
+                    if not pre2009:
+                        readings['kVA'] = volts*current*0.001
+                        readings['kW'] = readings['kVA']*rng.uniform(0.85, 0.98,
+                                                                     (len(current), 1))
+                        readings['Hz'] = 50 + rng.normal(0, 0.05, (1, len(times)))
+                    for unit, values in readings.items():
+                        raw.setdefault(unit, []).append(_rawFrame(
+                                recorderid, channels[unit], times, values, rng))
+                for unit, frames in raw.items():
+                    rows = _writeRawFile(pd.concat(frames), obs_dir, unit, year,
+                                         month, groupid)
+                    counts.append([year, unit, 1, rows])
+
+    tables = {
+        'profiles':pd.DataFrame(profiles, columns=['ProfileId', 'RecorderID', 'ChannelNo',
+                                                   'Type', 'Unit of measurement', 'Active',
+                                                   'aux', 'lock']),
+        'links':pd.DataFrame(links, columns=['ConsumerID', 'lock', 'AnswerID', 'GroupID',
+                                             'ProfileID']),
+        'groups':pd.DataFrame(group_table, columns=['GroupID', 'ContextID', 'Dom_NonDom',
+                                                    'Survey', 'Year', 'Location', 'LocName'])}
+    tables.update(_surveyTables(pd.DataFrame(answers, columns=['AnswerID', 'QuestionaireID'])))
+    for name, table in tables.items():
+        table.to_csv(os.path.join(obs_dir, 'tables', name + '.csv'), index=False)
+
+    counts = pd.DataFrame(counts, columns=['year', 'unit', 'files', 'rows']
+                          ).groupby(['year', 'unit'], as_index=False).sum()
+    counts.to_csv(os.path.join(obs_dir, 'synthetic.csv'), index=False)
+
+    return counts
+
+
+def syntheticHome(data_dir):
+    """Creates a user directory in data_dir/home that points delprocess to the
+    synthetic observations in data_dir. Processes that run with the HOME
+    environment variable set to this directory read and write synthetic data
+    only. The feature specification files of the package are copied to the
+    user directory.
+
+    Returns:
+        path of the home directory
+    """
+    home_dir = os.path.join(data_dir, 'home')
+    usr_dir = os.path.join(home_dir, 'del_data', 'usr')
+    os.makedirs(os.path.join(usr_dir, 'specs'), exist_ok=True)
+    with open(os.path.join(usr_dir, 'store_path.txt'), 'w') as f:
+        f.write(os.path.join(os.path.abspath(data_dir), 'observations'))
+    spec_dir = os.path.join(os.path.dirname(__file__), 'data', 'specs')
+    for spec in os.listdir(spec_dir):
+        shutil.copy(os.path.join(spec_dir, spec), os.path.join(usr_dir, 'specs'))
+
+    return home_dir
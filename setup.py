@@ -24,17 +24,20 @@ setup(
       author='Wiebke Toussaint',
       author_email='wiebke.toussaint@gmail.com',
       license='CC-BY-NC',
-      install_requires=['pandas','numpy','pyodbc','feather-format','plotly', 
+      install_requires=['pandas','numpy','pyodbc','feather-format','pyarrow','plotly', 
                         'pathlib','pyshp','shapely'],
       include_package_data=True,
       packages=find_packages(),
       py_modules = ['delprocess.surveys', 'delprocess.loadprofiles', 
-                    'delprocess.plotprofiles', 'delprocess.aggprofiles'],
+                    'delprocess.plotprofiles', 'delprocess.aggprofiles', 
+                    'delprocess.synthetic', 'delprocess.benchmark'],
       data_files=[(os.path.join(usr_dir,'specs'), [os.path.join(
                   'delprocess','data','specs', f) for f in [files for root, dirs, files 
                     in os.walk(os.path.join('delprocess','data','specs'))][0]])],
       entry_points = {
 			'console_scripts': ['delprocess_profiles=delprocess.command_line:process_profiles',
-                       'delprocess_surveys=delprocess.command_line:process_surveys'],
+                       'delprocess_surveys=delprocess.command_line:process_surveys',
+                       'delprocess_aggprofiles=delprocess.command_line:process_aggprofiles',
+                       'delprocess_benchmark=delprocess.command_line:process_benchmark'],
                        }
       )
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression tests run on synthetic DEL data generated with delprocess.synthetic.
+
+delprocess reads its data directory from USER_HOME/del_data/usr/store_path.txt
+when it is imported, so HOME is pointed at a synthetic user directory before
+any delprocess module is imported.
+"""
+
+import os
+import shutil
+import tempfile
+import pytest
+
+_data_dir = tempfile.mkdtemp(prefix='delprocess_test_')
+os.makedirs(os.path.join(_data_dir, 'observations'))
+os.makedirs(os.path.join(_data_dir, 'home', 'del_data', 'usr'))
+with open(os.path.join(_data_dir, 'home', 'del_data', 'usr', 'store_path.txt'), 'w') as f:
+    f.write(os.path.join(_data_dir, 'observations'))
+os.environ['HOME'] = os.path.join(_data_dir, 'home')
+
+from delprocess.synthetic import generateSyntheticData, syntheticHome
+
+
+@pytest.fixture(scope='session')
+def data_dir():
+    """Synthetic raw profiles for a pre-2009 and a post-2009 year."""
+    generateSyntheticData(_data_dir, years=[2008, 2012], groups=2, households=6, 
+                          months=[1], days=3)
+    syntheticHome(_data_dir)
+    yield _data_dir
+    shutil.rmtree(_data_dir, ignore_errors=True)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+from glob import glob
+import numpy as np
+import pandas as pd
+import pytest
+
+from delprocess import aggprofiles
+from delprocess.loadprofiles import saveReducedProfiles, getProfilePower, _reducedProfilesInput
+from delprocess.aggprofiles import (generateAggProfiles, readAggProfiles, intervalCalendar, 
+                                    aggProfilePower, annualIntervalDemand, mergeDemand, 
+                                    poolMoments, momentStd, daytypeCube, mergeDaytypeCubes, 
+                                    cubeDaytypeDemand, aggDaytypeDemand, kwSketch, 
+                                    mergeSketches, sketchQuantiles, generateAggProfilesMulti, 
+                                    _artifactInputs)
+
+
+def _profilePower(year):
+    saveReducedProfiles(year, 'H', 'feather')
+    return getProfilePower(year)
+
+
+def test_readaggprofiles_returns_independent_copies(data_dir):
+    generateAggProfiles(2012)
+    expected = readAggProfiles(2012, 'adtd').copy()
+    data = readAggProfiles(2012, 'adtd')
+    # Writes into the column buffers in place
+    data['kw_mean'].values[:] = -1
+    
+    pd.testing.assert_frame_equal(readAggProfiles(2012, 'adtd'), expected)
+
+
+@pytest.mark.parametrize('year', [2008, 2012])
+def test_compact_profiles_give_the_same_artifacts(data_dir, year):
+    artifacts = ['pp', 'aggpp_M', 'aMd', 'adtd', 'kw_sketch']
+    outputs = {}
+    try:
+        for compact in [False, True]:
+            saveReducedProfiles(year, 'H', 'feather', compact=compact)
+            for batchsize in [None, 1]:
+                generateAggProfiles(year, batchsize=batchsize, force=True)
+                outputs[(compact, batchsize)] = {a:readAggProfiles(year, a) for a in artifacts}
+    finally:
+        saveReducedProfiles(year, 'H', 'feather')
+    
+    expected = outputs.pop((False, None))
+    for output in outputs.values():
+        for a in artifacts:
+            # Compact profiles store readings as float32
+            pd.testing.assert_frame_equal(output[a], expected[a], rtol=1e-4)
+
+
+def test_artifact_inputs_cover_parquet_datasets(data_dir, tmp_path):
+    saveReducedProfiles(2008, 'H', 'feather')
+    reduced = {unit:_reducedProfilesInput(2008, unit, 'H') for unit in ['A', 'V']}
+    moved = {unit:str(tmp_path / os.path.basename(path)) for unit, path in reduced.items()}
+    try:
+        saveReducedProfiles(2008, 'H', 'parquet')
+        for unit, path in reduced.items():
+            shutil.move(path, moved[unit])
+        inputs = list(_artifactInputs(2008, 'H').keys())
+        
+        for unit in ['A', 'V']:
+            assert any(os.path.join(unit, 'parquet', 'year=2008') in i for i in inputs)
+            # Inputs are resolved without reducing the profiles again
+            assert glob(os.path.join(os.path.dirname(reduced[unit]), '2008_*')) == []
+    finally:
+        for unit in ['A', 'V']:
+            shutil.rmtree(os.path.join(os.path.dirname(reduced[unit]), 'parquet'), 
+                          ignore_errors=True)
+            if os.path.exists(moved[unit]):
+                shutil.move(moved[unit], reduced[unit])
+
+
+def test_saving_identical_reduced_profiles_keeps_artifacts(data_dir):
+    saveReducedProfiles(2008, 'H', 'feather')
+    generateAggProfiles(2008)
+    saveReducedProfiles(2008, 'H', 'feather')
+    
+    assert generateAggProfiles(2008) == []
+
+
+def test_pooled_moments_match_numpy():
+    rng = np.random.RandomState(0)
+    x = rng.gamma(2., 3., 1000)
+    parts = np.split(x, [0, 1, 300, 300, 999])
+    count = np.array([len(p) for p in parts])
+    mean = np.array([p.mean() if len(p) > 0 else np.nan for p in parts])
+    m2 = np.array([((p - p.mean())**2).sum() if len(p) > 0 else 0. for p in parts])
+    
+    n, pooled, pooled_m2 = poolMoments(count, mean, m2)
+    assert n == len(x)
+    assert np.isclose(pooled, x.mean())
+    assert np.isclose(pooled_m2, ((x - x.mean())**2).sum())
+    assert np.isclose(momentStd(n, pooled_m2), x.std(ddof=1))
+
+
+@pytest.mark.parametrize('year', [2008, 2012])
+def test_daytype_demand_matches_groupby(data_dir, year):
+    pp = _profilePower(year)
+    kw = 'Unitsread_kw' if year > 2009 else 'kw_calculated'
+    calendar = intervalCalendar(pp['Datefield'], 'H')
+    keys = ['ProfileID_i', 'month', 'daytype', 'hour']
+    grouped = pp.assign(**{k:calendar[k].values for k in keys[1:]}).groupby(keys, observed=True)
+    expected = grouped[kw].agg(['mean', 'std', 'count'])
+    expected.columns = ['kw_mean', 'kw_std', 'kw_count']
+    expected['valid_hours'] = grouped['valid_calculated'].sum()
+    expected['total_hours_sum'] = grouped.size()
+    expected = expected.reset_index()
+    
+    demand = aggDaytypeDemand(pp)
+    # Cells of observed months and hours without readings of a profile are kept
+    demand = demand[demand['total_hours_sum'] > 0].reset_index(drop=True)
+    pd.testing.assert_frame_equal(demand[expected.columns], expected, check_dtype=False, 
+                                  check_categorical=False)
+    
+    # Cubes of batches of readings merge to the cube of all readings
+    cubes = [daytypeCube(batch) for batch in np.array_split(pp, 3)]
+    pd.testing.assert_frame_equal(cubeDaytypeDemand(mergeDaytypeCubes(cubes)), 
+                                  aggDaytypeDemand(pp), check_dtype=False)
+
+
+@pytest.mark.parametrize('year', [2008, 2012])
+def test_merged_demand_matches_demand_of_all_readings(data_dir, year):
+    pp = _profilePower(year)
+    batches = np.array_split(pp, 3)
+    
+    aggpp = aggProfilePower(pp, 'D')
+    shards = [s.reset_index(drop=True) for s in np.array_split(aggpp, 3)]
+    merged = mergeDemand(pd.concat([annualIntervalDemand(s) for s in shards]), 
+                         ['RecorderID', 'ProfileID_i'])
+    pd.testing.assert_frame_equal(merged, annualIntervalDemand(aggpp), check_dtype=False)
+    
+    keys = ['ProfileID_i', 'month', 'daytype', 'hour']
+    merged = mergeDemand(pd.concat([aggDaytypeDemand(b) for b in batches]), keys)
+    expected = aggDaytypeDemand(pp).sort_values(keys, ignore_index=True)
+    pd.testing.assert_frame_equal(merged, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize('accuracy', [0.01, 0.05, 0.2])
+def test_sketch_quantiles_are_within_the_relative_accuracy(data_dir, accuracy):
+    pp = _profilePower(2012)
+    quantiles = [0.1, 0.5, 0.9, 0.95, 0.99]
+    readings = pp.dropna(subset=['Unitsread_kw'])
+    grouped = readings.groupby(['ProfileID_i', readings['Datefield'].dt.month])['Unitsread_kw']
+    expected = grouped.quantile(quantiles).unstack()
+    
+    sketch = mergeSketches([kwSketch(batch, accuracy) for batch in np.array_split(pp, 3)])
+    pd.testing.assert_frame_equal(sketch, kwSketch(pp, accuracy))
+    estimates = sketchQuantiles(sketch, quantiles, accuracy=accuracy)
+    for q in quantiles:
+        error = np.abs(estimates['kw_p' + '{:g}'.format(100*q)].values - expected[q].values)
+        assert (error <= accuracy*expected[q].values*(1 + 1e-9)).all()
+    assert (estimates['kw_peak'].values == grouped.max().values).all()
+    assert (estimates['count'].values == grouped.count().values).all()
+    
+    # Readings bunched at the lower end of a bucket
+    gamma = (1 + accuracy) / (1 - accuracy)
+    kw = np.r_[gamma**10 + 1e-9, np.full(8, gamma**10*1.0001), gamma**11 - 1e-9]
+    data = pd.DataFrame({'ProfileID_i':1, 'Datefield':pd.Timestamp('2012-01-01'), 
+                         'Unitsread_kw':kw})
+    estimates = sketchQuantiles(kwSketch(data, accuracy), quantiles, accuracy=accuracy)
+    for q in quantiles:
+        expected = np.quantile(kw, q)
+        assert abs(estimates['kw_p' + '{:g}'.format(100*q)][0] - expected) <= accuracy*expected
+
+
+def test_multi_year_generation_keeps_the_callers_options(data_dir, monkeypatch):
+    calls = {}
+    def generate(year, kwargs):
+        calls[year] = kwargs
+        return 0., []
+    monkeypatch.setattr(aggprofiles, '_generateAggYear', generate)
+    options = {'force':True}
+    
+    report = generateAggProfilesMulti(2008, 2009, interval='D', **options)
+    assert report['error'].isnull().all()
+    assert calls == {2008:{'force':True, 'interval':'D'}, 2009:{'force':True, 'interval':'D'}}
+    assert options == {'force':True}
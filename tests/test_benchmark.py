@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+
+from delprocess.benchmark import benchmark
+from delprocess.support import InputError
+
+
+def test_benchmark_keeps_user_directories(tmp_path):
+    benchmark(str(tmp_path), years=[2008], groups=1, households=2, days=1, 
+              run_stages=['reduceRawProfiles'])
+    assert os.path.isdir(str(tmp_path))
+    assert os.listdir(str(tmp_path)) == []
+    
+    (tmp_path / 'notes.txt').write_text('not written by a benchmark')
+    with pytest.raises(InputError):
+        benchmark(str(tmp_path), years=[2008], groups=1, households=2, days=1, 
+                  run_stages=['reduceRawProfiles'])
+    assert (tmp_path / 'notes.txt').read_text() == 'not written by a benchmark'
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+from glob import glob
+import numpy as np
+import pandas as pd
+import feather
+import pyarrow.parquet as pq
+import pytest
+
+from delprocess import loadprofiles
+from delprocess.surveys import loadID, loadTable
+from delprocess.support import InputError, writeAsync, tempPath, profiles_dir
+from delprocess.loadprofiles import (saveReducedProfiles, reduceRawProfiles, updateXCache, 
+                                     resampleReadings, loadRawProfiles, cacheRawProfiles, 
+                                     compactProfiles, loadReducedProfiles, loadXMatrix, 
+                                     getProfilePower, channelTopology, rawProfileColumns, 
+                                     cascadeIntervals, dailyHourlyProfiles, resampleProfiles, 
+                                     _rawProfileFiles, _reducedProfilesPath, 
+                                     _reducedProfilesInput)
+
+
+def _reducedRows(year, unit):
+    return len(feather.read_dataframe(_reducedProfilesPath(year, unit, 'H', 'feather')))
+
+
+def test_incremental_reduction_drops_removed_raw_files(data_dir):
+    saveReducedProfiles(2012, 'H', 'feather', incremental=True)
+    rows = _reducedRows(2012, 'A')
+    
+    childpath = _rawProfileFiles(2012, 'A')[0]
+    moved = os.path.join(data_dir, os.path.basename(childpath))
+    shutil.move(childpath, moved)
+    try:
+        saveReducedProfiles(2012, 'H', 'feather', incremental=True)
+        assert _reducedRows(2012, 'A') == len(reduceRawProfiles(2012, 'A', 'H'))
+        assert _reducedRows(2012, 'A') < rows
+    finally:
+        shutil.move(moved, childpath)
+    
+    saveReducedProfiles(2012, 'H', 'feather', incremental=True)
+    assert _reducedRows(2012, 'A') == rows
+
+
+def test_x_cache_reads_parquet_datasets(data_dir, tmp_path):
+    saveReducedProfiles(2012, 'H', 'feather')
+    flat_paths = glob(os.path.join(os.path.dirname(_reducedProfilesPath(
+            2012, 'A', 'H', 'feather')), '2012_A.*'))
+    dataset_path = _reducedProfilesPath(2012, 'A', 'H', 'parquet')
+    try:
+        saveReducedProfiles(2012, 'H', 'parquet')
+        for path in flat_paths:
+            shutil.move(path, str(tmp_path / os.path.basename(path)))
+        manifest, rebuilt = updateXCache([2012, 2012])
+        
+        # The block is fingerprinted from the dataset, without reducing it to a file
+        assert glob(os.path.join(os.path.dirname(dataset_path), '..', '2012_A.*')) == []
+        assert updateXCache([2012, 2012])[1] == []
+        part_path = glob(os.path.join(dataset_path, '*', '*'))[0]
+        os.utime(part_path)
+        assert updateXCache([2012, 2012])[1] == []
+        table = pq.read_table(part_path)
+        pq.write_table(table.slice(0, table.num_rows//2), part_path)
+        assert updateXCache([2012, 2012])[1] == [2012]
+    finally:
+        for unit in ['A', 'V', 'kVA', 'Hz', 'kW']:
+            shutil.rmtree(os.path.dirname(_reducedProfilesPath(2012, unit, 'H', 'parquet')), 
+                          ignore_errors=True)
+        for path in flat_paths:
+            shutil.move(str(tmp_path / os.path.basename(path)), path)
+
+
+def test_reduced_profiles_ignore_temporary_files(data_dir):
+    saveReducedProfiles(2008, 'H', 'feather')
+    path = _reducedProfilesPath(2008, 'A', 'H', 'feather')
+    
+    def write(tmp_path):
+        # Partially written outputs are not visible to readers
+        assert os.path.dirname(tmp_path) == os.path.dirname(path)
+        assert tmp_path not in glob(os.path.join(os.path.dirname(path), '2008_A.*'))
+        shutil.copy(path, tmp_path)
+    writeAsync(path, write).result()
+    
+    stray_path = path + '.bak'
+    shutil.copy(path, stray_path)
+    try:
+        assert _reducedProfilesInput(2008, 'A', 'H') == path
+    finally:
+        os.remove(stray_path)
+
+
+@pytest.mark.parametrize('interval', ['H', 'D', 'W', 'M', 'Q'])
+def test_filled_resampling_keeps_empty_intervals(interval):
+    data = pd.DataFrame({
+            'RecorderID':['a', 'a', 'a', 'b', 'b', 'c'], 
+            'ProfileID':[1, 1, 1, 2, 2, 3], 
+            'Datefield':pd.to_datetime(['2012-01-03', '2012-01-05', '2012-03-02', 
+                                        '2012-01-01 05:00', '2012-07-09', '2012-02-02']), 
+            'Unitsread':[1., 2., 3., 4., 5., np.nan], 
+            'Valid':[1, 0, 1, 1, 1, 1]})
+    agg = {'Unitsread':np.mean, 'Valid':np.sum}
+    expected = data.set_index('Datefield').groupby(['RecorderID', 'ProfileID']).resample(
+            interval).agg(agg).reset_index()
+    
+    resampled = resampleReadings(data, interval, agg=agg, fill=True)
+    pd.testing.assert_frame_equal(resampled[expected.columns], expected, check_dtype=False)
+
+
+def test_cached_raw_profiles_match_raw_files(data_dir):
+    expected = loadRawProfiles(2012, 1, 'A')
+    assert expected['Valid'].dtype == np.int64
+    try:
+        cacheRawProfiles(2012, 'A')
+        assert rawProfileColumns(_rawProfileFiles(2012, 'A')[0])['Valid'].dtype == np.int8
+        pd.testing.assert_frame_equal(loadRawProfiles(2012, 1, 'A'), expected)
+    finally:
+        shutil.rmtree(os.path.join(profiles_dir, 'raw_cache'), ignore_errors=True)
+
+
+def test_cached_raw_frames_share_the_memory_maps(data_dir, monkeypatch):
+    childpath = _rawProfileFiles(2012, 'A')[0]
+    expected = loadprofiles._loadRawFrame(childpath)
+    # Memory maps of the columns the frames are built on
+    mapped = []
+    def columns(path):
+        mapped.append(rawProfileColumns(path))
+        return mapped[-1]
+    monkeypatch.setattr(loadprofiles, 'rawProfileColumns', columns)
+    try:
+        cacheRawProfiles(2012, 'A')
+        data = loadprofiles._loadRawFrame(childpath)
+        pd.testing.assert_frame_equal(data, expected)
+        for col in ['ProfileID', 'Datefield', 'Unitsread']:
+            assert np.shares_memory(data[col].values, mapped[-1][col])
+        
+        data = loadprofiles._loadRawFrame(childpath, compact=True)
+        pd.testing.assert_frame_equal(data, compactProfiles(expected))
+        for col in ['Datefield', 'Valid']:
+            assert np.shares_memory(data[col].values, mapped[-1][col])
+    finally:
+        shutil.rmtree(os.path.join(profiles_dir, 'raw_cache'), ignore_errors=True)
+
+
+def test_reading_reduced_profiles_creates_no_directories(data_dir):
+    saveReducedProfiles(2008, 'H', 'feather')
+    dirs = sorted(root for root, ds, fs in os.walk(os.path.join(data_dir, 'resampled_profiles')))
+    
+    loadReducedProfiles(2008, 'A', 'H')
+    assert _reducedProfilesInput(2008, 'A', '30T') is None
+    assert sorted(root for root, ds, fs in os.walk(
+            os.path.join(data_dir, 'resampled_profiles'))) == dirs
+
+
+def test_units_outside_the_raw_layout_are_not_failures(data_dir):
+    failures = saveReducedProfiles(2008, 'H', 'feather')
+    
+    assert len(failures) == 0
+    assert _reducedProfilesInput(2008, 'kW', 'H') is None
+
+
+def test_interrupted_streaming_run_keeps_previous_output(data_dir, monkeypatch):
+    saveReducedProfiles(2012, 'H', 'csv', chunksize=1000)
+    path = _reducedProfilesPath(2012, 'A', 'H', 'csv')
+    expected = pd.read_csv(path)
+    
+    reduce = loadprofiles._reduceRawFileIntervals
+    calls = []
+    def interrupted(*args, **kwargs):
+        # The run is killed while the second raw file is reduced
+        calls.append(args[0])
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        return reduce(*args, **kwargs)
+    monkeypatch.setattr(loadprofiles, '_reduceRawFileIntervals', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        saveReducedProfiles(2012, 'H', 'csv', chunksize=1000)
+    
+    pd.testing.assert_frame_equal(pd.read_csv(path), expected)
+    assert not os.path.exists(tempPath(path))
+
+
+def test_raw_csv_with_non_iso_dates(data_dir, tmp_path):
+    childpath = _rawProfileFiles(2012, 'A')[0]
+    raw = pd.read_csv(childpath, parse_dates=['Datefield'])
+    path = str(tmp_path / os.path.basename(childpath))
+    raw.assign(Datefield=raw['Datefield'].dt.strftime('%Y/%m/%d %H:%M:%S.%f')).to_csv(
+            path, index=False)
+    
+    expected = loadprofiles._readRawCsv(childpath)
+    pd.testing.assert_frame_equal(loadprofiles._readRawCsv(path), expected)
+    chunks = list(loadprofiles._readRawCsvChunks(path, 1000))
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected)
+    pd.testing.assert_series_equal(expected['Datefield'], raw['Datefield'])
+
+
+def test_x_matrix_has_the_columns_of_all_blocks(tmp_path):
+    blocks = {'2011':pd.DataFrame({'ProfileID':[1, 2], 'date':pd.to_datetime(
+                      ['2011-01-01', '2011-01-02']), '0':[1., 0.], '1':[2., 0.]}), 
+              '2012':pd.DataFrame({'ProfileID':[3], 'date':pd.to_datetime(['2012-01-01']), 
+                      '1':[3.], '2':[4.]})}
+    for y, block in blocks.items():
+        feather.write_dataframe(block, str(tmp_path / (y + '.feather')))
+    xpath = str(tmp_path / 'X')
+    loadprofiles._writeXMatrix(xpath, str(tmp_path), list(blocks.keys()), {})
+    
+    expected = pd.concat(blocks.values(), ignore_index=True)
+    xmatrix = loadXMatrix(xpath, drop_0=True)
+    assert xmatrix['columns'] == list(expected.columns[2:])
+    np.testing.assert_array_equal(xmatrix['X'], expected.iloc[:, 2:].to_numpy(np.float32))
+    np.testing.assert_array_equal(xmatrix['rows'], [0, 2])
+
+
+def _offsetProfilePower(year):
+    """Pairs channels with ProfileID offsets, as getProfilePower() did originally."""
+    iprofile = loadReducedProfiles(year, 'A', 'H')
+    vprofile = loadReducedProfiles(year, 'V', 'H')
+    if year <= 2009:
+        profiles = loadTable('profiles')
+        profiles = profiles[profiles.ProfileId.isin(loadID()['ProfileID'])]
+        vchan = profiles.loc[profiles['Unit of measurement']==1, ['ProfileId', 'RecorderID']]
+        iprofile = iprofile.merge(vchan, on='RecorderID', suffixes=('_i', '_v'))
+        iprofile.rename(columns={'ProfileId':'matchcol'}, inplace=True)
+        power = iprofile.merge(vprofile, left_on=['matchcol', 'Datefield'], 
+                               right_on=['ProfileID', 'Datefield'], suffixes=['_i', '_v'])
+        power.drop(['RecorderID_i', 'matchcol'], axis=1, inplace=True)
+        power.rename(columns={'RecorderID_v':'RecorderID'}, inplace=True)
+    else:
+        vprofile['matchcol'] = vprofile['ProfileID'] + 1
+        power = vprofile.merge(iprofile, left_on=['matchcol', 'Datefield'], 
+                               right_on=['ProfileID', 'Datefield'], suffixes=['_v', '_i'])
+        power.drop(['RecorderID_v', 'RecorderID_i', 'matchcol'], axis=1, inplace=True)
+        kwprofile = loadReducedProfiles(year, 'kW', 'H')
+        kwprofile['matchcol'] = kwprofile['ProfileID'] - 3
+        kvaprofile = loadReducedProfiles(year, 'kVA', 'H')
+        kvaprofile['matchcol'] = kvaprofile['ProfileID'] - 2
+        kvaprofile.drop(columns='RecorderID', inplace=True)
+        power = power.merge(kwprofile, right_on=['matchcol', 'Datefield'], 
+                            left_on=['ProfileID_v', 'Datefield'])
+        power = power.merge(kvaprofile, right_on=['matchcol', 'Datefield'], 
+                            left_on=['matchcol', 'Datefield'], suffixes=['_kw', '_kva'])
+        power.drop(['matchcol'], axis=1, inplace=True)
+    power['kw_calculated'] = power.Unitsread_v*power.Unitsread_i*0.001
+    power['valid_calculated'] = power.Valid_i * power.Valid_v
+    
+    return power
+
+
+@pytest.mark.parametrize('year', [2008, 2012])
+def test_profile_power_matches_profileid_offsets(data_dir, year):
+    saveReducedProfiles(year, 'H', 'feather')
+    power = getProfilePower(year)
+    expected = _offsetProfilePower(year)
+    
+    keys = ['ProfileID_i', 'Datefield']
+    power = power.sort_values(keys).reset_index(drop=True)
+    expected = expected[power.columns].sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(power, expected, check_dtype=False)
+
+
+def test_channel_topology_falls_back_to_profileid_offsets(data_dir):
+    profiles = loadTable('profiles')
+    expected = channelTopology(profiles)['channel']
+    # Channel numbers that do not follow the documented layout
+    shuffled = profiles.copy()
+    shuffled.loc[shuffled['Unit of measurement']==2, 'ChannelNo'] += 4
+    
+    with pytest.warns(UserWarning):
+        channel = channelTopology(shuffled)['channel']
+    pd.testing.assert_frame_equal(channel, expected)
+
+
+@pytest.mark.parametrize('interval', ['5T', 'H', ['5T', '30T', 'H', 'D']])
+def test_chunked_reduction_matches_unchunked(data_dir, tmp_path, interval):
+    childpath = _rawProfileFiles(2012, 'A')[0]
+    raw = pd.read_csv(childpath)
+    shuffled = str(tmp_path / os.path.basename(childpath))
+    raw.sample(frac=1, random_state=0).to_csv(shuffled, index=False)
+    
+    for path in [childpath, shuffled]:
+        expected = loadprofiles._reduceRawFile(childpath, interval)
+        for chunksize in [97, 1000, 10**7]:
+            reduced = loadprofiles._reduceRawFile(path, interval, chunksize)
+            if isinstance(interval, list):
+                assert list(reduced.keys()) == interval
+                for i in interval:
+                    pd.testing.assert_frame_equal(reduced[i], expected[i])
+            else:
+                pd.testing.assert_frame_equal(reduced, expected)
+
+
+@pytest.mark.parametrize('interval', ['5T', '30T', 'H', 'D', 'M'])
+def test_resampling_matches_groupby_resample(data_dir, interval):
+    data = loadRawProfiles(2012, 1, 'A')
+    # Drop a day of readings to leave empty intervals and blank some readings
+    data = data[data['Datefield'].dt.day != 2].reset_index(drop=True)
+    data.loc[data.index % 7 == 0, 'Unitsread'] = np.nan
+    agg = {'Unitsread':['mean', 'sum', 'count', 'min', 'max'], 'Valid':'mean'}
+    expected = data.set_index('Datefield').groupby(['RecorderID', 'ProfileID']).resample(
+            interval).agg(agg)
+    expected.columns = ['Unitsread_mean', 'Unitsread_sum', 'Unitsread_count', 
+                        'Unitsread_min', 'Unitsread_max', 'Valid']
+    expected = expected.reset_index()
+    
+    resampled = resampleReadings(data, interval, agg=agg, fill=True)
+    pd.testing.assert_frame_equal(resampled[expected.columns], expected, check_dtype=False)
+    
+    # Without fill only the intervals that have readings are returned
+    resampled = resampleReadings(data, interval, agg=agg)
+    empty = expected['Valid'].isna()
+    assert empty.any() == (interval != 'M')
+    expected = expected[~empty].reset_index(drop=True)
+    pd.testing.assert_frame_equal(resampled[expected.columns], expected, check_dtype=False)
+
+
+def test_cascade_reduces_each_interval_like_the_raw_readings(data_dir):
+    cascade = cascadeIntervals(['M', 'H', '30T', 'D', 'W', '5T'])
+    assert list(cascade.items()) == [('5T', None), ('30T', '5T'), ('H', '30T'), 
+                                     ('D', 'H'), ('W', 'D'), ('M', 'D')]
+    with pytest.raises(InputError):
+        cascadeIntervals(['W', 'M'])
+    
+    childpath = _rawProfileFiles(2012, 'A')[0]
+    # Formatted as the raw files were before they were reduced with resampleReadings
+    raw = pd.read_csv(childpath, parse_dates=['Datefield'])
+    raw['Datefield'] = np.round(raw['Datefield'].astype(np.int64), -9).astype('datetime64[ns]')
+    raw['Valid'] = raw['Valid'].map(lambda x: x.strip()).map({'Y':1, 'N':0}).fillna(0)
+    reduced = loadprofiles._reduceRawFile(childpath, list(cascade.keys()))
+    for interval in cascade.keys():
+        expected = raw.set_index('Datefield').groupby(['RecorderID', 'ProfileID']).resample(
+                interval).agg({'Unitsread':'mean', 'Valid':'mean'}).dropna().reset_index()
+        # Intervals with invalid readings are invalid
+        expected.loc[expected['Valid'] < 1, 'Valid'] = 0
+        assert (expected['Valid'] == 0).any()
+        pd.testing.assert_frame_equal(reduced[interval], expected, check_dtype=False)
+
+
+def _dailyHourlyGroupby(data):
+    """Daily hourly profiles as built with groupby().mean().unstack()."""
+    return data['Unitsread'].groupby([data.ProfileID, data.Datefield.dt.date.rename('date'), 
+                                      data.Datefield.dt.hour.rename('hour')]).mean().unstack()
+
+
+@pytest.mark.parametrize('year', [2008, 2012])
+def test_daily_hourly_profiles_match_groupby(data_dir, year):
+    saveReducedProfiles(year, 'H', 'feather')
+    data = loadReducedProfiles(year, 'A', 'H')
+    data.loc[data['Valid'] != 1, 'Unitsread'] = np.nan
+    pd.testing.assert_frame_equal(dailyHourlyProfiles(year, 'A'), _dailyHourlyGroupby(data))
+    
+    # Blank readings and hours without readings are left empty
+    data.loc[data.index % 5 == 0, 'Unitsread'] = np.nan
+    data = data[(data['Datefield'].dt.hour != 5) | (data.index % 3 != 0)]
+    profiles = loadprofiles.dailyHourlyMatrix(data['ProfileID'].values, 
+                                              data['Datefield'].values, data['Unitsread'].values)
+    assert profiles.isna().values.any()
+    pd.testing.assert_frame_equal(profiles, _dailyHourlyGroupby(data))
+
+
+@pytest.mark.parametrize('interval', ['D', 'W', 'M', 'A'])
+def test_period_resampling_matches_groupby_resample(data_dir, interval):
+    saveReducedProfiles(2012, 'H', 'feather')
+    daily = dailyHourlyProfiles(2012, 'A')
+    # Profiles observed again three months later leave empty periods in between
+    later = daily.rename(index=lambda d: d + pd.Timedelta(days=95), level='date')
+    daily = pd.concat([daily, later])
+    df = daily.reset_index()
+    df['date'] = pd.to_datetime(df.date)
+    grouped = df.assign(days=1).set_index('date').groupby('ProfileID').resample(interval)
+    observed = grouped.agg('count')['days'] > 0
+    assert (~observed).any() == (interval != 'A')
+    
+    for aggfunc in ['mean', 'sum', 'min', 'max', 'count']:
+        expected = grouped.agg(aggfunc)[daily.columns][observed]
+        expected.columns = daily.columns
+        pd.testing.assert_frame_equal(resampleProfiles(daily, interval, aggfunc), expected, 
+                                      check_dtype=False)
+    
+    # Periods of a period map
+    dates = pd.DatetimeIndex(df['date'].unique())
+    periods = pd.Series(np.where(dates.month < 3, 'summer', 'autumn'), index=dates, 
+                        name='season')
+    season = pd.Index(periods.reindex(df['date']).values, name='season')
+    expected = daily.groupby([daily.index.get_level_values('ProfileID'), season]).mean()
+    pd.testing.assert_frame_equal(resampleProfiles(daily, periods), expected)